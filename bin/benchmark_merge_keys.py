@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# Micro-benchmark of the unique key building of update_xml.py - the compiled key extractors against
+# the string concatenating implementation they replaced, taken from update_xml.py of the baseline revision
+# by git, on a synthetic profile
+
+import sys
+import os
+import argparse
+from argparse import RawTextHelpFormatter
+import json
+import subprocess
+import time
+import types
+import xml.etree.ElementTree as ElementTree
+
+SCRIPT_FOLDER_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, SCRIPT_FOLDER_PATH)
+import update_xml
+
+CONFIG_PATH = '../etc'
+MERGE_CONFIGURATION = 'merge_config.json'
+NAMESPACE = update_xml.DEFAULT_NAMESPACE
+# revision of update_xml.py before the key extractors were compiled
+BASELINE_REVISION = '4b0ef65'
+
+# profile with the given number of elements of the most common types
+def build_profile(element_count):
+   root = ElementTree.Element('{' + NAMESPACE + '}Profile')
+   for index in range(element_count):
+      element_type = index % 4
+      if element_type == 0:
+         add_element(root, 'fieldPermissions', [('editable', 'true'), ('field', 'Account.Field' + str(index) + '__c'), ('readable', 'true')])
+      elif element_type == 1:
+         add_element(root, 'objectPermissions', [('allowCreate', 'true'), ('allowRead', 'true'), ('object', 'Object' + str(index) + '__c')])
+      elif element_type == 2:
+         add_element(root, 'layoutAssignments', [('layout', 'Object' + str(index) + '__c-Layout'), ('recordType', 'Object' + str(index) + '__c.Type')])
+      else:
+         add_element(root, 'userPermissions', [('enabled', 'true'), ('name', 'Permission' + str(index))])
+   return root
+
+def add_element(root, name, children):
+   element = ElementTree.SubElement(root, '{' + NAMESPACE + '}' + name)
+   for child_name, text in children:
+      ElementTree.SubElement(element, '{' + NAMESPACE + '}' + child_name).text = text
+
+# update_xml.py of the revision loaded as a module of its own, its build_element_unique_key is the baseline
+def load_baseline(revision):
+   try:
+      source = subprocess.check_output(['git', 'show', revision + ':bin/update_xml.py'], cwd=SCRIPT_FOLDER_PATH)
+   except (OSError, subprocess.CalledProcessError) as e:
+      raise SystemExit('Unable to read update_xml.py of revision ' + revision + ' by git: ' + str(e))
+   baseline = types.ModuleType('update_xml_' + revision)
+   baseline.__file__ = SCRIPT_FOLDER_PATH + '/update_xml.py'
+   exec(compile(source, 'update_xml.py@' + revision, 'exec'), baseline.__dict__)
+   return baseline
+
+def measure(function, repeat):
+   best = None
+   for attempt in range(repeat):
+      start_time = time.time()
+      function()
+      elapsed = time.time() - start_time
+      if best is None or elapsed < best:
+         best = elapsed
+   return best
+
+def main():
+   parser = argparse.ArgumentParser(description='Measures the unique key building of update_xml.py.\n' +
+                                                'Example:\n' +
+                                                '\t' + os.path.basename(__file__) + ' -n 50000',
+						formatter_class=RawTextHelpFormatter)
+   parser.add_argument(
+        "-n", "--elements", dest="elements", type=int, default=50000,
+        help="Number of elements of the synthetic profile (default: 50000)")
+
+   parser.add_argument(
+        "-r", "--repeat", dest="repeat", type=int, default=5,
+        help="Runs of every variant, the best one is reported (default: 5)")
+
+   parser.add_argument(
+        "--baseline", dest="baseline", default=BASELINE_REVISION,
+        help="Git revision of update_xml.py the compiled key extractors are compared with (default: " + BASELINE_REVISION + ")")
+
+   args = parser.parse_args()
+
+   with open(SCRIPT_FOLDER_PATH + '/' + CONFIG_PATH + '/' + MERGE_CONFIGURATION) as json_merge_config_file:
+      merge_type_config = json.load(json_merge_config_file)['profiles']
+   merge_keys = update_xml.compile_merge_config(merge_type_config, NAMESPACE)
+   root = build_profile(args.elements)
+   baseline = load_baseline(args.baseline)
+
+   # both variants have to tell the same elements apart
+   string_keys = set(baseline.build_element_unique_key(child, merge_type_config, NAMESPACE) for child in root)
+   tuple_keys = set(update_xml.build_element_unique_key(child, merge_keys) for child in root)
+   if set(update_xml.format_element_key(key, merge_keys) for key in tuple_keys) != string_keys:
+      raise SystemExit('Compiled key extractors build different keys')
+
+   string_time = measure(lambda: [baseline.build_element_unique_key(child, merge_type_config, NAMESPACE) for child in root], args.repeat)
+   tuple_time = measure(lambda: [update_xml.build_element_unique_key(child, merge_keys) for child in root], args.repeat)
+
+   print('Elements:                 ' + str(args.elements))
+   print('Baseline revision:        ' + args.baseline)
+   print('String keys:              %.4f s' % string_time)
+   print('Compiled key extractors:  %.4f s' % tuple_time)
+   print('Speed-up:                 %.1fx' % (string_time / tuple_time))
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+# Benchmark of the cleanup (clean_sf_metadata.py), merge (update_xml.py) and synchronization
+# (synchronize_sf_metadata.py) of metadata trees generated by generate_sf_metadata.py at several sizes
+# Every run starts from fresh copies of the trees and an empty home folder (no caches), the wall time,
+# peak RSS and number of spawned processes of the runs are written as json
+
+import sys
+import os
+import argparse
+from argparse import RawTextHelpFormatter
+import json
+import subprocess
+import multiprocessing
+import platform
+import shutil
+import tempfile
+import time
+
+SCRIPT_FOLDER_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, SCRIPT_FOLDER_PATH)
+import generate_sf_metadata
+
+BENCHMARK_VERSION = 2
+
+# generate_sf_metadata.py arguments of the sizes
+SIZES = {
+   'small': {'profiles': 5, 'field_permissions': 500, 'object_permissions': 50, 'class_accesses': 100, 'layout_assignments': 50,
+             'user_permissions': 20, 'objects': 2, 'fields': 500, 'classes': 50},
+   'medium': {'profiles': 20, 'field_permissions': 2000, 'object_permissions': 200, 'class_accesses': 500, 'layout_assignments': 200,
+              'user_permissions': 50, 'objects': 5, 'fields': 2000, 'classes': 200},
+   'large': {'profiles': 50, 'field_permissions': 10000, 'object_permissions': 500, 'class_accesses': 2000, 'layout_assignments': 500,
+             'user_permissions': 100, 'objects': 20, 'fields': 5000, 'classes': 1000}
+}
+SEED = 1
+UPDATE_VARIANT = 1
+
+BENCHMARKS = ['cleanup', 'merge-profiles', 'merge-objects', 'sync']
+
+# (benchmark, work folder of the size, run folder, settings, python) -> command, the run folder is prepared by prepare_run
+def get_command(benchmark, size_folder, run_folder, args, python):
+   if benchmark == 'cleanup':
+      return [python, SCRIPT_FOLDER_PATH + '/clean_sf_metadata.py', '-s', size_folder + '/base/src', '-t', run_folder + '/cleaned',
+              '--no-cache', '-j', str(args.jobs)]
+   if benchmark in ('merge-profiles', 'merge-objects'):
+      folder_name = benchmark[len('merge-'):]
+      return [python, SCRIPT_FOLDER_PATH + '/update_xml.py', '-m', folder_name, '-j', str(args.jobs), '--no-cache',
+              '-o', run_folder + '/merged', size_folder + '/base/src/' + folder_name, size_folder + '/update/src/' + folder_name]
+   return [python, SCRIPT_FOLDER_PATH + '/synchronize_sf_metadata.py', '-s', size_folder + '/update/src', '-t', run_folder + '/target']
+
+# the synchronization changes its target, so the base tree is copied there first (not measured)
+def prepare_run(benchmark, size_folder, run_folder):
+   if os.path.isdir(run_folder):
+      shutil.rmtree(run_folder)
+   os.makedirs(run_folder + '/home')
+   if benchmark == 'sync':
+      shutil.copytree(size_folder + '/base/src', run_folder + '/target')
+
+# number of processes created on the machine so far, None where it's not known
+def get_process_count():
+   try:
+      with open('/proc/stat') as stat_file:
+         for line in stat_file:
+            if line.startswith('processes '):
+               return int(line.split()[1])
+   except (IOError, OSError):
+      pass
+   return None
+
+# runs the command with the run folder as its home and returns its measurements
+# peak RSS is the largest one of the command and the processes it waited for (in kilobytes on Linux)
+def measure_command(command, run_folder):
+   environment = dict(os.environ)
+   environment['HOME'] = run_folder + '/home'
+   with open(run_folder + '/output.log', 'wb') as log_file:
+      process_count = get_process_count()
+      start_time = time.time()
+      process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, env=environment, cwd=run_folder)
+      pid, status, resource_usage = os.wait4(process.pid, 0)
+      wall_time = time.time() - start_time
+      spawns = get_process_count() - process_count if process_count is not None else None
+   process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+   run = {'wall-time': round(wall_time, 4), 'peak-rss-kb': resource_usage.ru_maxrss, 'spawns': spawns, 'returncode': process.returncode}
+   if process.returncode != 0:
+      with open(run_folder + '/output.log') as log_file:
+         run['error'] = log_file.read()[-2000:]
+   return run
+
+def median(values):
+   values = sorted(values)
+   middle = len(values) // 2
+   return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+# pythons the benchmark runs with - python 2 runs everything as deployed (synchronize_sf_metadata.py starts
+# update_xml.py by its shebang under python 2), the merge runs with python 3 as well if it's given
+def get_pythons(benchmark, args):
+   if benchmark.startswith('merge-') and args.python3:
+      return [args.python2, args.python3]
+   return [args.python2]
+
+def run_benchmark(benchmark, size, size_folder, args, python):
+   runs = []
+   for attempt in range(args.repeat):
+      run_folder = size_folder + '/runs/' + benchmark
+      prepare_run(benchmark, size_folder, run_folder)
+      runs.append(measure_command(get_command(benchmark, size_folder, run_folder, args, python), run_folder))
+   wall_times = [run['wall-time'] for run in runs]
+   spawns = [run['spawns'] for run in runs if run['spawns'] is not None]
+   return {'benchmark': benchmark, 'size': size, 'python': python, 'runs': runs, 'failed': any(run['returncode'] != 0 for run in runs),
+           'wall-time': {'min': min(wall_times), 'median': round(median(wall_times), 4)},
+           'peak-rss-kb': max(run['peak-rss-kb'] for run in runs),
+           'spawns': median(spawns) if spawns else None}
+
+# base tree and its update variant of the size
+def generate_trees(size, size_folder):
+   parser = generate_sf_metadata.get_parser()
+   for tree_name, variant in [('base', 0), ('update', UPDATE_VARIANT)]:
+      generator_args = parser.parse_args(['-o', size_folder + '/' + tree_name, '--seed', str(SEED), '--variant', str(variant)])
+      for name, value in SIZES[size].items():
+         setattr(generator_args, name, value)
+      generate_sf_metadata.generate_tree(generator_args)
+
+def get_output(command):
+   try:
+      return subprocess.check_output(command, stderr=subprocess.STDOUT, cwd=SCRIPT_FOLDER_PATH).decode('utf-8').strip()
+   except (subprocess.CalledProcessError, OSError):
+      return None
+
+# what the results depend on besides the sizes, results are comparable if it's the same
+def get_environment(args):
+   commit = get_output(['git', 'rev-parse', 'HEAD'])
+   return {'commit': commit, 'dirty': bool(get_output(['git', 'status', '--porcelain', '--untracked-files=no'])) if commit else None,
+           'python2': get_output([args.python2, '--version']), 'python3': get_output([args.python3, '--version']) if args.python3 else None,
+           'platform': platform.platform(), 'cpu-count': multiprocessing.cpu_count(), 'jobs': args.jobs}
+
+def main():
+   parser = argparse.ArgumentParser(description='Measures cleanup, merge and synchronization of generated metadata trees.\n' +
+                                                'Example:\n' +
+                                                '\t' + os.path.basename(__file__) + ' --sizes small,medium -o benchmark.json',
+						formatter_class=RawTextHelpFormatter)
+   parser.add_argument(
+        "-o", "--output", dest="output", default='-',
+        help="Json file with the results (default: '-' prints them)")
+
+   parser.add_argument(
+        "--sizes", dest="sizes", default='small,medium',
+        help="Comma separated sizes of the trees from " + ', '.join(sorted(SIZES)) + " (default: small,medium)")
+
+   parser.add_argument(
+        "--benchmarks", dest="benchmarks", default=','.join(BENCHMARKS),
+        help="Comma separated benchmarks from " + ', '.join(BENCHMARKS) + " (default: all)")
+
+   parser.add_argument(
+        "-r", "--repeat", dest="repeat", type=int, default=3,
+        help="Runs of every benchmark (default: 3)")
+
+   parser.add_argument(
+        "-j", "--jobs", dest="jobs", type=int, default=multiprocessing.cpu_count(),
+        help="Parallel jobs of the cleanup and the merge (default: number of cpus)")
+
+   parser.add_argument(
+        "--python2", dest="python2", default='python2',
+        help="Python all benchmarks run with, the one the scripts are deployed with (default: python2)")
+
+   parser.add_argument(
+        "--python3", dest="python3",
+        help="Python the merge benchmarks run with as well, for a comparison (default: none)")
+
+   parser.add_argument(
+        "--work-folder", dest="work_folder",
+        help="Folder of the generated trees and the runs, kept after the benchmark (default: temporary folder)")
+
+   args = parser.parse_args()
+
+   sizes = args.sizes.split(',')
+   benchmarks = args.benchmarks.split(',')
+   for size in sizes:
+      if size not in SIZES:
+         parser.error("unknown size " + size)
+   for benchmark in benchmarks:
+      if benchmark not in BENCHMARKS:
+         parser.error("unknown benchmark " + benchmark)
+   if args.repeat < 1:
+      parser.error("--repeat must be at least 1")
+
+   work_folder = args.work_folder or tempfile.mkdtemp(prefix='benchmark_sf_metadata_')
+   results = []
+   try:
+      for size in sizes:
+         size_folder = os.path.abspath(work_folder + '/' + size)
+         if os.path.isdir(size_folder):
+            shutil.rmtree(size_folder)
+         generate_trees(size, size_folder)
+         for benchmark in benchmarks:
+            for python in get_pythons(benchmark, args):
+               result = run_benchmark(benchmark, size, size_folder, args, python)
+               sys.stderr.write(benchmark + ' (' + size + ', ' + os.path.basename(python) + '): ' + '%.3f s, %d kB' % (result['wall-time']['median'], result['peak-rss-kb']) +
+                                (', failed' if result['failed'] else '') + '\n')
+               results.append(result)
+   finally:
+      if not args.work_folder:
+         shutil.rmtree(work_folder)
+
+   report = json.dumps({'version': BENCHMARK_VERSION, 'environment': get_environment(args), 'repeat': args.repeat,
+                        'sizes': dict((size, SIZES[size]) for size in sizes), 'seed': SEED, 'results': results}, indent=3, sort_keys=True)
+   if args.output == '-':
+      print(report)
+   else:
+      with open(args.output, 'w') as output_file:
+         output_file.write(report)
+
+if __name__ == "__main__":
+   main()
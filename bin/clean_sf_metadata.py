@@ -8,10 +8,21 @@ import os
 import argparse
 from argparse import RawTextHelpFormatter
 import json
-import subprocess
 import re
 import xml.etree.ElementTree as ElementTree
+import copy_backend
 import shutil
+import multiprocessing
+import hashlib
+import time
+import zipfile
+import struct
+import tempfile
+import posixpath
+import copy
+from contextlib import closing
+from io import BytesIO
+from xml.sax.saxutils import quoteattr
 
 # script context variables
 SCRIPT_FOLDER_PATH = os.path.dirname(os.path.realpath(__file__))
@@ -27,6 +38,36 @@ DEFAULT_NAMESPACE = "http://soap.sforce.com/2006/04/metadata"
 # configuration folders and files
 DEFAULT_SF_CLEANUP_JSON_CONFIG = 'salesforce_metadata_cleanup_config.json'
 CONFIG = '../etc'
+# cleanup caches of the source folders - one per absolute path of the source folder, kept out of the folder so
+# they don't end up in the deployed packages or the repositories, least recently used ones are evicted beyond
+# the cache size (number of source folders)
+CACHE_FOLDER = os.path.expanduser('~/.cache/clean_sf_metadata/files')
+CACHE_VERSION = 1
+CACHE_SIZE = 64
+# cache file kept in the source folder by the previous versions, it's removed once the cache is saved
+LEGACY_CACHE_FILE = '.clean_sf_metadata_cache.json'
+HASH_CHUNK_SIZE = 1024 * 1024
+# rules of the recently used cleanup configurations compiled independently of the source tree, keyed by the
+# configuration file and its content, the configurations it extends are checked by their content on load
+RULES_CACHE_FOLDER = os.path.expanduser('~/.cache/clean_sf_metadata')
+RULES_CACHE_VERSION = 2
+RULES_CACHE_SIZE = 32
+# files of this size (in megabytes) and above are cleaned in streaming mode
+DEFAULT_STREAMING_THRESHOLD = 8
+# zip local file header, its file name and extra field lengths are the last two items
+ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+# general purpose flag of zip entries with sizes and crc stored after the data
+ZIP_DATA_DESCRIPTOR_FLAG = 0x08
+
+# element level cleanup actions (in the order they are applied) and their mandatory rule keys
+ELEMENT_ACTIONS = [
+   ('remove-element-matching', ['element-name', 'matching']),
+   ('replace-tag-value', ['element-name', 'value', 'replace-value']),
+   ('remove-element', ['element-name'])
+]
+
+# patterns compiled so far (file masks, matching and replace patterns)
+COMPILED_PATTERNS = {}
 
 class Color:
     BLUE = '\033[94m'
@@ -93,6 +134,33 @@ def load_config(config_file_path):
 
    return json_data
 
+# load cleanup configuration including the rules of the configurations it extends ("extend" - path or list
+# of paths relative to it), rules of the extended configurations come first
+# sources - if given, real path -> content hash of every configuration file loaded is added there
+def load_cleanup_config(config_file_path, extending = (), sources = None):
+   sf_cleanup_config = load_config(config_file_path)
+   if sources is not None:
+      sources[os.path.realpath(config_file_path)] = get_file_hash(config_file_path)
+   base_config_paths = sf_cleanup_config.pop('extend', [])
+   if not isinstance(base_config_paths, list):
+      base_config_paths = [base_config_paths]
+
+   extending = extending + (os.path.realpath(config_file_path),)
+   merged_config = {}
+   for base_config_path in base_config_paths:
+      base_config_path = os.path.join(os.path.dirname(config_file_path), base_config_path)
+      if os.path.realpath(base_config_path) in extending:
+         raise RuntimeError("Cleanup configuration " + config_file_path + " extends " + base_config_path + " which extends it back")
+      merge_cleanup_config(merged_config, load_cleanup_config(base_config_path, extending, sources))
+   merge_cleanup_config(merged_config, sf_cleanup_config)
+   return merged_config
+
+def merge_cleanup_config(sf_cleanup_config, extending_config):
+   for action, folder_config in extending_config.items():
+      action_config = sf_cleanup_config.setdefault(action, {})
+      for folder_name, rules in folder_config.items():
+         action_config.setdefault(folder_name, []).extend(rules)
+
 def get_folder_list(path):
    folder_list = [] 
    if os.path.isdir(path):
@@ -101,166 +169,977 @@ def get_folder_list(path):
             folder_list.append(name)
    return folder_list
 
+def get_pattern(pattern):
+   if pattern not in COMPILED_PATTERNS:
+      COMPILED_PATTERNS[pattern] = re.compile(pattern)
+   return COMPILED_PATTERNS[pattern]
+
 def get_file_list(path, fileMask = '.*'):
    file_list = []
 
+   file_matcher = get_pattern(fileMask)
    for name in os.listdir(path):
-      file_matcher = re.compile(fileMask)
       if not os.path.isdir(path + '/' + name) and file_matcher.match(name):
           file_list.append(name)
    return file_list
 
-def remove_element_matching(sf_cleanup_config, path, folder_list):
-   if 'remove-element-matching' in sf_cleanup_config:
-      config = sf_cleanup_config['remove-element-matching']
-      for folder_name in folder_list:
-         if folder_name in config:
-            folder_config = config[folder_name]
-            for rule in folder_config:
-               if 'matching' in rule  and 'element-name' in rule:
-                  file_list = []
-                  matching = rule['matching']
-
-                  if 'fileMask' in rule:
-                     file_list = get_file_list(path + "/" + folder_name, rule['fileMask'])
-                  else:
-                     file_list = get_file_list(path + "/" + folder_name)
-                  
-                  for file_name in file_list:
-                     element = rule['element-name']
-                     cmd = 'metadata-xml-tool remove-element-matching ' + element + ' "' +  matching + '" ' + path + "/" + folder_name + "/" + file_name
-
-                     print_info("Element to be removed (if exists) " + color_string(element, Color.MAGENTA) + " matching " + color_string(matching, Color.MAGENTA) + " from " + color_string(path + "/" + folder_name + "/" + file_name, Color.MAGENTA))
-                     try:
-                        result = subprocess.check_output(cmd, shell=True)
-                     except subprocess.CalledProcessError as e:
-                        if(not IGNORE_ERRORS):
-                           raise RuntimeError("remove-element_matching command failed (Command: '{}' returned error (code {}). If you want to ignore errors during the processing you can run it with --ignore-errors parameter. Please, also use -d parameter for more details".format(e.cmd, e.returncode))
-                        result = e.output
-
-def remove_element(sf_cleanup_config, path, folder_list):
-   if 'remove-element' in sf_cleanup_config:
-      config = sf_cleanup_config['remove-element']
-      for folder_name in folder_list:
-         if folder_name in config:
-            folder_config = config[folder_name]
-            for rule in folder_config:
-               if 'element-name' in rule:
-                  file_list = []
-
-                  if 'fileMask' in rule:
-                     file_list = get_file_list(path + "/" + folder_name, rule['fileMask'])
-                  else:
-                     file_list = get_file_list(path + "/" + folder_name)
-                  
-                  for file_name in file_list:
-                     element = rule['element-name']
-                     cmd = 'metadata-xml-tool remove-element ' + element + ' ' + path + "/" + folder_name + "/" + file_name
-        
-                     print_info("Removing element " + color_string(element, Color.MAGENTA) + " from " + color_string(path + "/" + folder_name + "/" + file_name, Color.MAGENTA)) 
-                     try:
-                        result = subprocess.check_output(cmd, shell=True)
-                     except subprocess.CalledProcessError as e:
-                        if(not IGNORE_ERRORS):
-                           raise RuntimeError("remove-element command failed (Command: '{}' returned error (code {}). If you want to ignore errors during the processing you can run it with --ignore-errors parameter. Please, also use -d parameter for more details".format(e.cmd, e.returncode))
-                        result = e.output 
-
-def replace_tag_value(sf_cleanup_config, path, folder_list):
-    if 'replace-tag-value' in sf_cleanup_config:
-      config = sf_cleanup_config['replace-tag-value']
-      for folder_name in folder_list:
-         if folder_name in config:
-            folder_config = config[folder_name]
-            for rule in folder_config:
-               if 'element-name' in rule and 'value' in rule and 'replace-value' in rule:
-                  file_list = []
-
-                  if 'fileMask' in rule:
-                     file_list = get_file_list(path + "/" + folder_name, rule['fileMask'])
-                  else:
-                     file_list = get_file_list(path + "/" + folder_name)
-                  
-                  for file_name in file_list:
-                     element = rule['element-name']
-                     value = rule['value']
-                     replace_value = rule['replace-value']
-                     cmd = 'metadata-xml-tool replace-tag-value ' + element + ' "' + value + '" "' + replace_value + '" ' +  path + "/" + folder_name + "/" + file_name 
-                     print_info("Replacing tag " + color_string(element, Color.MAGENTA) + " value " + color_string(replace_value, Color.MAGENTA) + " by "  + color_string(replace_value, Color.MAGENTA) + ' in ' + color_string(path + "/" + folder_name + "/" + file_name, Color.MAGENTA)) 
-                     try:
-                        result = subprocess.check_output(cmd, shell=True)
-                     except subprocess.CalledProcessError as e:
-                        if(not IGNORE_ERRORS):
-                           raise RuntimeError("replace-tag-value command failed (Command: '{}' returned error (code {}). If you want to ignore errors during the processing you can run it with --ignore-errors parameter. Please, also use -d parameter for more details".format(e.cmd, e.returncode))
-                        result = e.output 
-  
-def remove_files(sf_cleanup_config, path, folder_list):
-    if 'remove-file' in sf_cleanup_config:
-      config = sf_cleanup_config['remove-file']
-      for folder_name in folder_list:
-         if folder_name in config:
-            folder_config = config[folder_name]
-            for rule in folder_config:
-               file_list = []
-               if 'fileMask' in rule:
-                  file_list = get_file_list(path + "/" + folder_name, rule['fileMask'])
-               else:
-                  file_list = get_file_list(path + "/" + folder_name)
-
-               for file_name in file_list:
-                  file_path = path + "/" + folder_name + "/" + file_name
-                  print_info("Removing file " + color_string(file_path, Color.MAGENTA))
-                  try:
-                     os.remove(file_path)
-                  except Exception as e:
-                     error_message = "Unable to remove file " + file_path
-                     if(not IGNORE_ERRORS):
-                        raise RuntimeError(error_message)
-                     else:
-                        print_error(error_message)
-               
-               # if there is not file left in the folder then delete the folder as well
-               #if 'fileMask' in rule:
-                  #file_list = get_file_list(path + "/" + folder_name, rule['fileMask'])
-               #else:
-               file_list = get_file_list(path + "/" + folder_name)
- 
-               if len(file_list) == 0:
-                  print_info("Folder is empty - removing folder: " + color_string(path + "/" + folder_name, Color.MAGENTA))
-                  shutil.rmtree(path + "/" + folder_name)
-
-def adjust_package_xml(sf_cleanup_config, path, folder_list, package_xml, namespace):
-    if 'remove-file' in sf_cleanup_config:
-      config = sf_cleanup_config['remove-file']
-      for folder_name in folder_list:
-         if folder_name in config:
-            folder_config = config[folder_name]
-            for rule in folder_config:
-               file_list = []
-               if 'fileMask' in rule:
-                  file_list = get_file_list(path + "/" + folder_name, rule['fileMask'])
+def get_local_tag(element):
+   return element.tag.rsplit('}', 1)[-1]
+
+def element_to_string(element):
+   string = ElementTree.tostring(element)
+   if not isinstance(string, str):
+      string = string.decode('utf-8')
+   return string
+
+# removes matching children, keeping the indentation of the following sibling or closing tag
+def remove_children(parent, predicate):
+   kept = []
+   for child in parent:
+      if predicate(child):
+         if kept:
+            kept[-1].tail = child.tail
+         elif not (parent.text or '').strip():
+            parent.text = child.tail
+      else:
+         kept.append(child)
+
+   removed = len(parent) - len(kept)
+   if removed > 0:
+      parent[:] = kept
+   return removed
+
+# removes matching elements at any depth
+def remove_elements(parent, predicate):
+   removed = remove_children(parent, predicate)
+   for child in parent:
+      removed += remove_elements(child, predicate)
+   return removed
+
+def remove_element_matching(root, element_name, matching):
+   matcher = get_pattern(matching)
+   return remove_elements(root, lambda child: get_local_tag(child) == element_name and matcher.search(element_to_string(child)) is not None)
+
+def remove_element(root, element_name):
+   return remove_elements(root, lambda child: get_local_tag(child) == element_name)
+
+# value is a pattern, only its first occurrence in the tag text gets replaced
+def replace_tag_value(root, element_name, value, replace_value):
+   replaced = 0
+   matcher = get_pattern(value)
+   for element in root.iter():
+      if get_local_tag(element) == element_name and element.text is not None:
+         text = matcher.sub(replace_value, element.text, 1)
+         if text != element.text:
+            element.text = text
+            replaced += 1
+   return replaced
+
+# compiles the cleanup configuration into rules that don't depend on the source tree:
+# 'config-hash' - hash of the cleanup configuration, 'sources' - real path -> content hash of the configuration files
+# 'rules' - (rule id, action, folder name, rule) of all configured rules, 'duplicate-rules' - rule id -> id of the identical rule
+# 'element-rules' - folder name -> (action, rule id, rule) of the unique element rules in the order they are applied
+# 'remove-file-rules' - folder name -> (rule id, rule) of the unique remove-file rules
+def compile_cleanup_rules(config_file_path):
+   sources = {}
+   sf_cleanup_config = load_cleanup_config(config_file_path, sources = sources)
+   rules = []
+   duplicate_rules = {}
+   element_rules = {}
+   for action, required_keys in ELEMENT_ACTIONS:
+      config = sf_cleanup_config.get(action, {})
+      for folder_name in sorted(config):
+         for rule_id, rule in get_unique_rules(config[folder_name], action, folder_name, rules, duplicate_rules):
+            if all(key in rule for key in required_keys):
+               element_rules.setdefault(folder_name, []).append((action, rule_id, rule))
+
+   remove_file_rules = {}
+   config = sf_cleanup_config.get('remove-file', {})
+   for folder_name in sorted(config):
+      remove_file_rules[folder_name] = get_unique_rules(config[folder_name], 'remove-file', folder_name, rules, duplicate_rules)
+
+   return {'config-hash': get_config_hash(sf_cleanup_config), 'sources': sources, 'rules': rules, 'duplicate-rules': duplicate_rules,
+           'element-rules': element_rules, 'remove-file-rules': remove_file_rules}
+
+# the rules only depend on the configuration files, so they are compiled once and loaded from the rules cache by
+# subsequent runs whatever source tree they clean
+def get_cleanup_rules(config_file_path, use_cache = True):
+   rules_key = hashlib.sha1(json.dumps([RULES_CACHE_VERSION, os.path.realpath(config_file_path), get_file_hash(config_file_path)]).encode('utf-8')).hexdigest()
+   rules_path = RULES_CACHE_FOLDER + '/' + rules_key + '.json'
+
+   if use_cache and os.path.isfile(rules_path):
+      try:
+         cleanup_rules = load_cleanup_rules(rules_path)
+         if all(os.path.isfile(source_path) and get_file_hash(source_path) == source_hash for source_path, source_hash in cleanup_rules['sources'].items()):
+            print_info("Cleanup rules loaded from " + color_string(rules_path, Color.MAGENTA))
+            return cleanup_rules
+         print_info("Configurations extended by " + color_string(config_file_path, Color.MAGENTA) + " changed, compiling its cleanup rules again")
+      except (IOError, OSError, ValueError, KeyError):
+         print_error("Unable to read cleanup rules " + rules_path + ", compiling them again")
+
+   cleanup_rules = compile_cleanup_rules(config_file_path)
+   if use_cache:
+      save_cleanup_rules(rules_path, cleanup_rules)
+   return cleanup_rules
+
+# json turns tuples into lists, rules are turned back
+def load_cleanup_rules(rules_path):
+   cleanup_rules = load_config(rules_path)
+   cleanup_rules['rules'] = [tuple(rule) for rule in cleanup_rules['rules']]
+   for folder_name, folder_rules in cleanup_rules['element-rules'].items():
+      cleanup_rules['element-rules'][folder_name] = [tuple(rule) for rule in folder_rules]
+   for folder_name, folder_rules in cleanup_rules['remove-file-rules'].items():
+      cleanup_rules['remove-file-rules'][folder_name] = [tuple(rule) for rule in folder_rules]
+   # used by the subsequent runs, least recently used rules are evicted first
+   os.utime(rules_path, None)
+   return cleanup_rules
+
+# concurrent runs may save the same rules, so temporary files are per process
+def save_cleanup_rules(rules_path, cleanup_rules):
+   try:
+      make_cache_folder(RULES_CACHE_FOLDER)
+      write_file(rules_path, json.dumps(cleanup_rules).encode('utf-8'), '.tmp.' + str(os.getpid()))
+      evict_cache_files(RULES_CACHE_FOLDER, RULES_CACHE_SIZE)
+   except (IOError, OSError):
+      print_error("Unable to write cleanup rules " + rules_path)
+
+# the cache folder may be created by a concurrent run at the same time
+def make_cache_folder(folder_path):
+   try:
+      os.makedirs(folder_path)
+   except OSError:
+      if not os.path.isdir(folder_path):
+         raise
+
+# removes the least recently used json files of the cache folder beyond the size (number of files), files
+# removed by a concurrent run meanwhile are skipped
+def evict_cache_files(folder_path, size):
+   cache_files = []
+   for name in os.listdir(folder_path):
+      if name.endswith('.json'):
+         try:
+            cache_files.append((os.path.getmtime(folder_path + '/' + name), folder_path + '/' + name))
+         except OSError:
+            pass
+   for modification_time, file_path in sorted(cache_files)[:-size]:
+      try:
+         os.remove(file_path)
+      except OSError:
+         pass
+
+# matches the cleanup rules against the source tree into a plan:
+# 'path' - source folder, 'config-hash' - hash of the cleanup configuration
+# 'rules' - (rule id, action, folder name, rule) of the rules of the source folders, 'duplicate-rules' - rule id -> id of the identical rule
+# 'file-operations' - file path -> element operations in the order they are applied
+# 'remove-file' - (folder name, file name, package.xml type, rule id) of files to be removed
+# 'remove-file-folders' - folders having remove-file rules, removed if no file is left in them
+# 'folder-files' - files of every folder the configuration refers to
+# every folder is listed once, identical rules are applied once and unless merge_rules is off (profiling)
+# all matching patterns of the same element are merged into a single alternation per file
+# folder_files - files of the folders if they are not to be listed from the source folder (zip)
+def compile_cleanup_plan(cleanup_rules, path, folder_list, merge_rules = True, folder_files = None):
+   if folder_files is None:
+      folder_files = {}
+   folders = set(folder_list)
+   file_rules = {}
+   for folder_name in sorted(cleanup_rules['element-rules']):
+      if folder_name in folders:
+         for action, rule_id, rule in cleanup_rules['element-rules'][folder_name]:
+            for file_name in get_rule_file_list(path, folder_name, rule, folder_files):
+               file_rules.setdefault(path + "/" + folder_name + "/" + file_name, []).append((action, rule_id, rule))
+
+   file_operations = {}
+   for file_path in file_rules:
+      file_operations[file_path] = get_file_operations(file_rules[file_path], merge_rules)
+
+   removed_files = []
+   removed_file_paths = set()
+   removed_file_folders = []
+   for folder_name in sorted(cleanup_rules['remove-file-rules']):
+      if folder_name in folders:
+         removed_file_folders.append(folder_name)
+         for rule_id, rule in cleanup_rules['remove-file-rules'][folder_name]:
+            for file_name in get_rule_file_list(path, folder_name, rule, folder_files):
+               if (folder_name, file_name) not in removed_file_paths:
+                  removed_file_paths.add((folder_name, file_name))
+                  removed_files.append((folder_name, file_name, rule.get('package_xml_type'), rule_id))
+
+   rules = [rule for rule in cleanup_rules['rules'] if rule[2] in folders]
+   rule_ids = set(rule[0] for rule in rules)
+   duplicate_rules = dict((rule_id, unique_rule_id) for rule_id, unique_rule_id in cleanup_rules['duplicate-rules'].items() if rule_id in rule_ids)
+   return {'path': path, 'config-hash': cleanup_rules['config-hash'], 'rules': rules, 'duplicate-rules': duplicate_rules, 'file-operations': file_operations, 'remove-file': removed_files, 'remove-file-folders': removed_file_folders, 'folder-files': folder_files}
+
+# returns (rule id, rule) of the first occurrence of every rule, all rules are added to the rules list
+# and the ids of repeated ones to duplicate_rules
+def get_unique_rules(folder_rules, action, folder_name, rules, duplicate_rules):
+   unique_rules = []
+   rule_ids = {}
+   for index, rule in enumerate(folder_rules):
+      rule_id = action + '/' + folder_name + '/' + str(index)
+      rules.append((rule_id, action, folder_name, rule))
+      rule_key = json.dumps(rule, sort_keys=True)
+      if rule_key in rule_ids:
+         duplicate_rules[rule_id] = rule_ids[rule_key]
+      else:
+         rule_ids[rule_key] = rule_id
+         unique_rules.append((rule_id, rule))
+   return unique_rules
+
+def get_rule_file_list(path, folder_name, rule, folder_files):
+   if folder_name not in folder_files:
+      folder_files[folder_name] = sorted(get_file_list(path + "/" + folder_name))
+   file_matcher = get_pattern(rule.get('fileMask', '.*'))
+   return [file_name for file_name in folder_files[folder_name] if file_matcher.match(file_name)]
+
+# turns the rules of a single file into operations, the last item of an operation is the tuple of ids of
+# the rules it was built from
+# matching patterns are merged per element and identical operations applied once unless merge_rules is off
+def get_file_operations(rules, merge_rules = True):
+   matching_patterns = {}
+   element_names = []
+   other_operations = []
+   other_operation_rule_ids = []
+   operations = []
+   for action, rule_id, rule in rules:
+      if action == 'remove-element-matching':
+         operation = (action, rule['element-name'], rule['matching'])
+      elif action == 'replace-tag-value':
+         operation = (action, rule['element-name'], rule['value'], rule['replace-value'])
+      else:
+         operation = (action, rule['element-name'])
+
+      if not merge_rules:
+         operations.append(operation + ((rule_id,),))
+      elif action == 'remove-element-matching':
+         element_name = rule['element-name']
+         if element_name not in matching_patterns:
+            matching_patterns[element_name] = ([], [])
+            element_names.append(element_name)
+         patterns, rule_ids = matching_patterns[element_name]
+         if rule['matching'] not in patterns:
+            patterns.append(rule['matching'])
+         rule_ids.append(rule_id)
+      elif operation in other_operations:
+         other_operation_rule_ids[other_operations.index(operation)].append(rule_id)
+      else:
+         other_operations.append(operation)
+         other_operation_rule_ids.append([rule_id])
+
+   for element_name in element_names:
+      patterns, rule_ids = matching_patterns[element_name]
+      if len(patterns) == 1:
+         matching = patterns[0]
+      else:
+         matching = '|'.join('(?:' + pattern + ')' for pattern in patterns)
+      operations.append(('remove-element-matching', element_name, matching, tuple(rule_ids)))
+   for operation, rule_ids in zip(other_operations, other_operation_rule_ids):
+      operations.append(operation + (tuple(rule_ids),))
+   return operations
+
+def describe_operation(operation, file_path):
+   action = operation[0]
+   element = operation[1]
+   if action == 'remove-element-matching':
+      return "Element to be removed (if exists) " + color_string(element, Color.MAGENTA) + " matching " + color_string(operation[2], Color.MAGENTA) + " from " + color_string(file_path, Color.MAGENTA)
+   elif action == 'replace-tag-value':
+      return "Replacing tag " + color_string(element, Color.MAGENTA) + " value " + color_string(operation[2], Color.MAGENTA) + " by "  + color_string(operation[3], Color.MAGENTA) + ' in ' + color_string(file_path, Color.MAGENTA)
+   else:
+      return "Removing element " + color_string(element, Color.MAGENTA) + " from " + color_string(file_path, Color.MAGENTA)
+
+def apply_operation(root, operation):
+   action = operation[0]
+   element = operation[1]
+   if action == 'remove-element-matching':
+      return remove_element_matching(root, element, operation[2])
+   elif action == 'replace-tag-value':
+      return replace_tag_value(root, element, operation[2], operation[3])
+   else:
+      return remove_element(root, element)
+
+# operation_statistics - if given, [changes, seconds] of every operation are added up there
+def apply_operations(root, operations, operation_statistics = None):
+   changes = 0
+   for index, operation in enumerate(operations):
+      if operation_statistics is None:
+         changes += apply_operation(root, operation)
+      else:
+         start_time = time.time()
+         operation_changes = apply_operation(root, operation)
+         operation_statistics[index][0] += operation_changes
+         operation_statistics[index][1] += time.time() - start_time
+         changes += operation_changes
+   return changes
+
+# returns rule id -> [files, elements removed or replaced, seconds, bytes written] for a cleaned file
+# the bytes written are accounted to every rule that changed the file
+def get_rule_statistics(operations, operation_statistics, bytes_written):
+   if operation_statistics is None:
+      return None
+   rule_statistics = {}
+   for operation, (changes, seconds) in zip(operations, operation_statistics):
+      for rule_id in operation[-1]:
+         statistics = rule_statistics.setdefault(rule_id, [0, 0, 0.0, 0])
+         statistics[0] += 1
+         statistics[1] += changes
+         statistics[2] += seconds
+         if changes > 0:
+            statistics[3] += bytes_written
+   return rule_statistics
+
+# parses the file once, applies all its rules in memory and writes it back only if something changed
+# messages and errors are returned rather than printed so that parallel workers keep the report deterministic
+# with a cache salt the cache key of the clean content is returned as well and a file whose key equals
+# the cached one is skipped without parsing
+# files of streaming_threshold bytes or more are cleaned by clean_file_streaming instead
+# with a target file path the source file is left untouched, the cleaned file is written to the target
+# path or the source file is linked there if no rule changed it
+# with profile on, statistics of every rule are returned as well (see get_rule_statistics)
+def clean_file(file_path, operations, cache_salt = None, cached_key = None, streaming_threshold = None, target_file_path = None, profile = False):
+   log = []
+   error_message = None
+   cache_key = None
+   status = 'unchanged'
+   operation_statistics = [[0, 0.0] for operation in operations] if profile else None
+   bytes_written = 0
+   try:
+      if streaming_threshold is not None and os.path.getsize(file_path) >= streaming_threshold and is_streaming_supported(file_path):
+         return clean_file_streaming(file_path, operations, cache_salt, cached_key, target_file_path, profile)
+
+      with open(file_path, 'rb') as xml_file:
+         content = xml_file.read()
+
+      if cache_salt is not None:
+         cache_key = get_cache_key(cache_salt, content)
+         if cache_key == cached_key:
+            if target_file_path is not None:
+               copy_backend.copy_file(file_path, target_file_path, read_only = True)
+            return log, error_message, cache_key, 'cached', None
+
+      for operation in operations:
+         log.append(describe_operation(operation, file_path))
+      content = clean_content(content, operations, operation_statistics)
+      if content is not None:
+         write_file(target_file_path or file_path, content)
+         bytes_written = len(content)
+         status = 'cleaned'
+         if cache_salt is not None:
+            cache_key = get_cache_key(cache_salt, content)
+      elif target_file_path is not None:
+         copy_backend.copy_file(file_path, target_file_path, read_only = True)
+   except (ElementTree.ParseError, IOError, OSError, re.error) as e:
+      error_message = "Cleanup of file " + file_path + " failed: " + str(e)
+      cache_key = None
+   return log, error_message, cache_key, status, get_rule_statistics(operations, operation_statistics, bytes_written)
+
+# returns the cleaned content or None if no operation changed it
+def clean_content(content, operations, operation_statistics = None):
+   xml = ElementTree.parse(BytesIO(content))
+   if apply_operations(xml.getroot(), operations, operation_statistics) == 0:
+      return None
+   output = BytesIO()
+   xml.write(output, encoding="UTF-8", xml_declaration = True)
+   return output.getvalue()
+
+# same as clean_file but the file is parsed incrementally and every top-level element is cleaned, written
+# to a temporary file and released as soon as it's complete, so memory is bounded by the largest element
+def clean_file_streaming(file_path, operations, cache_salt = None, cached_key = None, target_file_path = None, profile = False):
+   log = []
+   error_message = None
+   cache_key = None
+   status = 'unchanged'
+   operation_statistics = [[0, 0.0] for operation in operations] if profile else None
+   bytes_written = 0
+   output_file_path = target_file_path or file_path
+   temp_file_path = output_file_path + '.tmp'
+   try:
+      if cache_salt is not None:
+         cache_key = get_file_cache_key(cache_salt, file_path)
+         if cache_key == cached_key:
+            if target_file_path is not None:
+               copy_backend.copy_file(file_path, target_file_path, read_only = True)
+            return log, error_message, cache_key, 'cached', None
+
+      for operation in operations:
+         log.append(describe_operation(operation, file_path))
+
+      hasher = hashlib.sha1(cache_salt.encode('utf-8')) if cache_salt is not None else None
+      with open(temp_file_path, 'wb') as temp_file:
+         def write(string):
+            data = string.encode('utf-8') if not isinstance(string, bytes) else string
+            temp_file.write(data)
+            if hasher is not None:
+               hasher.update(data)
+
+         changes = clean_stream(file_path, write, operations, operation_statistics)
+
+      if changes > 0:
+         os.rename(temp_file_path, output_file_path)
+         bytes_written = os.path.getsize(output_file_path)
+         status = 'cleaned'
+         if hasher is not None:
+            cache_key = hasher.hexdigest()
+      elif target_file_path is not None:
+         copy_backend.copy_file(file_path, target_file_path, read_only = True)
+   except (ElementTree.ParseError, IOError, OSError, re.error) as e:
+      error_message = "Cleanup of file " + file_path + " failed: " + str(e)
+      cache_key = None
+   finally:
+      if os.path.isfile(temp_file_path):
+         os.remove(temp_file_path)
+   return log, error_message, cache_key, status, get_rule_statistics(operations, operation_statistics, bytes_written)
+
+# the streaming cleanup writes the root element by its local name, so it's used for roots of the Salesforce
+# default namespace or of no namespace only, files with other roots are cleaned in memory
+# source - file path, or zip with the entry name
+def is_streaming_supported(source, entry_name = None):
+   namespaces = []
+   with closing(source.open(entry_name) if entry_name is not None else open(source, 'rb')) as source_file:
+      for event, element in ElementTree.iterparse(source_file, events=('start', 'start-ns')):
+         if event == 'start-ns':
+            namespaces.append(element)
+         else:
+            return not element.tag.startswith('{') or (element.tag.startswith('{' + DEFAULT_NAMESPACE + '}') and ('', DEFAULT_NAMESPACE) in namespaces)
+   return False
+
+# parses the source (file path or file object) incrementally and writes every top-level element as soon as
+# it's complete and cleaned, returns the number of changes
+def clean_stream(source, write, operations, operation_statistics = None):
+   changes = 0
+   namespaces = []
+   root = None
+   depth = 0
+   # text preceding the next written element, the previously completed top-level element and whether it's kept
+   pending_text = None
+   pending_element = None
+   pending_string = None
+   for event, element in ElementTree.iterparse(source, events=('start', 'end', 'start-ns')):
+      if event == 'start-ns':
+         if depth == 0:
+            namespaces.append(element)
+      elif event == 'start':
+         depth += 1
+         if depth == 1:
+            root = element
+            register_namespaces(namespaces)
+            write("<?xml version='1.0' encoding='UTF-8'?>\n" + get_start_tag(root, namespaces))
+         elif depth == 2:
+            if pending_element is None:
+               pending_text = root.text
+            else:
+               pending_text = flush_pending_element(write, pending_text, pending_element, pending_string)
+               root.remove(pending_element)
+               pending_element = None
+      elif event == 'end':
+         depth -= 1
+         if depth == 1:
+            # clean the completed top-level element on its own
+            holder = ElementTree.Element('holder')
+            holder.append(element)
+            changes += apply_operations(holder, operations, operation_statistics)
+            pending_element = element
+            pending_string = get_element_string(holder[0], namespaces) if len(holder) > 0 else None
+         elif depth == 0:
+            if pending_element is None:
+               pending_text = root.text
+            else:
+               pending_text = flush_pending_element(write, pending_text, pending_element, pending_string)
+               root.remove(pending_element)
+            write(escape_text(pending_text or '') + '</' + get_local_name(root.tag) + '>')
+   return changes
+
+# writes the previous top-level element (unless it was removed) and returns the text preceding the next one
+def flush_pending_element(write, pending_text, pending_element, pending_string):
+   if pending_string is None:
+      # removed element - its tail keeps the indentation of what follows
+      if pending_text is None or not pending_text.strip():
+         return pending_element.tail
+      return pending_text
+   write(escape_text(pending_text or '') + pending_string)
+   return pending_element.tail
+
+def get_local_name(tag):
+   if tag.startswith('{' + DEFAULT_NAMESPACE + '}'):
+      return tag[len(DEFAULT_NAMESPACE) + 2:]
+   return tag
+
+def get_start_tag(root, namespaces):
+   start_tag = '<' + get_local_name(root.tag)
+   for prefix, uri in namespaces:
+      start_tag += ' xmlns' + (':' + prefix if prefix else '') + '=' + quoteattr(uri)
+   for name in sorted(root.attrib):
+      start_tag += ' ' + name + '=' + quoteattr(root.attrib[name])
+   return start_tag + '>'
+
+# serializes a top-level element without its tail, elements of the default namespace are written without
+# the namespace and namespaces already declared on the root are not declared again
+def get_element_string(element, namespaces):
+   for descendant in element.iter():
+      descendant.tag = get_local_name(descendant.tag)
+   # the tail may be parsed already, it's written along with the following element
+   tail = element.tail
+   element.tail = None
+   string = ElementTree.tostring(element, encoding='utf-8')
+   element.tail = tail
+   start_tag_end = string.index(b'>')
+   start_tag = string[:start_tag_end]
+   for prefix, uri in namespaces:
+      if prefix:
+         start_tag = start_tag.replace((' xmlns:' + prefix + '=' + quoteattr(uri)).encode('utf-8'), b'')
+   return start_tag + string[start_tag_end:]
+
+def register_namespaces(namespaces):
+   for prefix, uri in namespaces:
+      if prefix:
+         try:
+            ElementTree.register_namespace(prefix, uri)
+         except ValueError:
+            pass
+
+def escape_text(text):
+   return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def write_xml(xml, file_path):
+   output = BytesIO()
+   xml.write(output, encoding="UTF-8", xml_declaration = True)
+   write_file(file_path, output.getvalue())
+
+# files are replaced rather than rewritten so that hard links to the source are never written through
+def write_file(file_path, content, temp_suffix = '.tmp'):
+   temp_file_path = file_path + temp_suffix
+   with open(temp_file_path, 'wb') as output_file:
+      output_file.write(content)
+   os.rename(temp_file_path, file_path)
+
+def clean_file_task(task):
+   return clean_file(*task)
+
+def get_config_hash(sf_cleanup_config):
+   return hashlib.sha1(json.dumps(sf_cleanup_config, sort_keys=True).encode('utf-8')).hexdigest()
+
+def get_file_hash(file_path):
+   hasher = hashlib.sha1()
+   with open(file_path, 'rb') as content_file:
+      for chunk in iter(lambda: content_file.read(HASH_CHUNK_SIZE), b''):
+         hasher.update(chunk)
+   return hasher.hexdigest()
+
+def get_cache_key(cache_salt, content):
+   return hashlib.sha1(cache_salt.encode('utf-8') + content).hexdigest()
+
+# same key as get_cache_key but the file is read in chunks
+def get_file_cache_key(cache_salt, file_path):
+   hasher = hashlib.sha1(cache_salt.encode('utf-8'))
+   with open(file_path, 'rb') as content_file:
+      for chunk in iter(lambda: content_file.read(HASH_CHUNK_SIZE), b''):
+         hasher.update(chunk)
+   return hasher.hexdigest()
+
+def get_cache_path(source_path):
+   return CACHE_FOLDER + '/' + hashlib.sha1(os.path.realpath(source_path).encode('utf-8')).hexdigest() + '.json'
+
+# the cache maps file paths (relative to the source folder) to the key of their clean content,
+# it's only valid for the cleanup configuration it was created with
+def load_cache(source_path, config_hash):
+   cache_path = get_cache_path(source_path)
+   if os.path.isfile(cache_path):
+      try:
+         cache = load_config(cache_path)
+         if cache.get('version') == CACHE_VERSION and cache.get('config') == config_hash:
+            return cache['files']
+         print_info("Cleanup cache " + color_string(cache_path, Color.MAGENTA) + " was created with a different configuration, ignoring it")
+      except (ValueError, KeyError, IOError):
+         print_error("Unable to read cleanup cache " + cache_path + ", ignoring it")
+   return {}
+
+# runs cleaning the same source folder may save its cache at the same time, so temporary files are per process
+def save_cache(source_path, config_hash, cached_files):
+   cache_path = get_cache_path(source_path)
+   temp_cache_path = cache_path + '.tmp.' + str(os.getpid())
+   try:
+      make_cache_folder(CACHE_FOLDER)
+      with open(temp_cache_path, 'w') as cache_file:
+         json.dump({'version': CACHE_VERSION, 'config': config_hash, 'source': os.path.realpath(source_path), 'files': cached_files}, cache_file, sort_keys=True)
+      os.rename(temp_cache_path, cache_path)
+      evict_cache_files(CACHE_FOLDER, CACHE_SIZE)
+   except (IOError, OSError):
+      print_error("Unable to write cleanup cache " + cache_path)
+
+   legacy_cache_path = source_path + '/' + LEGACY_CACHE_FILE
+   if os.path.isfile(legacy_cache_path):
+      try:
+         os.remove(legacy_cache_path)
+         print_info("Removed cleanup cache " + color_string(legacy_cache_path, Color.MAGENTA) + " of the previous version from the source folder")
+      except OSError:
+         print_error("Unable to remove cleanup cache " + legacy_cache_path)
+
+# cached_files - relative file path -> cache key from the previous run or None when caching is disabled
+# returns relative file path -> cache key of all files known to be clean now
+# with a target folder the cleaned tree is written there and the source is left untouched
+# rule_statistics - if given, statistics of every rule are collected there (see get_rule_statistics)
+def clean_files(cleanup_plan, jobs = 1, cached_files = None, streaming_threshold = None, target = None, rule_statistics = None):
+   path = cleanup_plan['path']
+   file_operations = cleanup_plan['file-operations']
+   config_hash = cleanup_plan['config-hash']
+
+   # sorted paths keep files of the same folder next to each other so chunks get sharded per folder
+   tasks = []
+   for file_path in sorted(file_operations):
+      operations = file_operations[file_path]
+      target_file_path = None
+      if target is not None:
+         target_file_path = target + '/' + os.path.relpath(file_path, path)
+      profile = rule_statistics is not None
+      if cached_files is None:
+         tasks.append((file_path, operations, None, None, streaming_threshold, target_file_path, profile))
+      else:
+         cache_salt = config_hash + json.dumps(operations)
+         tasks.append((file_path, operations, cache_salt, cached_files.get(os.path.relpath(file_path, path)), streaming_threshold, target_file_path, profile))
+
+   results = map_tasks(clean_file_task, tasks, jobs)
+
+   error_messages = []
+   clean_file_keys = {}
+   statistics = {'cached': 0, 'unchanged': 0, 'cleaned': 0}
+   for task, result in zip(tasks, results):
+      log, error_message, cache_key, status, file_rule_statistics = result
+      for message in log:
+         print_info(message)
+      if error_message is not None:
+         error_messages.append(error_message)
+         # like with in place cleanup, a file that failed ends up in the target as it is
+         if target is not None and os.path.isfile(task[0]):
+            copy_backend.copy_file(task[0], task[5], read_only = True)
+      else:
+         statistics[status] += 1
+      if cache_key is not None:
+         clean_file_keys[os.path.relpath(task[0], path)] = cache_key
+      # files that failed to clean are not accounted to any rule
+      if rule_statistics is not None and file_rule_statistics is not None and error_message is None:
+         add_rule_statistics(rule_statistics, file_rule_statistics)
+
+   if cached_files is not None:
+      print_info("Cleanup cache: " + color_string(str(statistics['cached']), Color.MAGENTA) + " files skipped, " + color_string(str(statistics['unchanged']), Color.MAGENTA) + " files already clean, " + color_string(str(statistics['cleaned']), Color.MAGENTA) + " files cleaned")
+
+   report_errors(error_messages)
+
+   return clean_file_keys
+
+# runs the tasks in a pool of worker processes, results are returned in the order of the tasks
+def map_tasks(function, tasks, jobs = 1):
+   if jobs > 1 and len(tasks) > 1:
+      print_info("Cleaning " + color_string(str(len(tasks)), Color.MAGENTA) + " files using " + color_string(str(jobs), Color.MAGENTA) + " workers")
+      pool = multiprocessing.Pool(min(jobs, len(tasks)))
+      try:
+         return pool.map(function, tasks, len(tasks) // (jobs * 4) + 1)
+      finally:
+         pool.close()
+         pool.join()
+   return [function(task) for task in tasks]
+
+def report_errors(error_messages):
+   if error_messages:
+      if(not IGNORE_ERRORS):
+         raise RuntimeError("\n".join(error_messages) + "\nIf you want to ignore errors during the processing you can run it with --ignore-errors parameter. Please, also use -d parameter for more details")
+      for error_message in error_messages:
+         print_error(error_message)
+
+# returns the folder of the zip the package.xml closest to the top is in ('.' for the top) and the folder list
+# and folder name -> file names of the folders in it
+def get_zip_folders(source_zip):
+   names = source_zip.namelist()
+   package_xml_names = sorted([name for name in names if posixpath.basename(name) == 'package.xml'], key=lambda name: name.count('/'))
+   path = (posixpath.dirname(package_xml_names[0]) if package_xml_names else '') or '.'
+   prefix = '' if path == '.' else path + '/'
+   folder_files = {}
+   for name in names:
+      if name.startswith(prefix):
+         parts = name[len(prefix):].split('/')
+         if len(parts) >= 2 and parts[0]:
+            files = folder_files.setdefault(parts[0], [])
+            if len(parts) == 2 and parts[1]:
+               files.append(parts[1])
+   for folder_name in folder_files:
+      folder_files[folder_name].sort()
+   return path, sorted(folder_files), folder_files
+
+# same as clean_file but the file is an entry of a zip, the cleaned entry is written to the temporary file path
+# entries of streaming_threshold bytes or more are decompressed and cleaned incrementally
+def clean_zip_entry(zip_file_path, entry_name, operations, streaming_threshold = None, temp_file_path = None, profile = False):
+   log = []
+   error_message = None
+   status = 'unchanged'
+   operation_statistics = [[0, 0.0] for operation in operations] if profile else None
+   bytes_written = 0
+   try:
+      for operation in operations:
+         log.append(describe_operation(operation, zip_file_path + ':' + entry_name))
+
+      with closing(zipfile.ZipFile(zip_file_path)) as source_zip:
+         if (streaming_threshold is not None and source_zip.getinfo(entry_name).file_size >= streaming_threshold and
+             is_streaming_supported(source_zip, entry_name)):
+            with closing(source_zip.open(entry_name)) as source_file:
+               with open(temp_file_path, 'wb') as temp_file:
+                  def write(string):
+                     temp_file.write(string.encode('utf-8') if not isinstance(string, bytes) else string)
+
+                  changes = clean_stream(source_file, write, operations, operation_statistics)
+            if changes > 0:
+               bytes_written = os.path.getsize(temp_file_path)
+            else:
+               os.remove(temp_file_path)
+         else:
+            content = clean_content(source_zip.read(entry_name), operations, operation_statistics)
+            if content is not None:
+               write_file(temp_file_path, content)
+               bytes_written = len(content)
+      if bytes_written > 0:
+         status = 'cleaned'
+   except (ElementTree.ParseError, IOError, OSError, re.error, zipfile.BadZipfile) as e:
+      error_message = "Cleanup of file " + zip_file_path + ":" + entry_name + " failed: " + str(e)
+      if os.path.isfile(temp_file_path):
+         os.remove(temp_file_path)
+   return log, error_message, status, get_rule_statistics(operations, operation_statistics, bytes_written)
+
+def clean_zip_entry_task(task):
+   return clean_zip_entry(*task)
+
+# cleans a zip (e.g. a retrieve of the Metadata API) into the target zip without extracting it,
+# entries no rule changes are copied compressed as they are, removed files and folders are left out
+# and package.xml is adjusted
+def clean_zip(cleanup_plan, zip_file_path, target_zip_file_path, namespace, jobs = 1, streaming_threshold = None, rule_statistics = None):
+   path = cleanup_plan['path']
+   file_operations = cleanup_plan['file-operations']
+   temp_folder_path = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(target_zip_file_path)))
+   temp_zip_file_path = target_zip_file_path + '.tmp'
+   try:
+      tasks = []
+      for index, file_path in enumerate(sorted(file_operations)):
+         tasks.append((zip_file_path, posixpath.normpath(file_path), file_operations[file_path], streaming_threshold, temp_folder_path + '/' + str(index), rule_statistics is not None))
+      results = map_tasks(clean_zip_entry_task, tasks, jobs)
+
+      error_messages = []
+      cleaned_entries = {}
+      for task, result in zip(tasks, results):
+         log, error_message, status, file_rule_statistics = result
+         for message in log:
+            print_info(message)
+         if error_message is not None:
+            error_messages.append(error_message)
+         elif status == 'cleaned':
+            cleaned_entries[task[1]] = task[4]
+         if rule_statistics is not None and file_rule_statistics is not None and error_message is None:
+            add_rule_statistics(rule_statistics, file_rule_statistics)
+      report_errors(error_messages)
+
+      removed_files = {}
+      removed_entries = set()
+      for folder_name, file_name, package_xml_type, rule_id in cleanup_plan['remove-file']:
+         removed_files.setdefault(folder_name, set()).add(file_name)
+         removed_entries.add(posixpath.normpath(path + '/' + folder_name + '/' + file_name))
+      removed_folders = tuple(posixpath.normpath(path + '/' + folder_name) + '/' for folder_name in get_emptied_folders(cleanup_plan, removed_files))
+      package_xml_entry = posixpath.normpath(path + '/package.xml')
+
+      with closing(zipfile.ZipFile(zip_file_path)) as source_zip:
+         with closing(zipfile.ZipFile(temp_zip_file_path, 'w', zipfile.ZIP_DEFLATED)) as target_zip:
+            for info in source_zip.infolist():
+               if info.filename in removed_entries or info.filename.startswith(removed_folders):
+                  print_info("Removing file " + color_string(zip_file_path + ':' + info.filename, Color.MAGENTA))
+               elif info.filename == package_xml_entry:
+                  package_xml = ElementTree.parse(BytesIO(source_zip.read(info)))
+                  adjust_package_xml(cleanup_plan, package_xml, namespace)
+                  output = BytesIO()
+                  package_xml.write(output, encoding="UTF-8", xml_declaration = True)
+                  target_zip.writestr(get_cleaned_zip_info(info), output.getvalue())
+               elif info.filename in cleaned_entries:
+                  write_zip_entry(target_zip, get_cleaned_zip_info(info), cleaned_entries[info.filename])
                else:
-                  file_list = get_file_list(path + "/" + folder_name)
+                  copy_zip_entry(source_zip, target_zip, info)
+      os.rename(temp_zip_file_path, target_zip_file_path)
+   finally:
+      shutil.rmtree(temp_folder_path)
+      if os.path.isfile(temp_zip_file_path):
+         os.remove(temp_zip_file_path)
+
+# same name, date and attributes as the source entry but compressed again
+def get_cleaned_zip_info(info):
+   cleaned_info = zipfile.ZipInfo(info.filename, info.date_time)
+   cleaned_info.external_attr = info.external_attr
+   cleaned_info.compress_type = zipfile.ZIP_DEFLATED
+   return cleaned_info
+
+# compresses the file into the zip in chunks, the date of the entry is taken from the file
+def write_zip_entry(target_zip, info, file_path):
+   timestamp = time.mktime(info.date_time + (0, 0, -1))
+   os.utime(file_path, (timestamp, timestamp))
+   target_zip.write(file_path, info.filename, info.compress_type)
+
+# copies the compressed data of the entry without decompressing it, the sizes and crc are always written
+# to the local header so a data descriptor of the source entry is left out
+def copy_zip_entry(source_zip, target_zip, info):
+   source_file = source_zip.fp
+   source_file.seek(info.header_offset)
+   header = ZIP_LOCAL_HEADER.unpack(source_file.read(ZIP_LOCAL_HEADER.size))
+   source_file.seek(info.header_offset + ZIP_LOCAL_HEADER.size + header[-2] + header[-1])
+
+   target_info = copy.copy(info)
+   target_info.flag_bits &= ~ZIP_DATA_DESCRIPTOR_FLAG
+   target_info.header_offset = target_zip.fp.tell()
+   target_zip.fp.write(target_info.FileHeader())
+   remaining = info.compress_size
+   while remaining > 0:
+      chunk = source_file.read(min(remaining, HASH_CHUNK_SIZE))
+      if not chunk:
+         raise zipfile.BadZipfile("Truncated zip entry " + info.filename)
+      target_zip.fp.write(chunk)
+      remaining -= len(chunk)
+   target_zip.filelist.append(target_info)
+   target_zip.NameToInfo[target_info.filename] = target_info
+
+# adds up rule statistics of a single file
+def add_rule_statistics(rule_statistics, file_rule_statistics):
+   for rule_id, file_statistics in file_rule_statistics.items():
+      statistics = rule_statistics.setdefault(rule_id, [0, 0, 0.0, 0])
+      for index, value in enumerate(file_statistics):
+         statistics[index] += value
+
+# remove-file rules count every file they match as one hit
+def add_remove_file_statistics(cleanup_plan, rule_statistics):
+   for folder_name, file_name, package_xml_type, rule_id in cleanup_plan['remove-file']:
+      statistics = rule_statistics.setdefault(rule_id, [0, 0, 0.0, 0])
+      statistics[0] += 1
+      statistics[1] += 1
 
-               for file_name in file_list:
-                  if 'package_xml_type' in rule:
-                     # TODO: optimize - pass dictionary with names and members
-                     remove_from_package_xml(package_xml, rule['package_xml_type'], get_filename_without_extension(file_name), namespace)
+# one entry per configured rule in the configuration order, rules identical to an earlier one are reported as its duplicates
+def get_profile_report(cleanup_plan, rule_statistics):
+   report = []
+   for rule_id, action, folder_name, rule in cleanup_plan['rules']:
+      files, hits, seconds, bytes_written = rule_statistics.get(rule_id, [0, 0, 0.0, 0])
+      report.append({'id': rule_id, 'action': action, 'folder': folder_name, 'rule': rule, 'files': files, 'hits': hits,
+                     'seconds': round(seconds, 6), 'bytes-written': bytes_written, 'duplicate-of': cleanup_plan['duplicate-rules'].get(rule_id)})
+   return report
 
-def remove_from_package_xml(package_xml, name, member, namespace):
+# profile_path - '-' prints the report, otherwise it's written there as json
+def write_profile_report(report, profile_path):
+   if profile_path == '-':
+      print(color_string("Rule profile (files, hits, seconds, bytes written):", Color.MAGENTA))
+      for entry in sorted(report, key=lambda entry: -entry['seconds']):
+         line = "%-60s %8d %8d %10.4f %12d" % (entry['id'], entry['files'], entry['hits'], entry['seconds'], entry['bytes-written'])
+         if entry['duplicate-of'] is not None:
+            line += " duplicate of " + entry['duplicate-of']
+         elif entry['hits'] == 0:
+            line += " " + color_string("dead rule", Color.RED)
+         print(line)
+   else:
+      with open(profile_path, 'w') as profile_file:
+         json.dump(report, profile_file, indent=3, sort_keys=True)
+      print_info("Rule profile written to " + color_string(profile_path, Color.MAGENTA))
+
+def remove_files(cleanup_plan, path):
+   removed_files = {}
+   for folder_name, file_name, package_xml_type, rule_id in cleanup_plan['remove-file']:
+      file_path = path + "/" + folder_name + "/" + file_name
+      print_info("Removing file " + color_string(file_path, Color.MAGENTA))
+      try:
+         os.remove(file_path)
+         removed_files.setdefault(folder_name, set()).add(file_name)
+      except Exception as e:
+         error_message = "Unable to remove file " + file_path
+         if(not IGNORE_ERRORS):
+            raise RuntimeError(error_message)
+         else:
+            print_error(error_message)
+
+   # if there is not file left in the folder then delete the folder as well
+   for folder_name in get_emptied_folders(cleanup_plan, removed_files):
+      print_info("Folder is empty - removing folder: " + color_string(path + "/" + folder_name, Color.MAGENTA))
+      shutil.rmtree(path + "/" + folder_name)
+
+# removed_files - folder name -> set of names of the files removed from it
+def get_emptied_folders(cleanup_plan, removed_files):
+   emptied_folders = []
+   for folder_name in cleanup_plan['remove-file-folders']:
+      if len(set(cleanup_plan['folder-files'][folder_name]) - removed_files.get(folder_name, set())) == 0:
+         emptied_folders.append(folder_name)
+   return emptied_folders
+
+# creates the target tree, skipping folders the cleanup would remove
+def create_target_folders(cleanup_plan, target):
+   path = cleanup_plan['path']
+   excluded_folders = get_target_excluded_folders(cleanup_plan)
+   for folder_path, folder_names, file_names in os.walk(path):
+      relative_folder_path = os.path.relpath(folder_path, path)
+      folder_names[:] = [folder_name for folder_name in folder_names if relative_folder_path != '.' or folder_name not in excluded_folders]
+      target_folder_path = os.path.normpath(target + '/' + relative_folder_path)
+      if not os.path.isdir(target_folder_path):
+         os.makedirs(target_folder_path)
+
+# links every file no cleanup rule applies to into the target tree
+# package.xml and the cleanup cache of the previous versions are left out, removed files and folders are skipped
+def link_untouched_files(cleanup_plan, target):
+   path = cleanup_plan['path']
+   excluded_folders = get_target_excluded_folders(cleanup_plan)
+   excluded_files = set(path + '/' + folder_name + '/' + file_name for folder_name, file_name, package_xml_type, rule_id in cleanup_plan['remove-file'])
+   excluded_files.update(cleanup_plan['file-operations'])
+   excluded_files.update([path + '/package.xml', path + '/' + LEGACY_CACHE_FILE])
+
+   statistics = dict((method, 0) for method in copy_backend.COPY_METHODS)
+   for folder_path, folder_names, file_names in os.walk(path):
+      relative_folder_path = os.path.relpath(folder_path, path)
+      folder_names[:] = [folder_name for folder_name in folder_names if relative_folder_path != '.' or folder_name not in excluded_folders]
+      for file_name in file_names:
+         if relative_folder_path == '.':
+            file_path = path + '/' + file_name
+         else:
+            file_path = path + '/' + relative_folder_path + '/' + file_name
+         if file_path not in excluded_files:
+            statistics[copy_backend.copy_file(file_path, target + '/' + os.path.relpath(file_path, path), read_only = True)] += 1
+
+   print_info("Files linked to the target: " + color_string(str(statistics['reflink']), Color.MAGENTA) + " reflinked, " + color_string(str(statistics['copy_file_range']), Color.MAGENTA) + " copied by copy_file_range, " + color_string(str(statistics['hardlink']), Color.MAGENTA) + " hard linked, " + color_string(str(statistics['copy']), Color.MAGENTA) + " copied")
+
+def get_target_excluded_folders(cleanup_plan):
+   removed_files = {}
+   for folder_name, file_name, package_xml_type, rule_id in cleanup_plan['remove-file']:
+      removed_files.setdefault(folder_name, set()).add(file_name)
+   return set(get_emptied_folders(cleanup_plan, removed_files))
+
+def adjust_package_xml(cleanup_plan, package_xml, namespace):
+   removed_members = {}
+   for folder_name, file_name, package_xml_type, rule_id in cleanup_plan['remove-file']:
+      if package_xml_type is not None:
+         removed_members.setdefault(package_xml_type, set()).add(get_filename_without_extension(file_name))
+
+   if removed_members:
+      remove_from_package_xml(package_xml, removed_members, namespace)
+
+# removed_members - package.xml type name -> set of members to be removed
+def remove_from_package_xml(package_xml, removed_members, namespace):
    root = package_xml.getroot()
+   name_tag = '{' + namespace  + '}' + 'name'
+   members_tag = '{' + namespace  + '}' + 'members'
+
+   # index the types once
+   types_index = {}
    for child in root:
-      element_name = child.find('{' + namespace  + '}' + 'name') 
-      if element_name is not None and get_element_local_name(element_name) == 'name' and element_name.text == name:
-         element_members = child.findall('{' + namespace  + '}' + 'members')
-         for element_member in element_members:
-            if element_member.text == member:
+      element_name = child.find(name_tag)
+      if element_name is not None and element_name.text in removed_members:
+         types_index.setdefault(element_name.text, []).append(child)
+
+   emptied_types = set()
+   for name in types_index:
+      for child in types_index[name]:
+         members = set(element_member.text for element_member in child.findall(members_tag))
+         members_to_remove = members & removed_members[name]
+         if members_to_remove:
+            for member in sorted(members_to_remove):
                print_info("Removing element from package.xml " + color_string(name + "." + member, Color.MAGENTA))
-               child.remove(element_member)
-               # check whether it's empty if yes, delete the parent as well
-               temp_element_members = child.findall('{' + namespace  + '}' + 'members')
-               if len(temp_element_members) == 0:
-                  print_info("Parent element " + color_string(element_name.text, Color.MAGENTA) + " is empty, removing this as well.")
-                  root.remove(child)
+            remove_children(child, lambda element: element.tag == members_tag and element.text in members_to_remove)
+            # check whether it's empty if yes, delete the parent as well
+            if not members - members_to_remove:
+               print_info("Parent element " + color_string(name, Color.MAGENTA) + " is empty, removing this as well.")
+               emptied_types.add(child)
+
+   if emptied_types:
+      remove_children(root, lambda child: child in emptied_types)
 
 def get_element_local_name(element):
    match = re.search('\{.*\}(.*)', element.tag)
@@ -284,7 +1163,7 @@ def main():
 
    parser.add_argument(
         "-s", "--source", dest="source",
-        help="Source folder", required=True)
+        help="Source folder or zip (e.g. retrieved by the Metadata API), a zip is cleaned without being extracted", required=True)
 
    parser.add_argument(
         "-c", "--cleanup-config", dest="cleanup_config",
@@ -292,7 +1171,28 @@ def main():
 
    parser.add_argument(
         "-t", "--target", dest="target",
-        help="Destination folder", required=False)
+        help="Destination folder for the cleaned tree, the source folder is left untouched (destination zip for a zip source).\n" +
+             "Files no rule changes are reflinked or hard linked from the source (copied only if neither is possible, see\n" +
+             "copy_backend.py and DEVOPS_TOOLKIT_COPY_BACKEND),\n" +
+             "so tools editing the target must replace files rather than rewrite them in place", required=False)
+
+   parser.add_argument(
+        "-j", "--jobs", dest="jobs", type=int, default=multiprocessing.cpu_count(),
+        help="Number of parallel cleanup workers (default: number of cores)")
+
+   parser.add_argument(
+        "--no-cache", dest="no_cache",
+        help="Cleans all files, ignoring and not updating the cleanup cache (kept in " + CACHE_FOLDER + " by the source folder)\n" +
+             "and compiles the cleanup configuration again rather than loading its rules from " + RULES_CACHE_FOLDER, action="store_true")
+
+   parser.add_argument(
+        "--streaming-threshold", dest="streaming_threshold", type=float, default=DEFAULT_STREAMING_THRESHOLD,
+        help="Files of this size in MB and above are parsed and written incrementally (default: " + str(DEFAULT_STREAMING_THRESHOLD) + ", 0 streams all files)")
+
+   parser.add_argument(
+        "--profile", dest="profile", nargs='?', const='-',
+        help="Collects files, hits, time and bytes written per configured rule and prints them (or writes them as json to the given path).\n" +
+             "Rules are applied one by one without merging and the cleanup cache is not used")
 
    parser.add_argument(
         "--debug-level", dest="debug_level",type=int,
@@ -300,6 +1200,9 @@ def main():
 
    args = parser.parse_args()
 
+   if(args.jobs < 1):
+      parser.error("--jobs must be at least 1")
+
    # arguments assignment to global variables
    this.DEBUG = args.debug
    this.IGNORE_ERRORS = args.ignore_errors
@@ -313,6 +1216,24 @@ def main():
 
    # default namespace
    ElementTree.register_namespace('', DEFAULT_NAMESPACE)
+   rule_statistics = {} if args.profile is not None else None
+
+   # zip source - cleaned into the target zip (or replaced) entry by entry
+   if os.path.isfile(args.source) and zipfile.is_zipfile(args.source):
+      if args.target and os.path.isdir(args.target):
+         parser.error("--target must be a zip file path for a zip source")
+      cleanup_rules = get_cleanup_rules(sf_cleanup_config_path, not args.no_cache)
+      with closing(zipfile.ZipFile(args.source)) as source_zip:
+         zip_path, folder_list, folder_files = get_zip_folders(source_zip)
+         if posixpath.normpath(zip_path + '/package.xml') not in source_zip.namelist():
+            print_error(args.source + ":package.xml not found!")
+      cleanup_plan = compile_cleanup_plan(cleanup_rules, zip_path, folder_list, args.profile is None, folder_files)
+      clean_zip(cleanup_plan, args.source, args.target or args.source, DEFAULT_NAMESPACE, args.jobs, int(args.streaming_threshold * 1024 * 1024), rule_statistics)
+      if rule_statistics is not None:
+         add_remove_file_statistics(cleanup_plan, rule_statistics)
+         write_profile_report(get_profile_report(cleanup_plan, rule_statistics), args.profile)
+      return
+
    package_xml_path = args.source + "/package.xml"
 
    package_xml = None   
@@ -321,28 +1242,52 @@ def main():
    else:
       print_error(package_xml_path + " not found!")
 
-   # load sf cleanup  configuration
-   sf_cleanup_config = load_config(sf_cleanup_config_path)
+   # compile the cleanup configuration once (or load the rules compiled by a previous run)
+   cleanup_rules = get_cleanup_rules(sf_cleanup_config_path, not args.no_cache)
    
    # get list of folders first
    folder_list = get_folder_list(args.source)
 
-   # remove-element-matching
-   remove_element_matching(sf_cleanup_config, args.source, folder_list)
+   # match the rules against the source folders, every folder is listed once
+   # rules are not merged when profiling so every rule is measured on its own
+   cleanup_plan = compile_cleanup_plan(cleanup_rules, args.source, folder_list, args.profile is None)
+
+   # cleaned tree written to the target folder, the source is left untouched
+   target = None
+   if args.target and os.path.abspath(args.target) != os.path.abspath(args.source):
+      target = args.target
+      create_target_folders(cleanup_plan, target)
 
-   # replace-tag-value
-   replace_tag_value(sf_cleanup_config, args.source, folder_list)
+   # files unchanged since the last cleanup with the same configuration are skipped
+   # the cache describes files cleaned in place so it's not used with a target folder
+   use_cache = not args.no_cache and target is None and args.profile is None
+   cached_files = None
+   if use_cache:
+      cached_files = load_cache(args.source, cleanup_plan['config-hash'])
 
-   # remove-element 
-   remove_element(sf_cleanup_config, args.source, folder_list)
+   # remove-element-matching, replace-tag-value and remove-element in a single pass per file
+   clean_file_keys = clean_files(cleanup_plan, args.jobs, cached_files, int(args.streaming_threshold * 1024 * 1024), target, rule_statistics)
+
+   if use_cache:
+      save_cache(args.source, cleanup_plan['config-hash'], clean_file_keys)
 
    if package_xml:   
-      adjust_package_xml(sf_cleanup_config, args.source, folder_list, package_xml, DEFAULT_NAMESPACE)
+      adjust_package_xml(cleanup_plan, package_xml, DEFAULT_NAMESPACE)
       # write out the adjusted package.xml
-      package_xml.write(package_xml_path, encoding="UTF-8", xml_declaration = True)
+      if target is not None:
+         package_xml_path = target + "/package.xml"
+      write_xml(package_xml, package_xml_path)
+
+   if target is not None:
+      # files not cleaned are linked, files and folders to be removed are left out
+      link_untouched_files(cleanup_plan, target)
+   else:
+      # remove files and folder (if folder is empty)
+      remove_files(cleanup_plan, args.source)
 
-   # remove files and folder (if folder is empty)
-   remove_files(sf_cleanup_config, args.source, folder_list)
+   if rule_statistics is not None:
+      add_remove_file_statistics(cleanup_plan, rule_statistics)
+      write_profile_report(get_profile_report(cleanup_plan, rule_statistics), args.profile)
 
 if __name__ == "__main__":
    main()
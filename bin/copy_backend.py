@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+# Copy backend shared by the synchronization, the cleanup and the package assembly scripts - files are cloned
+# (reflink) or copied within the kernel (copy_file_range) where the file system supports it, hard linked if the
+# copy is only read and byte copied otherwise
+# The backend is selected by the DEVOPS_TOOLKIT_COPY_BACKEND environment variable:
+#   auto     - reflink, copy_file_range, hard link (read-only copies), byte copy (default)
+#   reflink  - reflink, copy_file_range, byte copy
+#   hardlink - hard link (read-only copies), byte copy
+#   copy     - byte copy only
+
+import os
+import errno
+import shutil
+
+COPY_BACKEND_VARIABLE = 'DEVOPS_TOOLKIT_COPY_BACKEND'
+COPY_METHODS = ['reflink', 'copy_file_range', 'hardlink', 'copy']
+COPY_BACKENDS = {
+   'auto': ['reflink', 'copy_file_range', 'hardlink', 'copy'],
+   'reflink': ['reflink', 'copy_file_range', 'copy'],
+   'hardlink': ['hardlink', 'copy'],
+   'copy': ['copy']
+}
+# ioctl cloning a file on btrfs, xfs and others (linux/fs.h)
+FICLONE = 0x40049409
+
+# errors telling the method isn't supported for the files (another file system, no support for it), the next
+# method is tried then
+UNSUPPORTED_ERRORS = set([errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EPERM, errno.EMLINK])
+# of these the method isn't supported for any file of the file systems, it's not tried for them again
+FILE_SYSTEM_ERRORS = set([errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY])
+# (method, device of the source file, device of the destination folder) of the methods not supported
+UNSUPPORTED_METHODS = set()
+
+def get_copy_backend():
+   backend = os.environ.get(COPY_BACKEND_VARIABLE, 'auto')
+   if backend not in COPY_BACKENDS:
+      raise ValueError('Unknown copy backend ' + backend + ' in ' + COPY_BACKEND_VARIABLE + ', expected one of ' + ', '.join(sorted(COPY_BACKENDS)))
+   return backend
+
+# copies the source file to the destination file (replaced if it exists)
+# read_only - the copy is never changed in place, so it can be a hard link to the source file
+# preserve - mode and modification time are copied as well (like shutil.copy2), hard links share them anyway
+# returns the method used
+def copy_file(source_file_path, destination_file_path, read_only = False, preserve = True):
+   # a hard linked or symbolic linked destination is replaced rather than written to, the file it's linked to
+   # stays as it is
+   if os.path.islink(destination_file_path) or (os.path.isfile(destination_file_path) and os.stat(destination_file_path).st_nlink > 1):
+      os.remove(destination_file_path)
+   devices = (os.stat(source_file_path).st_dev, os.stat(os.path.dirname(os.path.abspath(destination_file_path))).st_dev)
+   for method in COPY_BACKENDS[get_copy_backend()]:
+      if (method == 'hardlink' and not read_only) or (method, devices) in UNSUPPORTED_METHODS:
+         continue
+      try:
+         if method == 'reflink':
+            clone_file(source_file_path, destination_file_path)
+         elif method == 'copy_file_range':
+            copy_file_range(source_file_path, destination_file_path)
+         elif method == 'hardlink':
+            link_file(source_file_path, destination_file_path)
+            return method
+         else:
+            shutil.copyfile(source_file_path, destination_file_path)
+      except (IOError, OSError) as e:
+         if method != 'copy' and e.errno in UNSUPPORTED_ERRORS:
+            if e.errno in FILE_SYSTEM_ERRORS:
+               UNSUPPORTED_METHODS.add((method, devices))
+            continue
+         raise
+      if preserve:
+         shutil.copystat(source_file_path, destination_file_path)
+      return method
+
+# copies all files of the source folder and its subfolders to the destination folder (like distutils copy_tree)
+# returns the destination files, raises OSError if the source folder doesn't exist (os.walk would copy nothing)
+def copy_tree(source_folder_path, destination_folder_path, read_only = False, preserve = True):
+   if not os.path.isdir(source_folder_path):
+      raise OSError(errno.ENOENT, "cannot copy tree '" + source_folder_path + "': not a directory")
+   destination_files = []
+   for root, folders, files in os.walk(source_folder_path):
+      destination_root = destination_folder_path + root[len(source_folder_path):]
+      if not os.path.isdir(destination_root):
+         os.makedirs(destination_root)
+      for file_name in files:
+         copy_file(root + '/' + file_name, destination_root + '/' + file_name, read_only, preserve)
+         destination_files.append(destination_root + '/' + file_name)
+   return destination_files
+
+def clone_file(source_file_path, destination_file_path):
+   import fcntl
+   with open(source_file_path, 'rb') as source_file:
+      with open(destination_file_path, 'wb') as destination_file:
+         fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+
+# os.copy_file_range is available in python 3.8 and above only
+def copy_file_range(source_file_path, destination_file_path):
+   if not hasattr(os, 'copy_file_range'):
+      raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+   with open(source_file_path, 'rb') as source_file:
+      with open(destination_file_path, 'wb') as destination_file:
+         while os.copy_file_range(source_file.fileno(), destination_file.fileno(), 64 * 1024 * 1024):
+            pass
+
+# the link replaces the destination file at once
+def link_file(source_file_path, destination_file_path):
+   temp_file_path = destination_file_path + '.link.' + str(os.getpid())
+   os.link(source_file_path, temp_file_path)
+   try:
+      os.rename(temp_file_path, destination_file_path)
+   except OSError:
+      os.remove(temp_file_path)
+      raise
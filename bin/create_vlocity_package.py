@@ -11,7 +11,7 @@ from argparse import RawTextHelpFormatter
 import json
 import subprocess
 import re
-from distutils.dir_util import copy_tree
+import copy_backend
 
 # script context variables
 SCRIPT_FOLDER_PATH = os.path.dirname(os.path.realpath(__file__))
@@ -162,9 +162,9 @@ def main():
       destination_folder_path = output_folder + '/' + folder
       print_info('Copying folder ' + color_string(folder, Color.MAGENTA) + ' to ' + color_string(destination_folder_path, Color.MAGENTA))
       try:
-         copy_tree(folder, destination_folder_path)
+         copy_backend.copy_tree(folder, destination_folder_path)
       except Exception as e:
-         error_message = "Unable copy folder " + folder  + ". If you want to ignore errors during the processing you can run it with --ignore-errors parameter. Please, also use -d parameter for more details: " + e.message
+         error_message = "Unable copy folder " + folder  + ". If you want to ignore errors during the processing you can run it with --ignore-errors parameter. Please, also use -d parameter for more details: " + str(e)
          if(not IGNORE_ERRORS):
             raise RuntimeError(error_message)
          else:
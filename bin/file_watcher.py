@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+# Change feed of the files of a folder and its subfolders for the long-running scripts - inotify events where
+# inotify is available (Linux), polling of the size and modification time of the files otherwise
+# Changes are debounced - a batch of changed files is returned once no other change came for a while, so a
+# retrieve or a checkout writing many files is handled at once
+
+import os
+import sys
+import errno
+import select
+import struct
+import time
+
+# inotify events (linux/inotify.h)
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+# files written, created, moved in or touched, deleted files are of no interest as the synchronization doesn't
+# delete them from the target folder
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+EVENT_HEADER = 'iIII'
+EVENT_HEADER_SIZE = struct.calcsize(EVENT_HEADER)
+
+# a batch is returned after this many debounce periods even if the files keep changing
+MAX_DEBOUNCE_PERIODS = 10
+
+LIBC = None
+
+# watcher - {'type': 'inotify' or 'poll', 'path': watched folder, 'poll_interval': seconds, 'fd': inotify file
+# descriptor, 'folders': watch descriptor -> folder, 'files': file -> (size, modification time) of the last scan}
+# polling is used if inotify isn't available or the folder can't be watched by it (e.g. too many folders for
+# fs.inotify.max_user_watches) or if force_polling is set
+def create_watcher(folder_path, poll_interval = 1.0, force_polling = False):
+   watcher = {'type': 'poll', 'path': folder_path, 'poll_interval': poll_interval, 'fd': None, 'folders': {}, 'files': {}}
+   if not force_polling:
+      try:
+         watcher['fd'] = init_inotify()
+         watcher['type'] = 'inotify'
+         add_folder_watches(watcher, folder_path)
+      except (OSError, AttributeError) as e:
+         print('Unable to watch ' + folder_path + ' by inotify (' + str(e) + '), polling it every ' + str(poll_interval) + ' s')
+         switch_to_polling(watcher)
+         return watcher
+   if watcher['type'] == 'poll':
+      watcher['files'] = scan_files(folder_path)
+   return watcher
+
+def close_watcher(watcher):
+   if watcher['fd'] is not None:
+      os.close(watcher['fd'])
+      watcher['fd'] = None
+
+# waits for changes of the files and returns the changed files once no other change came for the debounce period
+# (seconds), returns None if the changes are not known (events were lost), everything should be synchronized then
+def wait_for_changes(watcher, debounce = 0.2):
+   changed_files = set()
+   first_change_time = None
+   while True:
+      changes = read_changes(watcher, debounce if changed_files else None)
+      if changes is None:
+         return None
+      if not changes and changed_files:
+         return changed_files
+      if changes and first_change_time is None:
+         first_change_time = time.time()
+      changed_files |= changes
+      if changed_files and time.time() - first_change_time >= debounce * MAX_DEBOUNCE_PERIODS:
+         return changed_files
+
+# changed files, empty if there is none within the timeout (seconds, None waits for a change), None if the
+# changes are not known
+def read_changes(watcher, timeout):
+   if watcher['type'] == 'poll':
+      return poll_changes(watcher, timeout)
+   ready = select.select([watcher['fd']], [], [], timeout)[0]
+   if not ready:
+      return set()
+   try:
+      data = os.read(watcher['fd'], 64 * 1024)
+   except OSError as e:
+      if e.errno == errno.EINTR:
+         return set()
+      raise
+
+   changes = set()
+   offset = 0
+   while offset < len(data):
+      watch_descriptor, mask, cookie, name_length = struct.unpack_from(EVENT_HEADER, data, offset)
+      name = decode_name(data[offset + EVENT_HEADER_SIZE:offset + EVENT_HEADER_SIZE + name_length].rstrip(b'\0'))
+      offset += EVENT_HEADER_SIZE + name_length
+      if mask & IN_Q_OVERFLOW:
+         return None
+      if mask & IN_IGNORED:
+         watcher['folders'].pop(watch_descriptor, None)
+         continue
+      if watch_descriptor not in watcher['folders'] or not name:
+         continue
+      path = os.path.join(watcher['folders'][watch_descriptor], name)
+      if mask & IN_ISDIR:
+         if mask & (IN_CREATE | IN_MOVED_TO):
+            # files can be written to the new folder before it's watched, they are all taken as changed
+            try:
+               add_folder_watches(watcher, path)
+            except OSError as e:
+               print('Unable to watch ' + path + ' by inotify (' + str(e) + '), polling ' + watcher['path'] + ' every ' + str(watcher['poll_interval']) + ' s')
+               switch_to_polling(watcher)
+               return None
+            changes.update(scan_files(path))
+      else:
+         changes.add(path)
+   return changes
+
+def poll_changes(watcher, timeout):
+   while True:
+      time.sleep(watcher['poll_interval'] if timeout is None else timeout)
+      files = scan_files(watcher['path'])
+      changes = set(path for path, file_stat in files.items() if watcher['files'].get(path) != file_stat)
+      watcher['files'] = files
+      if changes or timeout is not None:
+         return changes
+
+# file -> (size, modification time) of the files of the folder and its subfolders
+def scan_files(folder_path):
+   files = {}
+   for root, folders, file_names in os.walk(folder_path):
+      for file_name in file_names:
+         path = os.path.join(root, file_name)
+         try:
+            file_stat = os.stat(path)
+         except OSError:
+            continue
+         files[path] = (file_stat.st_size, file_stat.st_mtime)
+   return files
+
+def switch_to_polling(watcher):
+   close_watcher(watcher)
+   watcher['type'] = 'poll'
+   watcher['folders'] = {}
+   watcher['files'] = scan_files(watcher['path'])
+
+def add_folder_watches(watcher, folder_path):
+   for root, folders, files in os.walk(folder_path):
+      watch_descriptor = add_watch(watcher['fd'], root)
+      watcher['folders'][watch_descriptor] = root
+
+# inotify functions of the c library, python has no bindings of its own
+def get_libc():
+   import ctypes
+   import ctypes.util
+   global LIBC
+   if LIBC is None:
+      LIBC = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+   return LIBC
+
+def init_inotify():
+   import ctypes
+   fd = get_libc().inotify_init1(IN_CLOEXEC)
+   if fd < 0:
+      error_number = ctypes.get_errno()
+      raise OSError(error_number, os.strerror(error_number))
+   return fd
+
+def add_watch(fd, folder_path):
+   import ctypes
+   if not isinstance(folder_path, bytes):
+      folder_path = folder_path.encode(sys.getfilesystemencoding())
+   watch_descriptor = get_libc().inotify_add_watch(fd, ctypes.c_char_p(folder_path), WATCH_MASK)
+   if watch_descriptor < 0:
+      error_number = ctypes.get_errno()
+      raise OSError(error_number, os.strerror(error_number) + ': ' + folder_path.decode(sys.getfilesystemencoding()))
+   return watch_descriptor
+
+def decode_name(name):
+   if isinstance(name, str):
+      return name
+   return name.decode(sys.getfilesystemencoding(), 'surrogateescape')
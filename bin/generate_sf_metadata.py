@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+# Generates synthetic Salesforce metadata trees for the benchmarks - profiles, custom objects, apex classes
+# and package.xml in the form they are retrieved in
+# The same arguments always generate the same files, variants are the same tree changed the way a later
+# retrieve changes it (values changed, elements removed and added)
+
+import sys
+import os
+import argparse
+from argparse import RawTextHelpFormatter
+import random
+import hashlib
+
+API_VERSION = '43.0'
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+NAMESPACE = 'http://soap.sforce.com/2006/04/metadata'
+INDENTATION = '    '
+
+# share of elements a variant changes, removes and adds
+CHANGED_ELEMENTS = 0.1
+REMOVED_ELEMENTS = 0.05
+ADDED_ELEMENTS = 0.05
+
+# user permissions of retrieved profiles, some of them are removed by the cleanup configuration
+USER_PERMISSIONS = ['ApiEnabled', 'AssignUserToSkill', 'ManageSandboxes', 'ModifyMetadata', 'SendExternalEmailAvailable',
+                    'SubscribeDashboardToOtherUsers', 'ViewCaseInteraction', 'ViewSetup', 'RunReports', 'ExportReport']
+
+# children - (child element name, value) pairs
+def format_element(name, children, level = 1):
+   lines = [INDENTATION * level + '<' + name + '>']
+   for child_name, value in children:
+      lines.append(INDENTATION * (level + 1) + '<' + child_name + '>' + value + '</' + child_name + '>')
+   lines.append(INDENTATION * level + '</' + name + '>')
+   return '\n'.join(lines)
+
+def format_document(root_name, elements):
+   return XML_DECLARATION + '<' + root_name + ' xmlns="' + NAMESPACE + '">\n' + ''.join(element + '\n' for element in elements) + '</' + root_name + '>\n'
+
+def flag(randomizer):
+   return 'true' if randomizer.random() < 0.5 else 'false'
+
+# random integer from 0 to count - 1, the same in python 2 and 3 unlike randint and choice
+def pick(randomizer, count):
+   return int(randomizer.random() * count)
+
+# seeds and hashes are derived from the names so they are the same in python 2 and 3 and across runs
+def hash_name(name):
+   return int(hashlib.md5(name.encode('utf-8')).hexdigest()[:12], 16)
+
+# names of the generated elements of a kind, a variant removes some of them and adds new ones
+def get_names(randomizer, prefix, count, variant):
+   names = [prefix + str(index) for index in range(count)]
+   if variant:
+      names = [name for name in names if randomizer.random() >= REMOVED_ELEMENTS]
+      names += [prefix + 'Added' + str(variant) + '_' + str(index) for index in range(int(count * ADDED_ELEMENTS))]
+   return names
+
+# a variant changes some of the elements only, the rest is as in the base tree
+def is_changed(variant, name):
+   return variant and random.Random(hash_name(str(variant) + ':' + name)).random() < CHANGED_ELEMENTS
+
+def get_randomizer(seed, variant, name):
+   if is_changed(variant, name):
+      return random.Random(hash_name(str(variant) + ':' + seed + ':' + name))
+   return random.Random(hash_name(seed + ':' + name))
+
+def generate_profile(args, profile_name, variant):
+   seed = str(args.seed) + ':' + profile_name
+   randomizer = random.Random(hash_name(seed + ':' + str(variant)))
+   elements = []
+   for name in get_names(randomizer, 'ApexClass', args.class_accesses, variant):
+      elements.append(format_element('classAccesses', [('apexClass', name), ('enabled', flag(get_randomizer(seed, variant, name)))]))
+   elements.append(INDENTATION + '<custom>false</custom>')
+   for name in get_names(randomizer, 'Field', args.field_permissions, variant):
+      value_randomizer = get_randomizer(seed, variant, name)
+      elements.append(format_element('fieldPermissions', [('editable', flag(value_randomizer)),
+                                                          ('field', 'Object' + str(hash_name(name) % max(args.objects, 1)) + '__c.' + name + '__c'),
+                                                          ('readable', flag(value_randomizer))]))
+   for name in get_names(randomizer, 'Layout', args.layout_assignments, variant):
+      children = [('layout', 'Object' + str(hash_name(name) % max(args.objects, 1)) + '__c-' + name)]
+      if hash_name(name) % 2:
+         children.append(('recordType', 'Object' + str(hash_name(name) % max(args.objects, 1)) + '__c.' + name + 'RecordType'))
+      elements.append(format_element('layoutAssignments', children))
+   for name in get_names(randomizer, 'Object', args.object_permissions, variant):
+      value_randomizer = get_randomizer(seed, variant, name)
+      elements.append(format_element('objectPermissions', [('allowCreate', flag(value_randomizer)),
+                                                           ('allowDelete', flag(value_randomizer)),
+                                                           ('allowEdit', flag(value_randomizer)),
+                                                           ('allowRead', 'true'),
+                                                           ('modifyAllRecords', 'false'),
+                                                           ('object', name + '__c'),
+                                                           ('viewAllRecords', flag(value_randomizer))]))
+   elements.append(INDENTATION + '<userLicense>Salesforce</userLicense>')
+   for name in USER_PERMISSIONS[:args.user_permissions] + ['Permission' + str(index) for index in range(args.user_permissions - len(USER_PERMISSIONS))]:
+      elements.append(format_element('userPermissions', [('enabled', flag(get_randomizer(seed, variant, name))), ('name', name)]))
+   return format_document('Profile', elements)
+
+def generate_object(args, object_name, variant):
+   seed = str(args.seed) + ':' + object_name
+   randomizer = random.Random(hash_name(seed + ':' + str(variant)))
+   elements = [INDENTATION + '<enableHistory>true</enableHistory>']
+   for name in get_names(randomizer, 'Field', args.fields, variant):
+      value_randomizer = get_randomizer(seed, variant, name)
+      children = [('fullName', name + '__c'), ('externalId', 'false'), ('label', name + ' ' + str(pick(value_randomizer, 9) + 1))]
+      if value_randomizer.random() < 0.5:
+         children += [('length', ['40', '80', '255'][pick(value_randomizer, 3)]), ('required', 'false'), ('trackHistory', flag(value_randomizer)), ('type', 'Text'), ('unique', 'false')]
+      else:
+         children += [('precision', '18'), ('required', 'false'), ('scale', str(pick(value_randomizer, 5))), ('trackHistory', flag(value_randomizer)), ('type', 'Number'), ('unique', 'false')]
+      elements.append(format_element('fields', children))
+   elements.append(INDENTATION + '<label>' + object_name + '</label>')
+   elements.append(INDENTATION + '<sharingModel>ReadWrite</sharingModel>')
+   return format_document('CustomObject', elements)
+
+def generate_class(class_name, variant):
+   return 'public with sharing class ' + class_name + ' {\n' + INDENTATION + '// variant ' + str(variant if is_changed(variant, class_name) else 0) + '\n}\n'
+
+def generate_class_metadata():
+   return format_document('ApexClass', [INDENTATION + '<apiVersion>' + API_VERSION + '</apiVersion>', INDENTATION + '<status>Active</status>'])
+
+def generate_package(members):
+   elements = []
+   for metadata_type in sorted(members):
+      lines = [INDENTATION + '<types>']
+      lines += [INDENTATION * 2 + '<members>' + member + '</members>' for member in sorted(members[metadata_type])]
+      lines += [INDENTATION * 2 + '<name>' + metadata_type + '</name>', INDENTATION + '</types>']
+      elements.append('\n'.join(lines))
+   elements.append(INDENTATION + '<version>' + API_VERSION + '</version>')
+   return format_document('Package', elements)
+
+def write_file(file_path, content):
+   with open(file_path, 'wb') as output_file:
+      output_file.write(content.encode('utf-8'))
+
+# returns the number of generated files
+def generate_tree(args):
+   source_folder = args.output + '/src'
+   for folder_name in ['profiles', 'objects', 'classes']:
+      if not os.path.isdir(source_folder + '/' + folder_name):
+         os.makedirs(source_folder + '/' + folder_name)
+
+   members = {'Profile': [], 'CustomObject': [], 'ApexClass': []}
+   for index in range(args.profiles):
+      profile_name = 'Profile' + str(index)
+      write_file(source_folder + '/profiles/' + profile_name + '.profile', generate_profile(args, profile_name, args.variant))
+      members['Profile'].append(profile_name)
+   for index in range(args.objects):
+      object_name = 'Object' + str(index) + '__c'
+      write_file(source_folder + '/objects/' + object_name + '.object', generate_object(args, object_name, args.variant))
+      members['CustomObject'].append(object_name)
+   for index in range(args.classes):
+      class_name = 'ApexClass' + str(index)
+      write_file(source_folder + '/classes/' + class_name + '.cls', generate_class(class_name, args.variant))
+      write_file(source_folder + '/classes/' + class_name + '.cls-meta.xml', generate_class_metadata())
+      members['ApexClass'].append(class_name)
+   write_file(source_folder + '/package.xml', generate_package(members))
+   return args.profiles + args.objects + 2 * args.classes + 1
+
+def get_parser():
+   parser = argparse.ArgumentParser(description='Generates a synthetic Salesforce metadata tree (<output>/src).\n' +
+                                                'Example:\n' +
+                                                '\t' + os.path.basename(__file__) + ' -o /tmp/base --profiles 20 --field-permissions 5000\n' +
+                                                '\t' + os.path.basename(__file__) + ' -o /tmp/update --profiles 20 --field-permissions 5000 --variant 1',
+						formatter_class=RawTextHelpFormatter)
+   parser.add_argument(
+        "-o", "--output", dest="output", required=True,
+        help="Output folder")
+
+   parser.add_argument(
+        "--profiles", dest="profiles", type=int, default=10,
+        help="Number of profiles (default: 10)")
+
+   parser.add_argument(
+        "--field-permissions", dest="field_permissions", type=int, default=2000,
+        help="Number of fieldPermissions per profile (default: 2000)")
+
+   parser.add_argument(
+        "--object-permissions", dest="object_permissions", type=int, default=200,
+        help="Number of objectPermissions per profile (default: 200)")
+
+   parser.add_argument(
+        "--class-accesses", dest="class_accesses", type=int, default=500,
+        help="Number of classAccesses per profile (default: 500)")
+
+   parser.add_argument(
+        "--layout-assignments", dest="layout_assignments", type=int, default=200,
+        help="Number of layoutAssignments per profile (default: 200)")
+
+   parser.add_argument(
+        "--user-permissions", dest="user_permissions", type=int, default=50,
+        help="Number of userPermissions per profile (default: 50)")
+
+   parser.add_argument(
+        "--objects", dest="objects", type=int, default=5,
+        help="Number of custom objects (default: 5)")
+
+   parser.add_argument(
+        "--fields", dest="fields", type=int, default=2000,
+        help="Number of fields per custom object (default: 2000)")
+
+   parser.add_argument(
+        "--classes", dest="classes", type=int, default=100,
+        help="Number of apex classes (default: 100)")
+
+   parser.add_argument(
+        "--seed", dest="seed", type=int, default=1,
+        help="Seed of the generated values (default: 1)")
+
+   parser.add_argument(
+        "--variant", dest="variant", type=int, default=0,
+        help="Variant of the tree, 0 is the base tree, other variants change " + str(int(CHANGED_ELEMENTS * 100)) + "%%, remove " +
+             str(int(REMOVED_ELEMENTS * 100)) + "%% and add " + str(int(ADDED_ELEMENTS * 100)) + "%% of its elements (default: 0)")
+   return parser
+
+def main():
+   args = get_parser().parse_args()
+   file_count = generate_tree(args)
+   print('Generated ' + str(file_count) + ' files in ' + args.output + '/src')
+
+if __name__ == "__main__":
+   main()
@@ -10,7 +10,8 @@ from argparse import RawTextHelpFormatter
 import json
 import subprocess
 from git import *
-from distutils.dir_util import copy_tree, remove_tree
+from distutils.dir_util import remove_tree
+import copy_backend
 
 '''
 import json
@@ -246,10 +247,10 @@ def main():
          print_info("Removing existing folder " + color_string(vlocity_output_path, Color.BLUE))
          remove_tree(vlocity_output_path)
       try:
-         copy_tree(vlocity_folder, vlocity_output_path)
+         copy_backend.copy_tree(vlocity_folder, vlocity_output_path)
          print_info("Folder " + color_string(vlocity_folder, Color.BLUE) + " copied successfuly to " + color_string(output_path + "/vlocity", Color.BLUE))
       except Exception as e:
-         error_message = "Unable to copy folder " + vlocity_folder + " to the destination folder " + "../" + output_path + ": " + e.message
+         error_message = "Unable to copy folder " + vlocity_folder + " to the destination folder " + "../" + output_path + ": " + str(e)
          if(not IGNORE_ERRORS):
             raise RuntimeError(error_message)
          else:
@@ -9,8 +9,15 @@ import argparse
 from argparse import RawTextHelpFormatter
 import json
 import subprocess
-from shutil import copyfile
 import re
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import hashlib
+import time
+import importlib
+import xml.etree.ElementTree as ElementTree
+import copy_backend
+import file_watcher
 
 '''
 import json
@@ -40,6 +47,33 @@ DEBUG = False
 IGNORE_ERRORS = False
 DEBUG_LEVEL = 1
 
+# files are copied by a pool of threads
+DEFAULT_SYNC_THREADS = 8
+
+# watch mode - changes are synchronized once no other change came for the debounce period, the source folder is
+# polled at the poll interval where inotify isn't available (seconds)
+DEFAULT_WATCH_DEBOUNCE = 0.2
+DEFAULT_POLL_INTERVAL = 1.0
+
+# manifest of the synchronized files of a target folder, files that didn't change on either side since the last
+# synchronization are skipped without being compared or merged
+# manifests are kept by the absolute path of the target folder and the configuration outside of the folder, so they
+# are never committed along with the synchronized metadata and configurations synchronizing the same folder keep
+# manifests of their own, least recently saved ones are evicted beyond the size (number of manifests)
+# manifests kept in the target folder by the previous versions are removed
+SYNC_MANIFEST_FOLDER = os.path.expanduser('~/.cache/synchronize_sf_metadata/manifests')
+SYNC_MANIFEST_VERSION = 2
+SYNC_MANIFEST_CACHE_SIZE = 64
+LEGACY_SYNC_MANIFEST_FILE = '.synchronize_sf_metadata_manifest.json'
+MERGE_CONFIGURATION = 'merge_config.json'
+
+# preprocessed files are cached by the content of the source file and the preprocessors of its folder,
+# least recently used ones are evicted once the cache exceeds its size (in megabytes)
+PREPROCESSING_CACHE_FOLDER = os.path.expanduser('~/.cache/synchronize_sf_metadata/preprocessed')
+PREPROCESSING_CACHE_VERSION = 2
+PREPROCESSING_CACHE_SIZE = 256
+DEFAULT_NAMESPACE = 'http://soap.sforce.com/2006/04/metadata'
+
 # configuration folders and files
 SF_SYNC_JSON_CONFIG = 'salesforce_metadata_sync_config.json'
 CONFIG = '../etc'
@@ -64,17 +98,373 @@ def get_folder_list(path):
           folder_list.append(name)
    return folder_list
 
-def synchronize_folders(source_folder_path, destination_folder_path):
-   if not os.path.exists(destination_folder_path):
-      os.makedirs(destination_folder_path)
+# copies files of the source folders that are missing or differ in the destination folders (like rsync -a without
+# deleting), all folders are walked once and the files are compared and copied by a pool of threads
+# folder_pairs - (source folder, destination folder) pairs
+# manifest - if given, files synchronized since their manifest entry was made are skipped and the entries of the
+# other files are updated
+# folder_preprocessors - source folder -> preprocessors, files of these folders that are to be synchronized are
+# preprocessed by jobs worker processes and the preprocessed files are synchronized instead
+# source_files - if given, only these source files of the folders are synchronized and the folders are not walked
+# returns the statistics - copied and skipped files and bytes copied
+def synchronize_folders(folder_pairs, threads = DEFAULT_SYNC_THREADS, checksum = False, manifest = None, folder_preprocessors = None, jobs = 1, source_files = None):
+   tasks = []
+   for source_folder_path, destination_folder_path in folder_pairs:
+      folder_tasks = []
+      for root, files in get_folder_files(source_folder_path, source_files):
+         destination_root = destination_folder_path + root[len(source_folder_path):]
+         if not os.path.exists(destination_root):
+            os.makedirs(destination_root)
+         for file_name in files:
+            destination_file_path = destination_root + '/' + file_name
+            folder_tasks.append((root + '/' + file_name, destination_file_path, checksum, get_manifest_entry(manifest, destination_file_path), root + '/' + file_name))
 
-   sync_cmd = 'rsync -acv ' + source_folder_path + '/ ' + destination_folder_path
+      preprocessors = (folder_preprocessors or {}).get(source_folder_path)
+      if preprocessors:
+         # files synchronized since the last synchronization are not preprocessed
+         changed_files = set(task[0] for task in folder_tasks if not is_synchronized(task[3], task[0], task[1]))
+         preprocessed_paths = preprocess_files(sorted(changed_files), preprocessors, jobs)
+         folder_tasks = [task[:4] + (preprocessed_paths.get(task[0], task[0]),) for task in folder_tasks
+                         if task[0] in preprocessed_paths or task[0] not in changed_files]
+      tasks += folder_tasks
+
+   pool = ThreadPool(threads)
    try:
-      result = subprocess.check_output(sync_cmd, shell=True)
-   except subprocess.CalledProcessError as e:
-      if(not IGNORE_ERRORS):
-         raise RuntimeError("Synchronizatin of folders failed (Command: '{}' returned error (code {}). If you want to ignore errors during the synchronization you can run it with --ignore-errors parameter. Please, also use -d parameter for more details".format(e.cmd, e.returncode))
-      result = e.output 
+      results = pool.map(synchronize_file, tasks)
+   finally:
+      pool.close()
+      pool.join()
+
+   statistics = {'copied': 0, 'skipped': 0, 'bytes': 0}
+   error_messages = []
+   for task, result in zip(tasks, results):
+      status, copied_bytes, error_message, entry = result
+      if error_message is not None:
+         error_messages.append(error_message)
+         continue
+      set_manifest_entry(manifest, task[1], entry)
+      statistics[status] += 1
+      statistics['bytes'] += copied_bytes
+      if DEBUG and status == 'copied':
+         print task[1]
+
+   if error_messages and not IGNORE_ERRORS:
+      raise RuntimeError("Synchronization of folders failed:\n" + '\n'.join(error_messages) + "\nIf you want to ignore errors during the synchronization you can run it with --ignore-errors parameter.")
+   for error_message in error_messages:
+      print error_message
+   return statistics
+
+# (folder, file names) of the source folder and its subfolders like os.walk, or of the given source files in it
+def get_folder_files(source_folder_path, source_files = None):
+   if source_files is None:
+      return [(root, files) for root, folders, files in os.walk(source_folder_path)]
+   folder_files = {}
+   for file_path in sorted(source_files):
+      if file_path.startswith(source_folder_path + '/') and os.path.isfile(file_path):
+         root, file_name = os.path.split(file_path)
+         folder_files.setdefault(root, []).append(file_name)
+   return sorted(folder_files.items())
+
+# task of a pool thread - (source file, destination file, checksum, manifest entry or None, file to be copied -
+# the source file or its preprocessed version)
+# returns the status (copied or skipped), the bytes copied, the error message if the copy failed and the manifest
+# entry of the synchronized file
+def synchronize_file(task):
+   source_file_path, destination_file_path, checksum, entry, copied_file_path = task
+   try:
+      synchronized_entry = get_synchronized_entry(entry, source_file_path, destination_file_path)
+      if synchronized_entry is not None:
+         return 'skipped', 0, None, synchronized_entry
+      if not file_changed(copied_file_path, destination_file_path, checksum):
+         return 'skipped', 0, None, create_manifest_entry(source_file_path, destination_file_path)
+      # modification time is kept so the file is skipped by the next synchronization
+      copy_backend.copy_file(copied_file_path, destination_file_path)
+      return 'copied', os.path.getsize(destination_file_path), None, create_manifest_entry(source_file_path, destination_file_path, copied_file_path == source_file_path)
+   except (IOError, OSError) as e:
+      return None, 0, "Synchronization of " + source_file_path + " failed: " + str(e), None
+
+# files differ in size or modification time, or in content if checksum is set
+# modification times are compared to milliseconds as copies made by python 2 keep microseconds only
+def file_changed(source_file_path, destination_file_path, checksum = False):
+   if not os.path.isfile(destination_file_path):
+      return True
+   source_stat = os.stat(source_file_path)
+   destination_stat = os.stat(destination_file_path)
+   if source_stat.st_size != destination_stat.st_size:
+      return True
+   if checksum:
+      return get_file_hash(source_file_path) != get_file_hash(destination_file_path)
+   return abs(source_stat.st_mtime - destination_stat.st_mtime) >= 0.001
+
+def get_file_hash(file_path):
+   hasher = hashlib.sha1()
+   with open(file_path, 'rb') as input_file:
+      for chunk in iter(lambda: input_file.read(1024 * 1024), b''):
+         hasher.update(chunk)
+   return hasher.hexdigest()
+
+# the manifest is valid for the configuration it was made with - the synchronization and the merge configuration
+def get_manifest_config_hash(sf_sync_config):
+   with open(SCRIPT_FOLDER_PATH + '/' + CONFIG + '/' + MERGE_CONFIGURATION, 'rb') as merge_config_file:
+      merge_config = merge_config_file.read()
+   return hashlib.sha1(json.dumps(sf_sync_config, sort_keys=True).encode('utf-8') + merge_config).hexdigest()
+
+def get_manifest_path(target_folder_path, config_hash):
+   return SYNC_MANIFEST_FOLDER + '/' + hashlib.sha1(os.path.realpath(target_folder_path).encode('utf-8')).hexdigest() + '-' + config_hash + '.json'
+
+# manifest - {'path': target folder, 'files': path relative to the target folder -> manifest entry}
+# diagnostics of the manifest go to stderr, stdout may be the json plan
+def load_manifest(target_folder_path, config_hash):
+   manifest = {'path': target_folder_path, 'files': {}}
+   manifest_path = get_manifest_path(target_folder_path, config_hash)
+   if os.path.isfile(manifest_path):
+      try:
+         with open(manifest_path) as manifest_file:
+            manifest_data = json.load(manifest_file)
+         if manifest_data.get('version') == SYNC_MANIFEST_VERSION and manifest_data.get('config') == config_hash:
+            manifest['files'] = manifest_data['files']
+         else:
+            sys.stderr.write('Synchronization manifest ' + manifest_path + ' was created by another version, ignoring it\n')
+      except (IOError, OSError, ValueError, KeyError):
+         sys.stderr.write('Unable to read synchronization manifest ' + manifest_path + ', ignoring it\n')
+   return manifest
+
+# synchronizations of the same folder may save their manifests at the same time, so temporary files are per process
+def save_manifest(manifest, config_hash):
+   manifest_path = get_manifest_path(manifest['path'], config_hash)
+   temp_manifest_path = manifest_path + '.tmp.' + str(os.getpid())
+   try:
+      if not os.path.isdir(SYNC_MANIFEST_FOLDER):
+         try:
+            os.makedirs(SYNC_MANIFEST_FOLDER)
+         except OSError:
+            if not os.path.isdir(SYNC_MANIFEST_FOLDER):
+               raise
+      with open(temp_manifest_path, 'w') as manifest_file:
+         json.dump({'version': SYNC_MANIFEST_VERSION, 'config': config_hash, 'target': os.path.realpath(manifest['path']), 'files': manifest['files']},
+                   manifest_file, sort_keys=True)
+      os.rename(temp_manifest_path, manifest_path)
+      evict_manifests()
+   except (IOError, OSError):
+      sys.stderr.write('Unable to write synchronization manifest ' + manifest_path + '\n')
+
+   legacy_manifest_path = manifest['path'] + '/' + LEGACY_SYNC_MANIFEST_FILE
+   if os.path.isfile(legacy_manifest_path):
+      try:
+         os.remove(legacy_manifest_path)
+         sys.stderr.write('Removed synchronization manifest ' + legacy_manifest_path + ', manifests are kept in ' + SYNC_MANIFEST_FOLDER + ' now\n')
+      except OSError:
+         sys.stderr.write('Unable to remove synchronization manifest ' + legacy_manifest_path + '\n')
+
+# removes the least recently saved manifests beyond the size, manifests removed by another synchronization meanwhile
+# are skipped
+def evict_manifests():
+   manifests = []
+   for name in os.listdir(SYNC_MANIFEST_FOLDER):
+      if name.endswith('.json'):
+         try:
+            manifests.append((os.path.getmtime(SYNC_MANIFEST_FOLDER + '/' + name), SYNC_MANIFEST_FOLDER + '/' + name))
+         except OSError:
+            pass
+   for modification_time, manifest_path in sorted(manifests)[:-SYNC_MANIFEST_CACHE_SIZE]:
+      try:
+         os.remove(manifest_path)
+      except OSError:
+         pass
+
+def get_manifest_entry(manifest, destination_file_path):
+   if manifest is None:
+      return None
+   return manifest['files'].get(os.path.relpath(destination_file_path, manifest['path']))
+
+def set_manifest_entry(manifest, destination_file_path, entry):
+   if manifest is not None and entry is not None:
+      manifest['files'][os.path.relpath(destination_file_path, manifest['path'])] = entry
+
+# size, modification time and content hash of the destination file and the source file it was synchronized with
+# same_content - the destination file is a copy of the source file, its content is hashed once
+def create_manifest_entry(source_file_path, destination_file_path, same_content = False):
+   source_stat = os.stat(source_file_path)
+   destination_stat = os.stat(destination_file_path)
+   source_hash = get_file_hash(source_file_path)
+   return {'size': destination_stat.st_size, 'mtime': destination_stat.st_mtime, 'hash': source_hash if same_content else get_file_hash(destination_file_path),
+           'source-size': source_stat.st_size, 'source-mtime': source_stat.st_mtime, 'source-hash': source_hash}
+
+# the manifest entry if neither the source nor the destination file changed since it was made, None otherwise
+# a file of the same size but of another modification time (touched, checked out again) is compared by its content
+# hash, the entry is returned with the new modification times if the content is the same
+def get_synchronized_entry(entry, source_file_path, destination_file_path):
+   if entry is None:
+      return None
+   try:
+      source_stat = os.stat(source_file_path)
+      destination_stat = os.stat(destination_file_path)
+      if entry['source-size'] != source_stat.st_size or entry['size'] != destination_stat.st_size:
+         return None
+      if entry['source-mtime'] == source_stat.st_mtime and entry['mtime'] == destination_stat.st_mtime:
+         return entry
+      if ((entry['source-mtime'] != source_stat.st_mtime and get_file_hash(source_file_path) != entry['source-hash']) or
+          (entry['mtime'] != destination_stat.st_mtime and get_file_hash(destination_file_path) != entry['hash'])):
+         return None
+   except (IOError, OSError):
+      return None
+   synchronized_entry = dict(entry)
+   synchronized_entry.update({'source-mtime': source_stat.st_mtime, 'mtime': destination_stat.st_mtime})
+   return synchronized_entry
+
+def is_synchronized(entry, source_file_path, destination_file_path):
+   return get_synchronized_entry(entry, source_file_path, destination_file_path) is not None
+
+# preprocessors - name -> function changing the root element of a file, it gets the root and the preprocessor
+# configuration, other preprocessors can be configured by the "module.function" name
+# removes top-level elements of the given names ("elements"), a name may be a path to nested elements separated
+# by slashes (e.g. "oauthConfig/consumerKey")
+def remove_elements_preprocessor(root, preprocessor_config):
+   parent_element_names = {}
+   for element_path in preprocessor_config.get('elements', []):
+      parent_path, element_name = ('/' + element_path).rsplit('/', 1)
+      parent_element_names.setdefault(parent_path.strip('/'), set()).add(element_name)
+   for parent_path, element_names in parent_element_names.items():
+      for parent in get_elements_by_path(root, parent_path):
+         remove_children(parent, [child for child in parent if get_element_local_name(child) in element_names])
+
+# removes top-level elements referring to components of the given managed package namespaces ("namespaces"),
+# i.e. having a value starting with the namespace prefix or referring to a field or class of it
+def remove_namespaced_preprocessor(root, preprocessor_config):
+   if preprocessor_config.get('namespaces'):
+      matcher = re.compile('(^|[.:])(' + '|'.join(re.escape(namespace) for namespace in preprocessor_config['namespaces']) + ')__')
+      remove_children(root, [child for child in root if any(element.text and matcher.search(element.text) for element in child.iter())])
+
+# sorts top-level elements by tag, elements of the same tag keep their order (like update_xml.py does)
+def sort_preprocessor(root, preprocessor_config):
+   root[:] = sorted(root, key=lambda element: element.tag)
+
+PREPROCESSORS = {
+   'remove-elements': remove_elements_preprocessor,
+   'remove-namespaced': remove_namespaced_preprocessor,
+   'sort': sort_preprocessor
+}
+
+def get_element_local_name(element):
+   return element.tag.split('}')[-1]
+
+# elements at the path of local names separated by slashes below the root, the root itself for an empty path
+def get_elements_by_path(root, path):
+   elements = [root]
+   for name in path.split('/') if path else []:
+      elements = [child for element in elements for child in element if get_element_local_name(child) == name]
+   return elements
+
+# tails of the removed elements are kept for what followed them, the children are rebuilt in a single pass
+def remove_children(root, children):
+   removed_children = set(children)
+   if not removed_children:
+      return
+   kept_children = []
+   for child in root:
+      if child in removed_children:
+         if kept_children:
+            kept_children[-1].tail = child.tail
+      else:
+         kept_children.append(child)
+   root[:] = kept_children
+
+def get_preprocessor(name):
+   if name in PREPROCESSORS:
+      return PREPROCESSORS[name]
+   if '.' in name:
+      module_name, function_name = name.rsplit('.', 1)
+      return getattr(importlib.import_module(module_name), function_name)
+   raise ValueError('Unknown preprocessor ' + name)
+
+# preprocessors of the file, the ones with a fileMask not matching the file name are left out
+def get_file_preprocessors(file_path, preprocessors):
+   return [preprocessor for preprocessor in preprocessors if re.match(preprocessor.get('fileMask', '.*'), os.path.basename(file_path))]
+
+# task of a worker process - (source file, preprocessors)
+# returns the path of the preprocessed file in the cache and the error message if the preprocessing failed
+def preprocess_file_task(task):
+   source_file_path, preprocessors = task
+   try:
+      with open(source_file_path, 'rb') as source_file:
+         content = source_file.read()
+      cache_key = hashlib.sha1(json.dumps([PREPROCESSING_CACHE_VERSION, preprocessors], sort_keys=True).encode('utf-8') + content).hexdigest()
+      cached_file_path = PREPROCESSING_CACHE_FOLDER + '/' + cache_key
+      if os.path.isfile(cached_file_path):
+         # the access time orders the cache for the eviction, the modification time is compared by the synchronization
+         os.utime(cached_file_path, (time.time(), os.path.getmtime(cached_file_path)))
+         return cached_file_path, None
+
+      ElementTree.register_namespace('', DEFAULT_NAMESPACE)
+      element_tree = ElementTree.ElementTree(ElementTree.fromstring(content))
+      for preprocessor in preprocessors:
+         get_preprocessor(preprocessor['name'])(element_tree.getroot(), preprocessor)
+      element_tree.write(cached_file_path + '.' + str(os.getpid()), encoding="UTF-8", xml_declaration = True)
+      os.rename(cached_file_path + '.' + str(os.getpid()), cached_file_path)
+      return cached_file_path, None
+   except (ElementTree.ParseError, IOError, OSError, ValueError, ImportError, AttributeError) as e:
+      return None, "Preprocessing of " + source_file_path + " failed: " + str(e)
+
+# preprocesses the files by a pool of worker processes
+# returns source file -> file to be synchronized instead (preprocessed or the source file if there are no
+# preprocessors of the file), files failed to be preprocessed are left out
+def preprocess_files(file_paths, preprocessors, jobs = 1):
+   result_paths = {}
+   tasks = []
+   for file_path in file_paths:
+      file_preprocessors = get_file_preprocessors(file_path, preprocessors)
+      if file_preprocessors:
+         tasks.append((file_path, file_preprocessors))
+      else:
+         result_paths[file_path] = file_path
+   if not tasks:
+      return result_paths
+
+   if not os.path.isdir(PREPROCESSING_CACHE_FOLDER):
+      os.makedirs(PREPROCESSING_CACHE_FOLDER)
+   if jobs > 1 and len(tasks) > 1:
+      pool = multiprocessing.Pool(min(jobs, len(tasks)))
+      try:
+         results = pool.map(preprocess_file_task, tasks, len(tasks) // (jobs * 4) + 1)
+      finally:
+         pool.close()
+         pool.join()
+   else:
+      results = [preprocess_file_task(task) for task in tasks]
+
+   error_messages = []
+   for task, result in zip(tasks, results):
+      preprocessed_file_path, error_message = result
+      if error_message is not None:
+         error_messages.append(error_message)
+      else:
+         result_paths[task[0]] = preprocessed_file_path
+   if error_messages and not IGNORE_ERRORS:
+      raise RuntimeError("Preprocessing of files failed:\n" + '\n'.join(error_messages) + "\nIf you want to ignore errors during the synchronization you can run it with --ignore-errors parameter.")
+   for error_message in error_messages:
+      print error_message
+   return result_paths
+
+# removes the least recently used preprocessed files until the cache fits its size
+def evict_preprocessing_cache():
+   if not os.path.isdir(PREPROCESSING_CACHE_FOLDER):
+      return
+   cached_files = []
+   for name in os.listdir(PREPROCESSING_CACHE_FOLDER):
+      try:
+         file_stat = os.stat(PREPROCESSING_CACHE_FOLDER + '/' + name)
+      except OSError:
+         continue
+      cached_files.append((file_stat.st_atime, PREPROCESSING_CACHE_FOLDER + '/' + name, file_stat.st_size))
+   cache_size = sum(cached_file[2] for cached_file in cached_files)
+   for access_time, file_path, file_size in sorted(cached_files):
+      if cache_size <= PREPROCESSING_CACHE_SIZE * 1024 * 1024:
+         break
+      try:
+         os.remove(file_path)
+         cache_size -= file_size
+      except OSError:
+         pass
 
 def get_file_list(path, fileMask = '.*'):
    file_list = []
@@ -85,31 +475,77 @@ def get_file_list(path, fileMask = '.*'):
           file_list.append(name)
    return file_list
 
-def synchronize_files_in_folders(source_folder_path, destination_folder_path, metadata_type):
+# files of a merged folder - (destination file, source file) pairs to be merged, names of the files to be copied
+# (missing in the destination folder) and source files synchronized since their manifest entry was made
+# file_names - if given, only these files of the source folder are taken, the folder is not listed
+def get_merge_operations(source_folder_path, destination_folder_path, manifest = None, file_names = None):
+   if file_names is None:
+      source_folder_files = get_file_list(source_folder_path)
+   else:
+      source_folder_files = [file_name for file_name in sorted(file_names) if os.path.isfile(source_folder_path + '/' + file_name)]
+   destination_folder_files = set(file_name for file_name in source_folder_files if os.path.isfile(destination_folder_path + '/' + file_name))
+
+   merged_files = []
+   skipped_files = []
+   for file_name in source_folder_files:
+      source_file_path = source_folder_path + '/' + file_name
+      destination_file_path = destination_folder_path + '/' + file_name
+      if file_name not in destination_folder_files:
+         continue
+      entry = get_synchronized_entry(get_manifest_entry(manifest, destination_file_path), source_file_path, destination_file_path)
+      if entry is not None:
+         set_manifest_entry(manifest, destination_file_path, entry)
+         skipped_files.append(source_file_path)
+      else:
+         merged_files.append((destination_file_path, source_file_path))
+   copied_files = [file_name for file_name in source_folder_files if file_name not in destination_folder_files]
+   return merged_files, copied_files, skipped_files
+
+# manifest - if given, files synchronized since their manifest entry was made are not merged again and the entries
+# of the merged and copied files are updated
+# statistics - if given, merged, copied and skipped files are counted there
+# preprocessors - if given, files to be merged or copied are preprocessed by jobs worker processes first and the
+# preprocessed files are merged or copied instead
+# file_names - if given, only these files of the source folder are synchronized
+def synchronize_files_in_folders(source_folder_path, destination_folder_path, metadata_type, manifest = None, statistics = None, preprocessors = None, jobs = 1, file_names = None):
    if not os.path.exists(destination_folder_path):
       os.makedirs(destination_folder_path)
 
-   source_folder_files = get_file_list(source_folder_path)
-   destination_folder_files = get_file_list(destination_folder_path)
+   merged_files, copied_files, skipped_files = get_merge_operations(source_folder_path, destination_folder_path, manifest, file_names)
+
+   # only files to be merged or copied are preprocessed
+   preprocessed_paths = None
+   if preprocessors:
+      preprocessed_paths = preprocess_files([source_file_path for destination_file_path, source_file_path in merged_files] +
+                                            [source_folder_path + '/' + file_name for file_name in copied_files], preprocessors, jobs)
+      merged_files = [merged_file for merged_file in merged_files if merged_file[1] in preprocessed_paths]
+      copied_files = [file_name for file_name in copied_files if source_folder_path + '/' + file_name in preprocessed_paths]
 
    aggregated_output = ''
-   for file_name in source_folder_files:
-      source_file = source_folder_path + '/' + file_name
-      destination_file = destination_folder_path + '/' + file_name
-      if file_name in destination_folder_files:
-         # run update_xml.py script
-         cmd = SCRIPT_FOLDER_PATH + '/update_xml.py -d -m ' + metadata_type + ' "' + destination_file + '" "' + source_file + '"'
-         try:
-            result = subprocess.check_output(cmd, shell=True)
-         except subprocess.CalledProcessError as e:
-            if(not IGNORE_ERRORS):
-               raise RuntimeError("Synchronization of files failed (Command: '{}' returned error (code {}). If you want to ignore errors during the synchronization you can run it with --ignore-errors parameter. Please, also use -d parameter for more details".format(e.cmd, e.returncode))
-            result = e.output
-         aggregated_output += result + '\n'
+   if merged_files:
+      # run update_xml.py script once for all files of the folder to be merged
+      cmd = SCRIPT_FOLDER_PATH + '/update_xml.py -d -j ' + str(multiprocessing.cpu_count()) + ' -m ' + metadata_type + ' --manifest -'
+      merge_manifest = ''.join(destination_file_path + '\t' + (preprocessed_paths or {}).get(source_file_path, source_file_path) + '\n' for destination_file_path, source_file_path in merged_files)
+      process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+      result = process.communicate(merge_manifest)[0]
+      if process.returncode != 0:
+         if(not IGNORE_ERRORS):
+            raise RuntimeError("Synchronization of files failed (Command: '{}' returned error (code {}). If you want to ignore errors during the synchronization you can run it with --ignore-errors parameter. Please, also use -d parameter for more details".format(cmd, process.returncode))
       else:
-         # TODO try-catch
-         copyfile(source_file, destination_file)
+         for destination_file_path, source_file_path in merged_files:
+            set_manifest_entry(manifest, destination_file_path, create_manifest_entry(source_file_path, destination_file_path))
+      aggregated_output += result + '\n'
+
+   for file_name in copied_files:
+      source_file_path = source_folder_path + '/' + file_name
+      # TODO try-catch
+      copy_backend.copy_file((preprocessed_paths or {}).get(source_file_path, source_file_path), destination_folder_path + '/' + file_name, preserve = False)
+      set_manifest_entry(manifest, destination_folder_path + '/' + file_name, create_manifest_entry(source_file_path, destination_folder_path + '/' + file_name))
 
+   if statistics is not None:
+      statistics['merged'] += len(merged_files)
+      statistics['copied'] += len(copied_files)
+      statistics['skipped'] += len(skipped_files)
    return aggregated_output
    '''
    sync_cmd = 'rsync -acv ' + source_folder_path + '/ ' + destination_folder_path
@@ -121,6 +557,140 @@ def synchronize_files_in_folders(source_folder_path, destination_folder_path, me
       result = e.output 
     '''
 
+# what the synchronization would do, nothing is changed - per synchronized folder the files to be copied, merged
+# and skipped along with their bytes (bytes of both files for merged ones as both are parsed) and the folders to
+# be created, files of folders with preprocessing are planned by their source files
+def get_synchronization_plan(source_path, target_path, sf_sync_config, manifest = None, checksum = False):
+   plan = {'source': source_path, 'target': target_path, 'folders': [], 'ignored-folders': []}
+   totals = {'copy': {'files': 0, 'bytes': 0}, 'merge': {'files': 0, 'bytes': 0}, 'skip': {'files': 0, 'bytes': 0}, 'new-folders': 0}
+   for name in sorted(get_folder_list(source_path)):
+      folder_config = get_sf_folder_config(name, sf_sync_config)
+      if folder_config is None or folder_config.get('synchronization') != 'on':
+         plan['ignored-folders'].append(name)
+         continue
+
+      source_folder_path = source_path + '/' + name
+      destination_folder_path = target_path + '/' + name
+      folder_plan = {'folder': name, 'preprocessing': folder_config.get('preprocessing') == 'on',
+                     'copy': {'files': 0, 'bytes': 0}, 'merge': {'files': 0, 'bytes': 0}, 'skip': {'files': 0, 'bytes': 0}, 'new-folders': 0}
+      if folder_config.get('fileReplace') == 'off':
+         folder_plan['operation'] = 'merge'
+         folder_plan['new-folders'] = 0 if os.path.isdir(destination_folder_path) else 1
+         merged_files, copied_files, skipped_files = get_merge_operations(source_folder_path, destination_folder_path, manifest)
+         add_plan_files(folder_plan['merge'], [file_path for merged_file in merged_files for file_path in merged_file])
+         folder_plan['merge']['files'] = len(merged_files)
+         add_plan_files(folder_plan['copy'], [source_folder_path + '/' + file_name for file_name in copied_files])
+         add_plan_files(folder_plan['skip'], skipped_files)
+      else:
+         folder_plan['operation'] = 'replace'
+         for root, folders, files in os.walk(source_folder_path):
+            destination_root = destination_folder_path + root[len(source_folder_path):]
+            if not os.path.isdir(destination_root):
+               folder_plan['new-folders'] += 1
+            for file_name in files:
+               source_file_path = root + '/' + file_name
+               destination_file_path = destination_root + '/' + file_name
+               if (is_synchronized(get_manifest_entry(manifest, destination_file_path), source_file_path, destination_file_path) or
+                   not file_changed(source_file_path, destination_file_path, checksum)):
+                  add_plan_files(folder_plan['skip'], [source_file_path])
+               else:
+                  add_plan_files(folder_plan['copy'], [source_file_path])
+
+      for operation in ['copy', 'merge', 'skip']:
+         totals[operation]['files'] += folder_plan[operation]['files']
+         totals[operation]['bytes'] += folder_plan[operation]['bytes']
+      totals['new-folders'] += folder_plan['new-folders']
+      plan['folders'].append(folder_plan)
+   plan['totals'] = totals
+   return plan
+
+def add_plan_files(operation_plan, file_paths):
+   operation_plan['files'] += len(file_paths)
+   operation_plan['bytes'] += sum(os.path.getsize(file_path) for file_path in file_paths)
+
+# synchronizes the folders of the source folder with the target folder
+# folder_changes - if given, only these folders and their changed files are synchronized (see get_folder_changes)
+def synchronize(args, sf_sync_config, manifest, config_hash, folder_changes = None):
+   if folder_changes is None:
+      folder_names = get_folder_list(args.source)
+   else:
+      folder_names = sorted(name for name in folder_changes if os.path.isdir(args.source + '/' + name))
+
+   replaced_folders = []
+   replaced_files = None if folder_changes is None else set()
+   folder_preprocessors = {}
+   merged_folders = 0
+   merge_statistics = {'merged': 0, 'copied': 0, 'skipped': 0}
+   for name in folder_names:
+      folder_config = get_sf_folder_config(name, sf_sync_config)
+      if folder_config is not None and 'synchronization' in folder_config and folder_config['synchronization'] == 'on':
+         preprocessors = None
+         if 'preprocessing' in folder_config and folder_config['preprocessing'] == 'on':
+            # preprocessors of the folder, files are preprocessed before they are merged or copied
+            preprocessors = folder_config.get('preprocessors', [])
+            folder_preprocessors[args.source + '/' + name] = preprocessors
+         if 'fileReplace' in folder_config and folder_config['fileReplace'] == 'off':
+            # xml merge, only files of the folder itself are merged
+            file_names = None
+            if folder_changes is not None:
+               file_names = set(os.path.basename(file_path) for file_path in folder_changes[name] if os.path.dirname(file_path) == args.source + '/' + name)
+            synchronize_files_in_folders(args.source + '/' + name, args.target + '/' + name, name, manifest, merge_statistics, preprocessors, args.preprocessing_jobs, file_names)
+            merged_folders += 1
+            print name
+         else:
+            # simply replace files in folder, all such folders are synchronized at once
+            replaced_folders.append((args.source + '/' + name, args.target + '/' + name))
+            if replaced_files is not None:
+               replaced_files.update(folder_changes[name])
+
+   statistics = synchronize_folders(replaced_folders, args.threads, args.checksum, manifest, folder_preprocessors, args.preprocessing_jobs, replaced_files)
+   if manifest is not None:
+      save_manifest(manifest, config_hash)
+   if folder_preprocessors:
+      evict_preprocessing_cache()
+   print 'Merged ' + str(merged_folders) + ' folders: ' + str(merge_statistics['merged']) + ' files merged, ' + str(merge_statistics['copied']) + ' files copied, ' + str(merge_statistics['skipped']) + ' files skipped'
+   print 'Synchronized ' + str(len(replaced_folders)) + ' folders: ' + str(statistics['copied']) + ' files copied, ' + str(statistics['skipped']) + ' files skipped, ' + str(statistics['bytes']) + ' bytes copied'
+
+# changed files of the source folder by the folder of the source folder they are in, files directly in the source
+# folder are left out as they are never synchronized
+def get_folder_changes(source_path, changed_files):
+   folder_changes = {}
+   for file_path in changed_files:
+      relative_path = os.path.relpath(file_path, source_path)
+      if os.sep in relative_path and not relative_path.startswith(os.pardir + os.sep):
+         folder_changes.setdefault(relative_path.split(os.sep)[0], set()).add(source_path + '/' + relative_path)
+   return folder_changes
+
+# synchronizes everything and then the changes of the source folder as they come until interrupted, a failed
+# synchronization is reported and the files are synchronized again with their next change
+def watch(args, sf_sync_config, manifest, config_hash):
+   # the watcher is created first so changes made during the first synchronization are not missed
+   watcher = file_watcher.create_watcher(args.source, args.poll_interval, args.poll)
+   try:
+      synchronize(args, sf_sync_config, manifest, config_hash)
+      print 'Watching ' + args.source + ' for changes (' + watcher['type'] + '), press Ctrl+C to stop'
+      while True:
+         changed_files = file_watcher.wait_for_changes(watcher, args.debounce)
+         if changed_files is None:
+            print time.strftime('%H:%M:%S') + ' Changes of ' + args.source + ' are not known, synchronizing all folders'
+            folder_changes = None
+         else:
+            folder_changes = get_folder_changes(args.source, changed_files)
+            if not folder_changes:
+               continue
+            print time.strftime('%H:%M:%S') + ' ' + str(sum(len(files) for files in folder_changes.values())) + ' files changed'
+            if DEBUG:
+               for file_path in sorted(set().union(*folder_changes.values())):
+                  print file_path
+         try:
+            synchronize(args, sf_sync_config, manifest, config_hash, folder_changes)
+         except (RuntimeError, IOError, OSError) as e:
+            print 'Synchronization failed, waiting for further changes: ' + str(e)
+   except KeyboardInterrupt:
+      print 'Stopped watching ' + args.source
+   finally:
+      file_watcher.close_watcher(watcher)
+
 def main():
    parser = argparse.ArgumentParser(description='Synchronizes two folders with SF metadata using configuration file.\n' +
                                                 'Example:\n' +
@@ -150,6 +720,45 @@ def main():
         "--debug-level", dest="debug_level",type=int,
         help="Debug level from {1, 2}")
 
+   parser.add_argument(
+        "-j", "--threads", dest="threads", type=int, default=DEFAULT_SYNC_THREADS,
+        help="Number of threads copying files of the folders replaced (default: " + str(DEFAULT_SYNC_THREADS) + ")")
+
+   parser.add_argument(
+        "--preprocessing-jobs", dest="preprocessing_jobs", type=int, default=multiprocessing.cpu_count(),
+        help="Number of worker processes preprocessing files of the folders with preprocessing on (default: number of cpus)")
+
+   parser.add_argument(
+        "--plan", dest="plan", nargs='?', const='-',
+        help="Writes what the synchronization would do as json to the path ('-' or no path prints it) instead of\n" +
+             "synchronizing - per folder the files to be copied, merged and skipped, their bytes and the folders to be created")
+
+   parser.add_argument(
+        "-w", "--watch", dest="watch",
+        help="Keeps running after the synchronization and synchronizes files of the source folder as they change\n" +
+             "(inotify events or polling where inotify isn't available) until interrupted", action="store_true")
+
+   parser.add_argument(
+        "--debounce", dest="debounce", type=float, default=DEFAULT_WATCH_DEBOUNCE,
+        help="Seconds without further changes the watch mode waits for before it synchronizes them (default: " + str(DEFAULT_WATCH_DEBOUNCE) + ")")
+
+   parser.add_argument(
+        "--poll", dest="poll",
+        help="Polls the source folder in the watch mode rather than using inotify (e.g. network file systems)", action="store_true")
+
+   parser.add_argument(
+        "--poll-interval", dest="poll_interval", type=float, default=DEFAULT_POLL_INTERVAL,
+        help="Seconds between the scans of the source folder when it's polled (default: " + str(DEFAULT_POLL_INTERVAL) + ")")
+
+   parser.add_argument(
+        "--no-manifest", dest="no_manifest",
+        help="Compares and merges all files, ignoring and not updating the synchronization manifest\n" +
+             "(kept in " + SYNC_MANIFEST_FOLDER + " by the target folder and the configuration)", action="store_true")
+
+   parser.add_argument(
+        "--checksum", dest="checksum",
+        help="Compares content of the files of the folders replaced rather than their size and modification time", action="store_true")
+
    args = parser.parse_args()
 
    # arguments assignment to global variables
@@ -166,22 +775,36 @@ def main():
    # load sf synchronization configuration
    sf_sync_config = load_sf_sync_config(sync_json_config)
 
-   # source folder
-   for name in get_folder_list(args.source):
-      folder_config = get_sf_folder_config(name, sf_sync_config)
-      if folder_config is not None and 'synchronization' in folder_config and folder_config['synchronization'] == 'on':
-         if 'preprocessing' in folder_config and folder_config['preprocessing'] == 'on':
-            # TODO run preprocessing)            
-            pass
-         if 'fileReplace' in folder_config and folder_config['fileReplace'] == 'off':
-            # xml merge
-            synchronize_files_in_folders(args.source + '/' + name, args.target + '/' + name, name)
-            print name
-         else:
-            # simply replace files in folder
-            source_folder_path = args.source + '/' + name
-            destination_folder_path = args.target + '/' + name
-            synchronize_folders(source_folder_path, destination_folder_path)
-   
+   if(args.threads < 1):
+      parser.error("--threads must be at least 1")
+   if(args.preprocessing_jobs < 1):
+      parser.error("--preprocessing-jobs must be at least 1")
+   if(args.watch and args.plan):
+      parser.error("--watch can't be used with --plan")
+   if(args.debounce < 0 or args.poll_interval <= 0):
+      parser.error("--debounce can't be negative and --poll-interval must be positive")
+
+   manifest = None
+   config_hash = None
+   if not args.no_manifest:
+      config_hash = get_manifest_config_hash(sf_sync_config)
+      if not os.path.isdir(args.target) and not args.plan:
+         os.makedirs(args.target)
+      manifest = load_manifest(args.target, config_hash)
+
+   if args.plan:
+      plan = json.dumps(get_synchronization_plan(args.source, args.target, sf_sync_config, manifest, args.checksum), indent=3, sort_keys=True)
+      if args.plan == '-':
+         print plan
+      else:
+         with open(args.plan, 'w') as plan_file:
+            plan_file.write(plan)
+      return
+
+   if args.watch:
+      watch(args, sf_sync_config, manifest, config_hash)
+   else:
+      synchronize(args, sf_sync_config, manifest, config_hash)
+
 if __name__ == "__main__":
    main()
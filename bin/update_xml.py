@@ -15,11 +15,36 @@ from distutils.spawn import find_executable
 import os
 import xml.etree.ElementTree as ElementTree
 from io import BytesIO
+import multiprocessing
+import tempfile
+import shutil
+import hashlib
+from xml.sax.saxutils import quoteattr
+import copy_backend
 
 SCRIPT_FOLDER_PATH = os.path.dirname(os.path.realpath(__file__))
 CONFIG_PATH = '../etc'
 MERGE_CONFIGURATION = 'merge_config.json'
 DEFAULT_NAMESPACE = "http://soap.sforce.com/2006/04/metadata"
+DEFAULT_NAMESPACE_PREFIX = '{' + DEFAULT_NAMESPACE + '}'
+
+# files of this size (in megabytes) and above are merged in streaming mode
+DEFAULT_STREAMING_THRESHOLD = 8
+# namespace declarations of a serialized element
+NAMESPACE_DECLARATION = re.compile(br' xmlns(?::([^=]+))?="([^"]*)"')
+
+# local names of the qualified tags seen so far
+LOCAL_NAMES = {}
+
+# canonical form is written with the declaration and indentation of the files Salesforce retrieves
+CANONICAL_XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+CANONICAL_INDENTATION = '    '
+
+# results of merges are cached by the content of the merged files and the merge configuration,
+# least recently used entries are evicted once the cache exceeds its size (in megabytes)
+MERGE_CACHE_FOLDER = os.path.expanduser('~/.cache/update_xml')
+MERGE_CACHE_VERSION = 1
+DEFAULT_MERGE_CACHE_SIZE = 256
 
 class Color:
     BLUE = '\033[94m'
@@ -78,8 +103,11 @@ def get_root_namespace(element_tree):
    return match.group(1) if match else ''
 
 def get_element_local_name(element):
-   match = re.search('\{.*\}(.*)', element.tag)
-   return match.group(1) if match else ''
+   tag = element.tag
+   if tag not in LOCAL_NAMES:
+      match = re.search('\{.*\}(.*)', tag)
+      LOCAL_NAMES[tag] = match.group(1) if match else ''
+   return LOCAL_NAMES[tag]
 
 def write_xml(element_tree, file_path, namespaces):
    element_tree.write(file_path, xml_declaration=True, encoding="utf-8", method="xml", default_namespace=namespaces['default'])
@@ -120,49 +148,68 @@ def build_element_unique_key(element, config, namespace, unmatched_element_count
       print "Not configured: " + element_local_name
    return key
 '''
-def build_element_unique_key(element, config, namespace):
-   config_missing_count = 0
-   # default value
+# compiles the merge configuration of a metadata type into a key extractor per element name:
+# 'key-tags' - qualified tags the unique key is built from, 'exclusive' - whether they are exclusiveUniqueKeys,
+# 'parent-separator' - key values are cut at it (useParentForPrimaryKey) and 'equal-tags' - (name, qualified tag)
+# of the equalKeys or None if the elements are compared by their text
+def compile_merge_config(merge_type_config, namespace):
+   compiled_config = {}
+   for element_local_name, element_config in merge_type_config.items():
+      # elements configured with anything else than keys (e.g. an empty list) are compared by their text
+      if not isinstance(element_config, dict):
+         element_config = {}
+      if 'uniqueKeys' in element_config:
+         key_names = element_config['uniqueKeys']
+         exclusive = False
+      elif 'exclusiveUniqueKeys' in element_config:
+         # only the first list ever makes the key
+         key_names = element_config['exclusiveUniqueKeys'][0] if element_config['exclusiveUniqueKeys'] else []
+         exclusive = True
+      else:
+         key_names = []
+         exclusive = False
+      equal_tags = None
+      if element_config.get('equalKeys') is not None:
+         equal_tags = [(key, '{' + namespace + '}' + key) for key in element_config['equalKeys']]
+      compiled_config[element_local_name] = {
+         'key-tags': ['{' + namespace + '}' + key for key in key_names],
+         'exclusive': exclusive,
+         'parent-separator': element_config.get('useParentForPrimaryKey') if not exclusive else None,
+         'equal-tags': equal_tags}
+   return compiled_config
+
+# the key is a tuple of the element name and the key values, (element name,) for elements without a key
+# a missing key value following a present one is kept as an empty value
+def build_element_unique_key(element, config):
    element_local_name = get_element_local_name(element)
-   key = None
-   if element_local_name in config:
-      element_config = config[element_local_name]
-      if('uniqueKeys' in element_config):
-         for uniqueKey in element_config['uniqueKeys']:
-            key_element = element.find('{' + namespace  + '}' + uniqueKey)
-            if(key_element is not None and key_element.text):
-               if key is None:
-                  key = '#' + element_local_name
-               if ('useParentForPrimaryKey' in element_config):
-                  key = key + "#" + key_element.text.split(element_config['useParentForPrimaryKey'])[0]
-               else:
-                  key = key + "#" + key_element.text
-            elif(key is not None):
-               key = key + '#'
-      elif('exclusiveUniqueKeys' in  element_config):
-         for exclusiveUniqueKeyList in element_config['exclusiveUniqueKeys']:
-            for exlusiveUniqueKey in exclusiveUniqueKeyList:
-               key_element = element.find('{' + namespace  + '}' +exlusiveUniqueKey)
-               if(key_element is not None and key_element.text):
-                  if key is None:
-                     key = ''
-                  key = key + "#" + element_local_name + '#' + key_element.text
-            # we already have a unique key we can return
-            if(key != element_local_name):
-               break;
-
-   if(key is None):
-     key = get_element_local_name(element) + "#" + str(config_missing_count) + "#"
-     config_missing_count = config_missing_count + 1
-
-   return key
+   element_config = config.get(element_local_name)
+   if element_config is None:
+      return (element_local_name,)
+
+   values = []
+   separator = element_config['parent-separator']
+   for key_tag in element_config['key-tags']:
+      key_element = element.find(key_tag)
+      if key_element is not None and key_element.text:
+         values.append(key_element.text if separator is None else key_element.text.split(separator)[0])
+      elif values and not element_config['exclusive']:
+         values.append('')
+   return (element_local_name,) + tuple(values)
+
+# key as it's reported
+def format_element_key(key, config):
+   if len(key) == 1:
+      return key[0] + "#0#"
+   if config[key[0]]['exclusive']:
+      return ''.join('#' + key[0] + '#' + value for value in key[1:])
+   return '#' + key[0] + ''.join('#' + value for value in key[1:])
 
 def load_base_xml_file(element_tree, config, namespace, unmatched_element_count):
    xml_dict = {}
    root = element_tree.getroot()
    for child in root:
       #child_key = build_element_unique_key(child, config, namespace, unmatched_element_count)
-      child_key = build_element_unique_key(child, config, namespace)
+      child_key = build_element_unique_key(child, config)
 
       # if child_key is None then ignore the element
       if(child_key is not None):
@@ -170,53 +217,81 @@ def load_base_xml_file(element_tree, config, namespace, unmatched_element_count)
 
    return xml_dict
 
-def update_base_xml(base_xml, base_xml_dict, element_tree, config, namespace, unmatched_element_count):
+# messages are collected in the log if given (parallel merges), printed otherwise
+def report(message, log = None):
+   if log is None:
+      print(message)
+   else:
+      log.append(message)
+
+# statistics - if given, element type -> counts of the updated, appended and unchanged elements are collected there
+def update_base_xml(base_xml, base_xml_dict, element_tree, config, namespace, unmatched_element_count, log = None, statistics = None):
    xml_dict = {}
    root = element_tree.getroot()
    for child in root:
       #child_key = build_element_unique_key(child, config, namespace, unmatched_element_count)
-      child_key = build_element_unique_key(child, config, namespace)
+      child_key = build_element_unique_key(child, config)
 
       exists_in_base = key_exists_in_dict(base_xml_dict, child_key)
       if(exists_in_base):
          # check whether key exists and if yes and not equal then update
-         is_equal_to_base = elements_are_equal(child, base_xml_dict[child_key]['element'], config, namespace)
+         is_equal_to_base = elements_are_equal(child, base_xml_dict[child_key]['element'], config, log)
          if not is_equal_to_base:
-            print('Updating element with key: ' + child_key)
+            report('Updating element with key: ' + format_element_key(child_key, config), log)
             base_xml_dict[child_key]['element'].text = child.text
+         add_element_statistics(statistics, child_key[0], 'unchanged' if is_equal_to_base else 'updated')
       else:
          # default value
          # add new value if doesn't exist
-         print('Appending new element ' + child_key)
+         report('Appending new element ' + format_element_key(child_key, config), log)
          base_xml.getroot().append(child)
          is_equal_to_base = False
+         add_element_statistics(statistics, child_key[0], 'appended')
 
       xml_dict[child_key] = {'element-type': get_element_local_name(child), 'element': child, 'existsInBase': exists_in_base, 'isEqualToBase': is_equal_to_base}
    return xml_dict
 
+# changes counted per element type, removed elements and conflicts only occur in three-way merges
+ELEMENT_CHANGES = ['updated', 'appended', 'removed', 'unchanged', 'conflicts']
+
+def add_element_statistics(statistics, element_type, change):
+   if statistics is not None:
+      if element_type not in statistics:
+         statistics[element_type] = dict((element_change, 0) for element_change in ELEMENT_CHANGES)
+      statistics[element_type][change] += 1
+
+def has_changes(statistics):
+   return any(counts['updated'] or counts['appended'] or counts['removed'] for counts in statistics.values())
+
+# the merge didn't change the base, it's copied to the output unless the output is the base itself
+# a hard linked output (e.g. a tree written by clean_sf_metadata.py --target) is replaced rather than written through
+# in canonical form the base is written in canonical form instead, as it may not be in it yet
+def copy_unchanged_base(base_file, output_file, merge_keys = None, canonical = False):
+   if canonical:
+      write_merged_xml(ElementTree.parse(base_file), output_file, merge_keys, True)
+   elif not (os.path.exists(output_file) and os.path.samefile(base_file, output_file)):
+      copy_backend.copy_file(base_file, output_file, preserve = False)
+
 def key_exists_in_dict(xml_dict, key):
    if key in xml_dict:
       return True
    else:
       return False
 
-def elements_are_equal(element1, element2, config, namespace):
+def elements_are_equal(element1, element2, config, log = None):
    if(element1 is None or element2 is None):
       return False
 
    element_local_name = get_element_local_name(element1)
-   if element_local_name in config:
-      config = config[element_local_name]
+   equal_tags = config[element_local_name]['equal-tags'] if element_local_name in config else None
 
-   if 'equalKeys' in config and config['equalKeys'] is not None:
+   if equal_tags is not None:
       change = False
-      for key in config['equalKeys']:
-         #print('--> ' + key + ', ' + element2.find('{' + namespace + '}' + key).text + ', ' + element1.find('{' + namespace + '}' + key).text)
-         #print "--->" + key
-         element2_key = element2.find('{' + namespace + '}' + key)
-         element1_key = element1.find('{' + namespace + '}' + key)
+      for key, key_tag in equal_tags:
+         element2_key = element2.find(key_tag)
+         element1_key = element1.find(key_tag)
          if(element2_key is not None and element1_key is not None and element2_key.text != element1_key.text):
-            print('Updating value: ' + element2_key.text + ' with ' + element1_key.text + ' for element: ' + element_local_name)
+            report('Updating value: ' + element2_key.text + ' with ' + element1_key.text + ' for element: ' + element_local_name, log)
             element2_key.text = element1_key.text
             change = True
          elif(element1_key is not None and element2_key is None):
@@ -237,19 +312,547 @@ def sort_xml(tree):
    root = tree.getroot()
    root[:] = sorted(root, key=get_tag)
 
+# canonical form - top-level elements sorted by tag and unique key (elements of the same key keep their order) and
+# the whitespace between elements replaced by the Salesforce indentation, so the same content is always written
+# byte for byte the same way
+def canonicalize_xml(tree, merge_keys):
+   root = tree.getroot()
+   root[:] = sorted(root, key=lambda element: (element.tag, build_element_unique_key(element, merge_keys)))
+   indent_element(root, 0)
+
+# texts of elements without children are values and kept as they are
+def indent_element(element, level):
+   if len(element):
+      element.text = '\n' + CANONICAL_INDENTATION * (level + 1)
+      for child in element:
+         indent_element(child, level + 1)
+         child.tail = '\n' + CANONICAL_INDENTATION * (level + 1)
+      element[-1].tail = '\n' + CANONICAL_INDENTATION * level
+
+# sorted by tag or in canonical form
+# the output is written to a temporary file replacing it, so files hard linked to the output are left untouched
+def write_merged_xml(tree, output_file, merge_keys, canonical = False):
+   temp_output_file = output_file + '.tmp'
+   if canonical:
+      canonicalize_xml(tree, merge_keys)
+      with open(temp_output_file, 'wb') as output:
+         output.write(CANONICAL_XML_DECLARATION.encode('utf-8'))
+         tree.write(output, encoding="UTF-8", xml_declaration = False)
+         output.write(b'\n')
+   else:
+      sort_xml(tree)
+      tree.write(temp_output_file, encoding="UTF-8", xml_declaration = True)
+   os.rename(temp_output_file, output_file)
+
+# merges the update xmls one after another into the base xml and writes the result to the output file
+# the base is indexed, sorted and written once, the result is the same as of merging the updates one by one
+# merge_keys - merge configuration of the metadata type compiled by compile_merge_config
+# the output is written only if an element was updated or appended, in canonical form it's always written (the base
+# may not be canonical yet), returns the element statistics
+def merge_xml_files(base_file, update_files, output_file, merge_keys, log = None, canonical = False):
+   # base xml
+   base_xml = ElementTree.parse(base_file)
+   unmatched_base_element_count = 0
+   base_xml_dict = load_base_xml_file(base_xml, merge_keys, DEFAULT_NAMESPACE, unmatched_base_element_count)
+
+   statistics = {}
+   for update_file in update_files:
+      # update xml
+      update_xml = ElementTree.parse(update_file)
+      unmatched_update_element_count = 0
+      xml_dict = update_base_xml(base_xml, base_xml_dict, update_xml, merge_keys, DEFAULT_NAMESPACE, unmatched_update_element_count, log, statistics)
+
+      # the appended elements are the base of the next update, the last one of the duplicate keys as in load_base_xml_file
+      for key, entry in xml_dict.items():
+         if not entry['existsInBase']:
+            base_xml_dict[key] = {'element-type': entry['element-type'], 'element': entry['element']}
+
+   if has_changes(statistics) or canonical:
+      write_merged_xml(base_xml, output_file, merge_keys, canonical)
+   else:
+      copy_unchanged_base(base_file, output_file)
+   return statistics
+
+# three-way merge - the base, the update and their common ancestor are indexed by unique key and only the keys
+# the update changed since the ancestor are applied to the base:
+# - keys the update left as they were in the ancestor are kept as they are in the base
+# - keys the base left as they were are updated, appended or removed as in the update
+# - keys both changed the same way are kept, keys both changed differently are conflicts and keep the base
+# elements are compared by their tags, attributes and trimmed texts, so indentation doesn't make a change
+# returns the element statistics and the conflicts (element type, key, kind and the differing values)
+def merge_xml_files_three_way(base_file, update_file, ancestor_file, output_file, merge_keys, log = None, canonical = False):
+   base_xml = ElementTree.parse(base_file)
+   base_root = base_xml.getroot()
+   base_index = index_elements(base_root, merge_keys)
+   update_index = index_elements(ElementTree.parse(update_file).getroot(), merge_keys)
+   # a missing ancestor (e.g. a file new in both folders) is an empty one
+   ancestor_index = {}
+   if os.path.isfile(ancestor_file):
+      ancestor_index = index_elements(ElementTree.parse(ancestor_file).getroot(), merge_keys)
+
+   statistics = {}
+   conflicts = []
+   keys = list(base_index) + [key for key in update_index if key not in base_index] + [key for key in ancestor_index if key not in base_index and key not in update_index]
+   for key in keys:
+      base_element = base_index.get(key)
+      update_element = update_index.get(key)
+      ancestor_signature = get_element_signature(ancestor_index.get(key))
+      base_signature = get_element_signature(base_element)
+      update_signature = get_element_signature(update_element)
+
+      if update_signature == ancestor_signature or update_signature == base_signature:
+         if base_element is not None:
+            add_element_statistics(statistics, key[0], 'unchanged')
+      elif base_signature == ancestor_signature:
+         if update_element is None:
+            report('Removing element with key: ' + format_element_key(key, merge_keys), log)
+            remove_element(base_root, base_element)
+            add_element_statistics(statistics, key[0], 'removed')
+         elif base_element is None:
+            report('Appending new element ' + format_element_key(key, merge_keys), log)
+            base_root.append(update_element)
+            add_element_statistics(statistics, key[0], 'appended')
+         else:
+            report('Updating element with key: ' + format_element_key(key, merge_keys), log)
+            base_element.attrib = update_element.attrib
+            base_element.text = update_element.text
+            base_element[:] = list(update_element)
+            add_element_statistics(statistics, key[0], 'updated')
+      else:
+         conflict = get_conflict(key, merge_keys, ancestor_index.get(key), base_element, update_element)
+         report(color_string('Conflict on element with key: ' + conflict['key'] + ' (' + conflict['kind'] + '), keeping the base', Color.RED), log)
+         conflicts.append(conflict)
+         add_element_statistics(statistics, key[0], 'conflicts')
+
+   if has_changes(statistics) or canonical:
+      write_merged_xml(base_xml, output_file, merge_keys, canonical)
+   else:
+      copy_unchanged_base(base_file, output_file)
+   return statistics, conflicts
+
+# unique key -> element, the last one of the duplicate keys like in load_base_xml_file
+def index_elements(root, merge_keys):
+   return dict((build_element_unique_key(child, merge_keys), child) for child in root)
+
+def get_element_signature(element):
+   if element is None:
+      return None
+   return (element.tag, sorted(element.attrib.items()), (element.text or '').strip(), [get_element_signature(child) for child in element])
+
+# removes the element, its tail is kept for what followed it
+def remove_element(root, element):
+   index = list(root).index(element)
+   if index > 0:
+      root[index - 1].tail = element.tail
+   root.remove(element)
+
+# kind - changed/changed, removed/changed, changed/removed or added/added (base/update)
+# values - child element -> {ancestor, base, update} value of the child elements with a different value
+def get_conflict(key, merge_keys, ancestor_element, base_element, update_element):
+   if ancestor_element is None:
+      kind = 'added/added'
+   elif base_element is None:
+      kind = 'removed/changed'
+   elif update_element is None:
+      kind = 'changed/removed'
+   else:
+      kind = 'changed/changed'
+
+   versions = [('ancestor', get_element_values(ancestor_element)), ('base', get_element_values(base_element)), ('update', get_element_values(update_element))]
+   values = {}
+   for name in sorted(set(name for version, element_values in versions for name in element_values)):
+      child_values = dict((version, element_values.get(name)) for version, element_values in versions)
+      if child_values['base'] != child_values['update']:
+         values[name] = child_values
+   return {'element-type': key[0], 'key': format_element_key(key, merge_keys), 'kind': kind, 'values': values}
+
+# child element name -> trimmed text (texts of repeated children are joined), the element text for elements
+# without children
+def get_element_values(element):
+   values = {}
+   if element is None:
+      return values
+   if len(element) == 0:
+      values[get_element_local_name(element)] = (element.text or '').strip()
+   for child in element:
+      name = get_element_local_name(child)
+      # encoding='unicode' isn't known to python 2
+      text = (child.text or '').strip() if len(child) == 0 else ElementTree.tostring(child, encoding='utf-8').decode('utf-8').strip()
+      values[name] = values[name] + '\n' + text if name in values else text
+   return values
+
+# same result as merge_xml_files but both files are parsed incrementally and only the index of the base
+# (unique key -> position of the serialized element in a temporary spill file) is kept in memory:
+# - the base elements are spilled in their order and indexed
+# - every update element is merged into its spilled base element, which is spilled again, or spilled as a new one
+# - the spilled elements are written sorted by tag (base elements first) like sort_xml does
+# the update files are merged one after another, elements appended by an update are the base of the next ones
+# in canonical form the elements are indented as they are spilled and written sorted by tag and unique key
+def merge_xml_files_streaming(base_file, update_files, output_file, merge_keys, log = None, canonical = False):
+   spill = {'file': tempfile.TemporaryFile(), 'namespaces': set(), 'canonical': canonical}
+   statistics = {}
+   try:
+      base_roots = []
+      base_records = []
+      base_keys = []
+      base_index = {}
+      for element in iterparse_top_level_elements(base_file, base_roots):
+         key = build_element_unique_key(element, merge_keys)
+         base_index[key] = len(base_records)
+         base_records.append(spill_element(spill, element))
+         base_keys.append(key)
+
+      for update_file in update_files:
+         new_index = {}
+         for element in iterparse_top_level_elements(update_file, []):
+            key = build_element_unique_key(element, merge_keys)
+            if key in base_index:
+               # check whether key exists and if yes and not equal then update
+               base_element = read_spilled_element(spill, base_records[base_index[key]])
+               if not elements_are_equal(element, base_element, merge_keys, log):
+                  report('Updating element with key: ' + format_element_key(key, merge_keys), log)
+                  base_element.text = element.text
+                  base_records[base_index[key]] = spill_element(spill, base_element)
+                  add_element_statistics(statistics, key[0], 'updated')
+               else:
+                  add_element_statistics(statistics, key[0], 'unchanged')
+            else:
+               # add new value if doesn't exist, new elements follow the base ones of the same tag
+               report('Appending new element ' + format_element_key(key, merge_keys), log)
+               new_index[key] = len(base_records)
+               base_records.append(spill_element(spill, element))
+               base_keys.append(key)
+               add_element_statistics(statistics, key[0], 'appended')
+         base_index.update(new_index)
+
+      # an unchanged base is written as well in canonical form, its spilled elements are indented already
+      if has_changes(statistics) or canonical:
+         base_root = base_roots[0]
+         if canonical:
+            records = [base_records[index] for index in sorted(range(len(base_records)), key=lambda index: (base_records[index][0], base_keys[index]))]
+         else:
+            records = sorted(base_records, key=lambda record: record[0])
+         write_spilled_xml(output_file, base_root, records, spill)
+      else:
+         copy_unchanged_base(base_file, output_file)
+   finally:
+      spill['file'].close()
+   return statistics
+
+# the spilled xml is written with the root in the Salesforce namespace, files with roots of other namespaces (or of
+# no namespace) are merged in memory
+def is_streaming_supported(file_path):
+   with open(file_path, 'rb') as xml_file:
+      for event, element in ElementTree.iterparse(xml_file, events=('start',)):
+         return element.tag.startswith(DEFAULT_NAMESPACE_PREFIX)
+   return False
+
+# yields the top-level elements of the xml once they are complete (including their tail) and releases them
+# afterwards, the root is added to the roots list as soon as it starts
+def iterparse_top_level_elements(file_path, roots):
+   depth = 0
+   pending_element = None
+   for event, element in ElementTree.iterparse(file_path, events=('start', 'end')):
+      if event == 'start':
+         depth += 1
+         if depth == 1:
+            roots.append(element)
+         elif depth == 2 and pending_element is not None:
+            yield pending_element
+            roots[0].remove(pending_element)
+            pending_element = None
+      else:
+         depth -= 1
+         if depth == 1:
+            pending_element = element
+         elif depth == 0 and pending_element is not None:
+            yield pending_element
+            roots[0].remove(pending_element)
+
+# appends the element serialized as it's written out and its tail to the spill file, returns (tag, offset,
+# element length, length)
+# namespaces the element declares are collected to be declared on the root once
+def spill_element(spill, element):
+   if spill['canonical']:
+      indent_element(element, 1)
+   parts = []
+   if append_plain_element(element, parts):
+      serialized_element = ''.join(parts).encode('utf-8')
+   else:
+      tail = element.tail
+      element.tail = None
+      serialized_element = ElementTree.tostring(element, encoding='utf-8')
+      element.tail = tail
+      start_tag_end = serialized_element.index(b'>')
+      for prefix, uri in NAMESPACE_DECLARATION.findall(serialized_element[:start_tag_end]):
+         spill['namespaces'].add((prefix.decode('utf-8'), uri.decode('utf-8')))
+      serialized_element = NAMESPACE_DECLARATION.sub(b'', serialized_element[:start_tag_end]) + serialized_element[start_tag_end:]
+   serialized_tail = element.tail.encode('utf-8') if element.tail else b''
+
+   spill_file = spill['file']
+   spill_file.seek(0, os.SEEK_END)
+   offset = spill_file.tell()
+   spill_file.write(serialized_element + serialized_tail)
+   return (element.tag, offset, len(serialized_element), len(serialized_element) + len(serialized_tail))
+
+def read_spilled_bytes(spill, record):
+   spill_file = spill['file']
+   spill_file.seek(record[1])
+   return spill_file.read(record[3])
+
+# serializes elements of the default namespace without attributes the way ElementTree does, a lot faster
+# returns False for any other element
+def append_plain_element(element, parts):
+   if element.attrib or not element.tag.startswith(DEFAULT_NAMESPACE_PREFIX):
+      return False
+   local_name = element.tag[len(DEFAULT_NAMESPACE_PREFIX):]
+   if element.text or len(element):
+      parts.append('<' + local_name + '>')
+      if element.text:
+         parts.append(escape_text(element.text))
+      for child in element:
+         if not append_plain_element(child, parts):
+            return False
+         if child.tail:
+            parts.append(escape_text(child.tail))
+      parts.append('</' + local_name + '>')
+   else:
+      parts.append('<' + local_name + ' />')
+   return True
+
+# spilled elements don't declare namespaces, they are parsed within a root declaring all of them
+def read_spilled_element(spill, record):
+   serialized_element = read_spilled_bytes(spill, record)
+   if spill.get('root-namespaces') != spill['namespaces']:
+      spill['root-namespaces'] = set(spill['namespaces'])
+      spill['root-start-tag'] = ('<root' + get_namespace_declarations(spill['namespaces']) + '>').encode('utf-8')
+   element = ElementTree.fromstring(spill['root-start-tag'] + serialized_element[:record[2]] + b'</root>')[0]
+   element.tail = serialized_element[record[2]:].decode('utf-8') or None
+   return element
+
+# writes the xml the way ElementTree does, namespaces are declared on the root only
+# in canonical form the spilled tails are replaced by the indentation like write_merged_xml does
+def write_spilled_xml(output_file, root, records, spill):
+   temp_output_file = output_file + '.tmp'
+   with open(temp_output_file, 'wb') as output:
+      if spill['canonical']:
+         start_tag = CANONICAL_XML_DECLARATION
+      else:
+         start_tag = "<?xml version='1.0' encoding='UTF-8'?>\n"
+      start_tag += '<' + get_element_local_name(root) + get_namespace_declarations(spill['namespaces'])
+      for name, value in root.items():
+         start_tag += ' ' + name + '=' + quoteattr(value)
+      if not records and not root.text:
+         output.write((start_tag + ' />').encode('utf-8'))
+      elif spill['canonical'] and records:
+         output.write((start_tag + '>\n' + CANONICAL_INDENTATION).encode('utf-8'))
+         for index, record in enumerate(records):
+            output.write(read_spilled_bytes(spill, record)[:record[2]])
+            output.write(('\n' + CANONICAL_INDENTATION if index < len(records) - 1 else '\n').encode('utf-8'))
+         output.write(('</' + get_element_local_name(root) + '>').encode('utf-8'))
+      else:
+         output.write((start_tag + '>' + escape_text(root.text or '')).encode('utf-8'))
+         for record in records:
+            output.write(read_spilled_bytes(spill, record))
+         output.write(('</' + get_element_local_name(root) + '>').encode('utf-8'))
+      if spill['canonical']:
+         output.write(b'\n')
+   os.rename(temp_output_file, output_file)
+
+# the default namespace and the given (prefix, uri) namespaces ordered by prefix like ElementTree does
+def get_namespace_declarations(namespaces):
+   declarations = ''
+   for prefix, uri in sorted(namespaces | set([('', DEFAULT_NAMESPACE)])):
+      declarations += ' xmlns' + (':' + prefix if prefix else '') + '=' + quoteattr(uri)
+   return declarations
+
+def escape_text(text):
+   return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def get_file_hash(file_path):
+   hasher = hashlib.sha1()
+   with open(file_path, 'rb') as input_file:
+      for chunk in iter(lambda: input_file.read(1024 * 1024), b''):
+         hasher.update(chunk)
+   return hasher.hexdigest()
+
+# cache salt - merge configuration and output form, the same files merged with the same salt give the same result
+def get_merge_cache_key(cache_salt, base_file, update_files, ancestor_file = None):
+   file_hashes = [get_file_hash(base_file)] + [get_file_hash(update_file) for update_file in update_files]
+   if ancestor_file is not None:
+      file_hashes.append(get_file_hash(ancestor_file) if os.path.isfile(ancestor_file) else None)
+   return hashlib.sha1(json.dumps([cache_salt, file_hashes]).encode('utf-8')).hexdigest()
+
+# cache entry - <key>.json with the messages and the summary of the merge, <key>.xml with the result if the merge
+# changed the base
+# the result is copied to the output (an unchanged base is kept, or written in canonical form if canonical) and the
+# entry is returned, None if there is none
+def load_cached_merge(cache_key, base_file, output_file, merge_keys, canonical = False):
+   entry_path = MERGE_CACHE_FOLDER + '/' + cache_key + '.json'
+   if not os.path.isfile(entry_path):
+      return None
+   try:
+      with open(entry_path) as entry_file:
+         entry = json.load(entry_file)
+      if entry['changed']:
+         result_path = MERGE_CACHE_FOLDER + '/' + cache_key + '.xml'
+         shutil.copyfile(result_path, output_file + '.tmp')
+         os.rename(output_file + '.tmp', output_file)
+         os.utime(result_path, None)
+      else:
+         copy_unchanged_base(base_file, output_file, merge_keys, canonical)
+      # used by the subsequent runs, least recently used entries are evicted first
+      os.utime(entry_path, None)
+      return entry
+   except (IOError, OSError, ValueError, KeyError):
+      return None
+
+# worker processes may save the same entry (files of the same content) and create the folder at the same time,
+# so temporary files are per process and an existing folder is fine
+def save_cached_merge(cache_key, output_file, log, summary):
+   entry_path = MERGE_CACHE_FOLDER + '/' + cache_key + '.json'
+   temp_suffix = '.tmp.' + str(os.getpid())
+   try:
+      if not os.path.isdir(MERGE_CACHE_FOLDER):
+         try:
+            os.makedirs(MERGE_CACHE_FOLDER)
+         except OSError:
+            if not os.path.isdir(MERGE_CACHE_FOLDER):
+               raise
+      if summary['changed']:
+         result_path = MERGE_CACHE_FOLDER + '/' + cache_key + '.xml'
+         shutil.copyfile(output_file, result_path + temp_suffix)
+         os.rename(result_path + temp_suffix, result_path)
+      entry = {'log': log, 'changed': summary['changed'], 'elements': summary['elements'], 'conflicts': summary.get('conflicts')}
+      with open(entry_path + temp_suffix, 'w') as entry_file:
+         json.dump(entry, entry_file)
+      os.rename(entry_path + temp_suffix, entry_path)
+   except (IOError, OSError):
+      return False
+   return True
+
+# removes the least recently used entries until the cache fits the size in bytes
+# returns the number of removed entries and the size of the cache
+def evict_merge_cache(cache_size):
+   if not os.path.isdir(MERGE_CACHE_FOLDER):
+      return 0, 0
+   entries = []
+   total_size = 0
+   for name in os.listdir(MERGE_CACHE_FOLDER):
+      if name.endswith('.json'):
+         entry_path = MERGE_CACHE_FOLDER + '/' + name
+         result_path = entry_path[:-len('.json')] + '.xml'
+         try:
+            entry_size = os.path.getsize(entry_path) + (os.path.getsize(result_path) if os.path.isfile(result_path) else 0)
+            entries.append((os.path.getmtime(entry_path), entry_path, result_path, entry_size))
+         except OSError:
+            continue
+         total_size += entry_size
+
+   evicted_entries = 0
+   for modified, entry_path, result_path, entry_size in sorted(entries):
+      if total_size <= cache_size:
+         break
+      try:
+         os.remove(entry_path)
+         if os.path.isfile(result_path):
+            os.remove(result_path)
+      except OSError:
+         continue
+      total_size -= entry_size
+      evicted_entries += 1
+   return evicted_entries, total_size
+
+# task of a worker process - (base file, update files, output file, ancestor file or None, merge keys, streaming
+# threshold in bytes, canonical, cache salt or None if the merge cache isn't used), there is a single update file
+# along with an ancestor
+# returns the messages of the merge, the error message if it failed and the summary of the merge
+def merge_xml_files_task(task):
+   log = []
+   summary = {'base': task[0], 'updates': task[1], 'output': task[2], 'changed': False, 'cached': False, 'elements': {}}
+   if task[3] is not None:
+      summary['ancestor'] = task[3]
+   try:
+      # the key is taken before the merge as the output can be the base
+      cache_key = None
+      if task[7] is not None:
+         cache_key = get_merge_cache_key(task[7], task[0], task[1], task[3])
+         entry = load_cached_merge(cache_key, task[0], task[2], task[4], task[6])
+         if entry is not None:
+            summary.update({'changed': entry['changed'], 'cached': True, 'elements': entry['elements']})
+            if entry['conflicts'] is not None:
+               summary['conflicts'] = entry['conflicts']
+            return entry['log'], None, summary
+
+      if task[3] is not None:
+         # three-way merges are done in memory
+         summary['elements'], summary['conflicts'] = merge_xml_files_three_way(task[0], task[1][0], task[3], task[2], task[4], log, task[6])
+      elif (task[5] is not None and max(os.path.getsize(file_path) for file_path in [task[0]] + task[1]) >= task[5] and
+            all(is_streaming_supported(file_path) for file_path in [task[0]] + task[1])):
+         summary['elements'] = merge_xml_files_streaming(task[0], task[1], task[2], task[4], log, task[6])
+      else:
+         summary['elements'] = merge_xml_files(task[0], task[1], task[2], task[4], log, task[6])
+   except (ElementTree.ParseError, IOError, OSError) as e:
+      return log, 'Merge of ' + ', '.join(task[1]) + ' into ' + task[0] + ' failed: ' + str(e), None
+   summary['changed'] = has_changes(summary['elements'])
+   if cache_key is not None and not save_cached_merge(cache_key, task[2], log, summary):
+      log = log + [color_string('Unable to write merge cache entry ' + cache_key, Color.RED)]
+   return log, None, summary
+
+# per file summaries along with the totals per element type
+def get_merge_summary(file_summaries):
+   totals = {}
+   for file_summary in file_summaries:
+      for element_type, counts in file_summary['elements'].items():
+         for change, count in counts.items():
+            if element_type not in totals:
+               totals[element_type] = dict((element_change, 0) for element_change in ELEMENT_CHANGES)
+            totals[element_type][change] += count
+   changed_files = len([file_summary for file_summary in file_summaries if file_summary['changed']])
+   conflicts = sum(len(file_summary.get('conflicts', [])) for file_summary in file_summaries)
+   return {'files': file_summaries, 'elements': totals, 'changed-files': changed_files, 'unchanged-files': len(file_summaries) - changed_files, 'conflicts': conflicts}
+
+# files of the update folders that exist in the base folder, written to the output folder or back to the base folder
+# a file is merged with the files of the same name of all the update folders in their order
+# with an ancestor folder the files of the same name there are their ancestors
+def get_folder_merge_pairs(base_folder, update_folders, output_folder = None, ancestor_folder = None):
+   pairs = []
+   names = sorted(set(name for update_folder in update_folders for name in os.listdir(update_folder)))
+   for name in names:
+      update_files = [update_folder + '/' + name for update_folder in update_folders if os.path.isfile(update_folder + '/' + name)]
+      base_file = base_folder + '/' + name
+      if update_files and os.path.isfile(base_file):
+         pairs.append((base_file, update_files, (output_folder or base_folder) + '/' + name, ancestor_folder + '/' + name if ancestor_folder else None))
+   return pairs
+
+# manifest lines - base file, update file and optionally output and ancestor file separated by tabs
+def get_manifest_merge_pairs(manifest_file):
+   pairs = []
+   for line in manifest_file:
+      line = line.rstrip('\r\n')
+      if line:
+         files = line.split('\t')
+         if len(files) not in (2, 3, 4):
+            raise SystemExit('Invalid manifest line ' + color_string(line, Color.RED) + ', expected base, update and optionally output and ancestor file separated by tabs')
+         pairs.append((files[0], [files[1]], files[2] if len(files) >= 3 and files[2] else files[0], files[3] if len(files) == 4 and files[3] else None))
+   return pairs
+
 def main():
    parser = argparse.ArgumentParser(description='Merges Salesforce XML files. Currently profiles and custom objects are supported.\n' +
+                                                'Base and update can be folders, all files of the update folder that exist in the base folder are merged then.\n' +
+                                                'Several updates are merged into the base one after another, the base is written once.\n' +
                                                 'Example:\n' +
-                                                '\t' + os.path.basename(__file__),
+                                                '\t' + os.path.basename(__file__) + ' -m profiles base/profiles update/profiles\n' +
+                                                '\t' + os.path.basename(__file__) + ' -m profiles -o release/profiles base/profiles item1/profiles item2/profiles',
 						formatter_class=RawTextHelpFormatter)
 
    parser.add_argument(
-        "base",
-        help="Original XML")
+        "base", nargs='?',
+        help="Original XML (or folder)")
 
    parser.add_argument(
-        "update",
-        help="Update XML")
+        "updates", nargs='*', metavar='update',
+        help="Update XML (or folder), several are merged in the given order")
 
    parser.add_argument(
         "-d", "--debug", dest="debug",
@@ -257,21 +860,86 @@ def main():
 
    parser.add_argument(
         "-o", "--output", dest="output",
-        help="Output file")
+        help="Output file (or folder)")
 
    parser.add_argument(
         "-m", "--mode", dest="mode",
         help="Mode", default='profiles')
 
+   parser.add_argument(
+        "--manifest", dest="manifest",
+        help="File with the files to be merged ('-' for standard input) instead of base and update,\n" +
+             "one merge per line - base, update and optionally output and ancestor file separated by tabs")
+
+   parser.add_argument(
+        "-a", "--ancestor", dest="ancestor",
+        help="Common ancestor XML (or folder) of base and update for a three-way merge - only elements the update\n" +
+             "changed since the ancestor are applied and elements both changed differently are reported as conflicts")
+
+   parser.add_argument(
+        "-j", "--jobs", dest="jobs", type=int, default=1,
+        help="Number of parallel merge workers (default: 1)")
+
+   parser.add_argument(
+        "--summary", dest="summary",
+        help="Writes counts of updated, appended and unchanged elements per element type and file as json to the path\n" +
+             "('-' prints it after the merge messages)")
+
+   parser.add_argument(
+        "--canonical", dest="canonical",
+        help="Writes the merged files in canonical form - elements sorted by tag and unique key and indented the way\n" +
+             "Salesforce does, so the same content always results in the same file", action="store_true")
+
+   parser.add_argument(
+        "--no-cache", dest="no_cache",
+        help="Merges all files, ignoring and not updating the merge cache (" + MERGE_CACHE_FOLDER + ")", action="store_true")
+
+   parser.add_argument(
+        "--cache-size", dest="cache_size", type=float, default=DEFAULT_MERGE_CACHE_SIZE,
+        help="Size of the merge cache in MB, least recently used results are evicted (default: " + str(DEFAULT_MERGE_CACHE_SIZE) + ")")
+
+   parser.add_argument(
+        "--streaming-threshold", dest="streaming_threshold", type=float, default=DEFAULT_STREAMING_THRESHOLD,
+        help="Files of this size in MB and above are merged incrementally, keeping only an index of the base in memory\n" +
+             "(default: " + str(DEFAULT_STREAMING_THRESHOLD) + ", 0 streams all files)")
+
    args = parser.parse_args()
 
-   # check if the xml files provided exist
-   if not os.path.isfile(args.base):
-      raise SystemExit(('Base XML ' + color_string('{}', Color.RED) + ' doesn\'t exist!').format(args.base))
+   if(args.jobs < 1):
+      parser.error("--jobs must be at least 1")
 
-   if not os.path.isfile(args.update):
-      raise SystemExit(('Update XML ' + color_string('{}', Color.RED) + ' doesn\'t exist!').format(args.update))
+   if args.manifest:
+      if args.base or args.updates or args.ancestor:
+         parser.error("base, update and --ancestor can't be used along with --manifest")
+      if args.manifest == '-':
+         pairs = get_manifest_merge_pairs(sys.stdin)
+      else:
+         with open(args.manifest) as manifest_file:
+            pairs = get_manifest_merge_pairs(manifest_file)
+   else:
+      if not args.base or not args.updates:
+         parser.error("base and update are required unless --manifest is used")
+      if args.ancestor and len(args.updates) > 1:
+         parser.error("--ancestor can be used along with a single update only")
+      if os.path.isdir(args.base) and all(os.path.isdir(update) for update in args.updates):
+         if args.output and not os.path.isdir(args.output):
+            os.makedirs(args.output)
+         pairs = get_folder_merge_pairs(args.base, args.updates, args.output, args.ancestor)
+      else:
+         # check if the xml files provided exist
+         if not os.path.isfile(args.base):
+            raise SystemExit(('Base XML ' + color_string('{}', Color.RED) + ' doesn\'t exist!').format(args.base))
 
+         for update in args.updates:
+            if not os.path.isfile(update):
+               raise SystemExit(('Update XML ' + color_string('{}', Color.RED) + ' doesn\'t exist!').format(update))
+
+         if args.ancestor and not os.path.isfile(args.ancestor):
+            raise SystemExit(('Ancestor XML ' + color_string('{}', Color.RED) + ' doesn\'t exist!').format(args.ancestor))
+
+         pairs = [(args.base, args.updates, args.output or args.base, args.ancestor)]
+
+   # the configuration is loaded once for all merges
    merge_config_path = SCRIPT_FOLDER_PATH + '/' + CONFIG_PATH + '/' + MERGE_CONFIGURATION
    with open(merge_config_path) as json_merge_config_file:
       merge_config = json.load(json_merge_config_file)
@@ -284,28 +952,51 @@ def main():
    # default namespace
    ElementTree.register_namespace('', DEFAULT_NAMESPACE)
 
-   # base xml
-   base_xml = ElementTree.parse(args.base)
-   #base_namespaces = {'default': get_root_namespace(base_xml)}
-
-   unmatched_base_element_count = 0
-   base_xml_dict = load_base_xml_file(base_xml, merge_type_config, DEFAULT_NAMESPACE, unmatched_base_element_count)
-   # print(load_base_xml_file(base_xml, profile_config, base_namespaces))
-
-   # update xml
-   update_xml = ElementTree.parse(args.update)
-   #update_xml_namespaces = {'default': get_root_namespace(update_xml)}
-   unmatched_update_element_count = 0
-   update_base_xml(base_xml, base_xml_dict, update_xml, merge_type_config, DEFAULT_NAMESPACE, unmatched_update_element_count)
-
-   if args.output:
-      output_file = args.output
+   # key extractors are compiled once for all merges
+   merge_keys = compile_merge_config(merge_type_config, DEFAULT_NAMESPACE)
+   # the results depend on the configuration of the mode and the output form
+   cache_salt = None
+   if not args.no_cache:
+      cache_salt = json.dumps([MERGE_CACHE_VERSION, merge_type_config, args.canonical], sort_keys=True)
+   tasks = [pair + (merge_keys, int(args.streaming_threshold * 1024 * 1024), args.canonical, cache_salt) for pair in pairs]
+   if args.jobs > 1 and len(tasks) > 1:
+      pool = multiprocessing.Pool(min(args.jobs, len(tasks)))
+      try:
+         results = pool.map(merge_xml_files_task, tasks, len(tasks) // (args.jobs * 4) + 1)
+      finally:
+         pool.close()
+         pool.join()
    else:
-      output_file = args.base
+      results = [merge_xml_files_task(task) for task in tasks]
+
+   # messages are printed in the order of the merges, whatever worker did them
+   error_messages = []
+   file_summaries = []
+   for log, error_message, file_summary in results:
+      for message in log:
+         print(message)
+      if error_message is not None:
+         error_messages.append(error_message)
+      else:
+         file_summaries.append(file_summary)
+
+   if cache_salt is not None:
+      evicted_entries, cache_size = evict_merge_cache(int(args.cache_size * 1024 * 1024))
+      if args.debug:
+         cached_files = len([file_summary for file_summary in file_summaries if file_summary['cached']])
+         print('Merge cache: ' + str(cached_files) + ' hits, ' + str(len(file_summaries) - cached_files) + ' misses, ' +
+               str(evicted_entries) + ' evicted, ' + '%.1f of %.1f MB used' % (cache_size / 1024.0 / 1024.0, args.cache_size))
+
+   if args.summary:
+      summary = json.dumps(get_merge_summary(file_summaries), indent=3, sort_keys=True)
+      if args.summary == '-':
+         print(summary)
+      else:
+         with open(args.summary, 'w') as summary_file:
+            summary_file.write(summary)
 
-   sort_xml(base_xml)
-   base_xml.write(output_file, encoding="UTF-8", xml_declaration = True)
-   #print(ElementTree.tostring(base_xml.getroot(), encoding='UTF-8'))
+   if error_messages:
+      raise SystemExit('\n'.join(color_string(error_message, Color.RED) for error_message in error_messages))
 
 if __name__ == "__main__":
    main()
@@ -0,0 +1,12 @@
+<?xml version="1.0" encoding="UTF-8"?>
+<Profile xmlns="http://soap.sforce.com/2006/04/metadata">
+  <userPermissions>
+    <enabled>true</enabled>
+    <name>ViewSetup</name>
+  </userPermissions>
+  <custom>false</custom>
+  <userPermissions>
+    <enabled>true</enabled>
+    <name>ApiEnabled</name>
+  </userPermissions>
+</Profile>
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+# Regression tests of bin/clean_sf_metadata.py (python 2 like the script)
+# Run: python -m unittest discover -s tests
+
+import sys
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import zipfile
+from contextlib import closing
+import xml.etree.ElementTree as ElementTree
+
+TESTS_FOLDER_PATH = os.path.dirname(os.path.realpath(__file__))
+FIXTURES_FOLDER_PATH = TESTS_FOLDER_PATH + '/fixtures/clean_sf_metadata'
+sys.path.insert(0, TESTS_FOLDER_PATH + '/../bin')
+import clean_sf_metadata
+
+class StreamingCleanupTest(unittest.TestCase):
+   def setUp(self):
+      ElementTree.register_namespace('', clean_sf_metadata.DEFAULT_NAMESPACE)
+      self.temp_folder_path = tempfile.mkdtemp()
+
+   def tearDown(self):
+      shutil.rmtree(self.temp_folder_path)
+
+   # files cleaned in streaming mode (threshold of 1 byte) and in memory are the same
+   def assert_same_cleanup(self, fixture_name, element_name):
+      fixture_path = FIXTURES_FOLDER_PATH + '/' + fixture_name
+      operations = [('remove-element', element_name, (1,))]
+      with open(fixture_path, 'rb') as fixture_file:
+         expected = clean_sf_metadata.clean_content(fixture_file.read(), operations)
+      self.assertTrue(expected is not None)
+
+      file_path = self.temp_folder_path + '/' + fixture_name
+      shutil.copy(fixture_path, file_path)
+      result = clean_sf_metadata.clean_file(file_path, operations, streaming_threshold = 1)
+      self.assertEqual(result[1], None)
+      with open(file_path, 'rb') as cleaned_file:
+         self.assertEqual(cleaned_file.read(), expected)
+
+      zip_file_path = self.temp_folder_path + '/source.zip'
+      with closing(zipfile.ZipFile(zip_file_path, 'w')) as source_zip:
+         source_zip.write(fixture_path, fixture_name)
+      result = clean_sf_metadata.clean_zip_entry(zip_file_path, fixture_name, operations, 1, self.temp_folder_path + '/entry.xml')
+      self.assertEqual(result[1], None)
+      with open(self.temp_folder_path + '/entry.xml', 'rb') as cleaned_file:
+         self.assertEqual(cleaned_file.read(), expected)
+
+   def test_other_namespace_root(self):
+      self.assertFalse(clean_sf_metadata.is_streaming_supported(FIXTURES_FOLDER_PATH + '/other_namespace.xml'))
+      self.assert_same_cleanup('other_namespace.xml', 'version')
+
+   def test_prefixed_salesforce_namespace_root(self):
+      self.assertFalse(clean_sf_metadata.is_streaming_supported(FIXTURES_FOLDER_PATH + '/prefixed_namespace.xml'))
+      self.assert_same_cleanup('prefixed_namespace.xml', 'custom')
+
+   def test_salesforce_namespace_root(self):
+      self.assertTrue(clean_sf_metadata.is_streaming_supported(FIXTURES_FOLDER_PATH + '/profile.profile'))
+      self.assert_same_cleanup('profile.profile', 'userPermissions')
+
+class CleanupCacheTest(unittest.TestCase):
+   def setUp(self):
+      ElementTree.register_namespace('', clean_sf_metadata.DEFAULT_NAMESPACE)
+      self.temp_folder_path = tempfile.mkdtemp()
+      # caches of the test are kept in its temporary folder
+      for name in ['CACHE_FOLDER', 'RULES_CACHE_FOLDER', 'compile_cleanup_rules', 'clean_file_task']:
+         self.addCleanup(setattr, clean_sf_metadata, name, getattr(clean_sf_metadata, name))
+      clean_sf_metadata.CACHE_FOLDER = self.temp_folder_path + '/cache/files'
+      clean_sf_metadata.RULES_CACHE_FOLDER = self.temp_folder_path + '/cache'
+
+      # rules of the extended configuration come first
+      self.base_config_path = self.temp_folder_path + '/base_cleanup_config.json'
+      self.config_path = self.temp_folder_path + '/cleanup_config.json'
+      self.write_config(self.base_config_path, {'remove-element': {'profiles': [{'element-name': 'classAccesses'}]}})
+      self.write_config(self.config_path, {'extend': 'base_cleanup_config.json', 'remove-element': {'profiles': [{'element-name': 'custom'}]}})
+
+      self.compiled = []
+      compile_cleanup_rules = clean_sf_metadata.compile_cleanup_rules
+      def count_compilation(config_file_path):
+         self.compiled.append(config_file_path)
+         return compile_cleanup_rules(config_file_path)
+      clean_sf_metadata.compile_cleanup_rules = count_compilation
+
+      self.statuses = []
+      clean_file_task = clean_sf_metadata.clean_file_task
+      def record_status(task):
+         result = clean_file_task(task)
+         self.statuses.append(result[3])
+         return result
+      clean_sf_metadata.clean_file_task = record_status
+
+   def tearDown(self):
+      shutil.rmtree(self.temp_folder_path)
+
+   def write_config(self, config_path, config):
+      with open(config_path, 'w') as config_file:
+         json.dump(config, config_file)
+
+   def create_source(self, name):
+      source = self.temp_folder_path + '/' + name
+      os.makedirs(source + '/profiles')
+      shutil.copy(FIXTURES_FOLDER_PATH + '/profile.profile', source + '/profiles/Admin.profile')
+      return source
+
+   # cleans the source folder in place like the script does and returns the statuses of the cleaned files
+   def clean(self, source):
+      self.statuses = []
+      cleanup_rules = clean_sf_metadata.get_cleanup_rules(self.config_path)
+      cleanup_plan = clean_sf_metadata.compile_cleanup_plan(cleanup_rules, source, clean_sf_metadata.get_folder_list(source))
+      cached_files = clean_sf_metadata.load_cache(source, cleanup_plan['config-hash'])
+      clean_file_keys = clean_sf_metadata.clean_files(cleanup_plan, 1, cached_files)
+      clean_sf_metadata.save_cache(source, cleanup_plan['config-hash'], clean_file_keys)
+      return self.statuses
+
+   # files unchanged since the last cleanup with the same configuration are skipped, the cache is kept out of
+   # the source folder
+   def test_file_cache(self):
+      source = self.create_source('source')
+      with open(source + '/' + clean_sf_metadata.LEGACY_CACHE_FILE, 'w') as legacy_cache_file:
+         legacy_cache_file.write('{}')
+      self.assertEqual(self.clean(source), ['cleaned'])
+      self.assertEqual(sorted(os.listdir(source)), ['profiles'])
+      self.assertEqual(os.path.dirname(clean_sf_metadata.get_cache_path(source)), clean_sf_metadata.CACHE_FOLDER)
+      self.assertTrue(os.path.isfile(clean_sf_metadata.get_cache_path(source)))
+      self.assertEqual(self.clean(source), ['cached'])
+
+      # a changed file is cleaned again
+      shutil.copy(FIXTURES_FOLDER_PATH + '/profile.profile', source + '/profiles/Admin.profile')
+      self.assertEqual(self.clean(source), ['cleaned'])
+      self.assertEqual(self.clean(source), ['cached'])
+
+      # the cache is not valid for another configuration
+      self.write_config(self.config_path, {'extend': 'base_cleanup_config.json', 'remove-element': {'profiles': [{'element-name': 'userLicense'}]}})
+      self.assertEqual(self.clean(source), ['cleaned'])
+      with open(source + '/profiles/Admin.profile', 'rb') as cleaned_file:
+         content = cleaned_file.read()
+      for element_name in ['classAccesses', 'custom', 'userLicense']:
+         self.assertFalse(b'<' + element_name + b'>' in content)
+
+   # rules are compiled once for all source trees and again if any configuration they come from changed
+   def test_rules_cache(self):
+      for name in ['first', 'second']:
+         self.clean(self.create_source(name))
+      self.assertEqual(self.compiled, [self.config_path])
+
+      cleanup_rules = clean_sf_metadata.get_cleanup_rules(self.config_path)
+      self.assertEqual(cleanup_rules, clean_sf_metadata.compile_cleanup_rules(self.config_path))
+      cleanup_plan = clean_sf_metadata.compile_cleanup_plan(cleanup_rules, self.temp_folder_path + '/first', ['profiles'])
+      self.assertEqual(cleanup_plan['file-operations'][self.temp_folder_path + '/first/profiles/Admin.profile'],
+                       [('remove-element', 'classAccesses', ('remove-element/profiles/0',)), ('remove-element', 'custom', ('remove-element/profiles/1',))])
+
+      self.compiled = []
+      self.write_config(self.base_config_path, {'remove-element': {'profiles': [{'element-name': 'userLicense'}]}})
+      cleanup_rules = clean_sf_metadata.get_cleanup_rules(self.config_path)
+      self.assertEqual(self.compiled, [self.config_path])
+      self.assertEqual([rule[3]['element-name'] for rule in cleanup_rules['rules']], ['userLicense', 'custom'])
+      clean_sf_metadata.get_cleanup_rules(self.config_path)
+      self.assertEqual(self.compiled, [self.config_path])
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+# Tests of bin/synchronize_sf_metadata.py (python 2 like the script), the script is run with the manifests kept
+# in a temporary home folder
+# Run: python -m unittest discover -s tests
+
+import sys
+import os
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+TESTS_FOLDER_PATH = os.path.dirname(os.path.realpath(__file__))
+FIXTURES_FOLDER_PATH = TESTS_FOLDER_PATH + '/fixtures/update_xml'
+SCRIPT_PATH = TESTS_FOLDER_PATH + '/../bin/synchronize_sf_metadata.py'
+
+class SynchronizationTest(unittest.TestCase):
+   def setUp(self):
+      self.temp_folder_path = tempfile.mkdtemp()
+      self.source = self.temp_folder_path + '/source'
+      self.target = self.temp_folder_path + '/target'
+      # profiles are merged, classes are replaced
+      os.makedirs(self.source + '/profiles')
+      os.makedirs(self.source + '/classes')
+      os.makedirs(self.target + '/profiles')
+      shutil.copyfile(FIXTURES_FOLDER_PATH + '/profile_update.profile', self.source + '/profiles/Admin.profile')
+      shutil.copyfile(FIXTURES_FOLDER_PATH + '/profile_base.profile', self.target + '/profiles/Admin.profile')
+      for name in ['A', 'B']:
+         with open(self.source + '/classes/' + name + '.cls', 'w') as class_file:
+            class_file.write('public class ' + name + ' {}\n')
+
+   def tearDown(self):
+      shutil.rmtree(self.temp_folder_path)
+
+   # returns the stdout and the stderr of the script
+   def synchronize(self, *args):
+      environment = dict(os.environ, HOME=self.temp_folder_path + '/home')
+      process = subprocess.Popen([sys.executable, SCRIPT_PATH, '-s', self.source, '-t', self.target] + list(args),
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environment)
+      output, errors = process.communicate()
+      self.assertEqual(process.returncode, 0, errors)
+      return output.decode('utf-8'), errors.decode('utf-8')
+
+   def get_manifest_paths(self):
+      manifest_folder_path = self.temp_folder_path + '/home/.cache/synchronize_sf_metadata/manifests'
+      return [manifest_folder_path + '/' + name for name in sorted(os.listdir(manifest_folder_path))]
+
+   # stdout of --plan is the json plan only, diagnostics of an unreadable manifest go to stderr
+   def test_plan_output_is_json(self):
+      self.synchronize()
+      self.synchronize('-c', 'profiles_only_sync_config.json')
+      for manifest_path in self.get_manifest_paths():
+         with open(manifest_path, 'w') as manifest_file:
+            manifest_file.write('{')
+      for config in ['salesforce_metadata_sync_config.json', 'profiles_only_sync_config.json']:
+         output, errors = self.synchronize('--plan', '-c', config)
+         plan = json.loads(output)
+         self.assertTrue('Unable to read synchronization manifest' in errors)
+         self.assertEqual((plan['source'], plan['target']), (self.source, self.target))
+
+      output, errors = self.synchronize('--plan')
+      plan = json.loads(output)
+      folders = dict((folder_plan['folder'], folder_plan) for folder_plan in plan['folders'])
+      self.assertEqual(sorted(folders), ['classes', 'profiles'])
+      self.assertEqual((folders['classes']['operation'], folders['classes']['skip']['files']), ('replace', 2))
+      self.assertEqual((folders['profiles']['operation'], folders['profiles']['merge']['files']), ('merge', 1))
+      self.assertEqual(plan['totals']['skip']['files'], 2)
+
+   # (merged, copied, skipped) files of the merged folders and (copied, skipped) files of the replaced ones
+   def get_statistics(self, output):
+      merged = [line.split() for line in output.splitlines() if line.startswith('Merged ')][0]
+      replaced = [line.split() for line in output.splitlines() if line.startswith('Synchronized ')][0]
+      return (int(merged[3]), int(merged[6]), int(merged[9])), (int(replaced[3]), int(replaced[6]))
+
+   # files synchronized by the previous run are skipped, even if they were touched since, and synchronized again
+   # once their content changed
+   def test_manifest(self):
+      self.assertEqual(self.get_statistics(self.synchronize()[0]), ((1, 0, 0), (2, 0)))
+      self.assertEqual(self.get_statistics(self.synchronize()[0]), ((0, 0, 1), (0, 2)))
+
+      modification_time = time.time() + 10
+      for file_path in [self.source + '/profiles/Admin.profile', self.source + '/classes/A.cls', self.target + '/classes/B.cls']:
+         os.utime(file_path, (modification_time, modification_time))
+      self.assertEqual(self.get_statistics(self.synchronize()[0]), ((0, 0, 1), (0, 2)))
+
+      # source file of the same size but another content, changed destination files
+      with open(self.source + '/classes/A.cls', 'w') as class_file:
+         class_file.write('public class Z {}\n')
+      with open(self.target + '/classes/B.cls', 'a') as class_file:
+         class_file.write('// changed\n')
+      with open(self.target + '/profiles/Admin.profile', 'a') as profile_file:
+         profile_file.write('\n')
+      self.assertEqual(self.get_statistics(self.synchronize()[0]), ((1, 0, 0), (2, 0)))
+      for name in ['A', 'B']:
+         with open(self.source + '/classes/' + name + '.cls') as source_file:
+            with open(self.target + '/classes/' + name + '.cls') as target_file:
+               self.assertEqual(target_file.read(), source_file.read())
+      self.assertEqual(self.get_statistics(self.synchronize()[0]), ((0, 0, 1), (0, 2)))
+
+   # every configuration keeps a manifest of its own, switching between them doesn't invalidate the other one
+   def test_manifest_per_configuration(self):
+      self.synchronize()
+      self.assertEqual(self.get_statistics(self.synchronize('-c', 'profiles_only_sync_config.json')[0]), ((1, 0, 0), (0, 0)))
+      self.assertEqual(len(self.get_manifest_paths()), 2)
+      self.assertEqual(self.get_statistics(self.synchronize()[0]), ((0, 0, 1), (0, 2)))
+      self.assertEqual(self.get_statistics(self.synchronize('-c', 'profiles_only_sync_config.json')[0]), ((0, 0, 1), (0, 0)))
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# Regression tests of bin/update_xml.py, run with both python 2 (the synchronization runs the script by its
+# shebang) and python 3
+# Run: python -m unittest discover -s tests
+
+import sys
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import xml.etree.ElementTree as ElementTree
+
+TESTS_FOLDER_PATH = os.path.dirname(os.path.realpath(__file__))
+FIXTURES_FOLDER_PATH = TESTS_FOLDER_PATH + '/fixtures/update_xml'
+sys.path.insert(0, TESTS_FOLDER_PATH + '/../bin')
+import update_xml
+
+def get_merge_keys(metadata_type):
+   with open(update_xml.SCRIPT_FOLDER_PATH + '/' + update_xml.CONFIG_PATH + '/' + update_xml.MERGE_CONFIGURATION) as merge_config_file:
+      return update_xml.compile_merge_config(json.load(merge_config_file)[metadata_type], update_xml.DEFAULT_NAMESPACE)
+
+class UpdateXmlTest(unittest.TestCase):
+   def setUp(self):
+      ElementTree.register_namespace('', update_xml.DEFAULT_NAMESPACE)
+      self.temp_folder_path = tempfile.mkdtemp()
+
+   def tearDown(self):
+      shutil.rmtree(self.temp_folder_path)
+
+   # runs the merge task of the fixtures and returns the merged file and the summary
+   def merge(self, metadata_type, base_name, update_name, ancestor_name = None, streaming_threshold = None, canonical = False, cache_salt = None):
+      output_file = self.temp_folder_path + '/output.xml'
+      ancestor_file = FIXTURES_FOLDER_PATH + '/' + ancestor_name if ancestor_name is not None else None
+      log, error_message, summary = update_xml.merge_xml_files_task((FIXTURES_FOLDER_PATH + '/' + base_name, [FIXTURES_FOLDER_PATH + '/' + update_name],
+                                                                     output_file, ancestor_file, get_merge_keys(metadata_type), streaming_threshold, canonical, cache_salt))
+      self.assertEqual(error_message, None)
+      with open(output_file, 'rb') as merged_file:
+         return merged_file.read(), summary
+
+   # files with roots of other namespaces are merged in memory even above the streaming threshold
+   def test_streaming_merge_of_other_namespaces(self):
+      for name in ['other_namespace', 'no_namespace']:
+         self.assertFalse(update_xml.is_streaming_supported(FIXTURES_FOLDER_PATH + '/' + name + '_base.xml'))
+         merged, summary = self.merge('profiles', name + '_base.xml', name + '_update.xml')
+         streamed, summary = self.merge('profiles', name + '_base.xml', name + '_update.xml', streaming_threshold = 0)
+         self.assertEqual(streamed, merged)
+         self.assertTrue(streamed.startswith(b"<?xml version='1.0' encoding='UTF-8'?>\n<"))
+         ElementTree.fromstring(streamed)
+
+   # an output hard linked to another file (e.g. by clean_sf_metadata.py --target) is replaced, the other file
+   # keeps its content
+   def test_hard_linked_output_is_replaced(self):
+      for streaming_threshold in [None, 0]:
+         source_file = self.temp_folder_path + '/source.xml'
+         output_file = self.temp_folder_path + '/linked.xml'
+         shutil.copyfile(FIXTURES_FOLDER_PATH + '/profile_base.profile', source_file)
+         with open(source_file, 'rb') as original_file:
+            original = original_file.read()
+         os.link(source_file, output_file)
+         log, error_message, summary = update_xml.merge_xml_files_task((output_file, [FIXTURES_FOLDER_PATH + '/profile_update.profile'], output_file, None,
+                                                                        get_merge_keys('profiles'), streaming_threshold, False, None))
+         self.assertEqual(error_message, None)
+         self.assertTrue(summary['changed'])
+         self.assertEqual(os.stat(source_file).st_nlink, 1)
+         with open(source_file, 'rb') as source:
+            self.assertEqual(source.read(), original)
+         with open(output_file, 'rb') as output:
+            self.assertNotEqual(output.read(), original)
+         os.remove(source_file)
+         os.remove(output_file)
+
+   # a base the update doesn't change is written in canonical form as well, the same way a changed one would be
+   def test_canonical_form_of_unchanged_base(self):
+      expected = (b'<?xml version="1.0" encoding="UTF-8"?>\n<Profile xmlns="http://soap.sforce.com/2006/04/metadata">\n'
+                  b'    <custom>false</custom>\n'
+                  b'    <userPermissions>\n        <enabled>true</enabled>\n        <name>ApiEnabled</name>\n    </userPermissions>\n'
+                  b'    <userPermissions>\n        <enabled>true</enabled>\n        <name>ViewSetup</name>\n    </userPermissions>\n'
+                  b'</Profile>\n')
+      self.addCleanup(setattr, update_xml, 'MERGE_CACHE_FOLDER', update_xml.MERGE_CACHE_FOLDER)
+      update_xml.MERGE_CACHE_FOLDER = self.temp_folder_path + '/cache'
+      for streaming_threshold in [None, 0]:
+         # the second merge is replayed from the merge cache
+         for attempt in range(2):
+            merged, summary = self.merge('profiles', 'profile_base.profile', 'profile_unchanged.profile', streaming_threshold = streaming_threshold, canonical = True, cache_salt = str(streaming_threshold))
+            self.assertFalse(summary['changed'])
+            self.assertEqual(summary['cached'], attempt == 1)
+            self.assertEqual(merged, expected)
+      merged, summary = self.merge('profiles', 'profile_base.profile', 'profile_unchanged.profile', 'profile_unchanged.profile', canonical = True)
+      self.assertEqual(merged, expected)
+
+   # conflicting elements with nested children report the serialized children as their values
+   def test_three_way_conflict_of_nested_children(self):
+      merged, summary = self.merge('objects', 'three_way_base.object', 'three_way_update.object', 'three_way_ancestor.object')
+      self.assertEqual(len(summary['conflicts']), 1)
+      conflict = summary['conflicts'][0]
+      self.assertEqual((conflict['key'], conflict['kind']), ('#fields#Status__c', 'changed/changed'))
+      self.assertEqual(sorted(conflict['values']), ['valueSet'])
+      for version, value in [('ancestor', 'New'), ('base', 'Open'), ('update', 'Pending')]:
+         self.assertTrue(conflict['values']['valueSet'][version].startswith('<valueSet'))
+         self.assertTrue('<fullName>' + value + '</fullName>' in conflict['values']['valueSet'][version])
+      # the base keeps the conflicting field, the label changed by the update only is updated
+      self.assertTrue(b'<fullName>Open</fullName>' in merged)
+      self.assertTrue(b'<label>Service Request</label>' in merged)
+
+if __name__ == '__main__':
+   unittest.main()